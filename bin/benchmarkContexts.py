@@ -0,0 +1,78 @@
+"""
+Microbenchmark for the type context engine.
+
+Compares the PersistentArray-backed contexts that PersistentContext.enable()
+(--persistentContexts) switches to against the default substitution-list ones, on enumeration,
+likelihood scoring, type inference and eta-long conversion, for the list and
+tower grammars.
+
+Usage: python bin/benchmarkContexts.py [--budget NATS] [--repeat N]
+"""
+try:
+    import binutil  # required to import from dreamcoder modules
+except ModuleNotFoundError:
+    import bin.binutil  # alt import if called as module
+
+import argparse
+import time
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget_extra
+from dreamcoder.domains.tower.towerPrimitives import primitives as towerPrimitives, ttower
+from dreamcoder.grammar import Grammar, configureLikelihoodSummaryStore
+from dreamcoder.program import EtaLongVisitor
+from dreamcoder.type import PersistentContext, emptyContext, arrow, tint, tlist
+
+
+def workload(g, request, budget):
+    timings = {}
+
+    g.clearCandidateCache()
+    starting = time.time()
+    programs = [p for _, _, p in g.enumeration(emptyContext(), [], request,
+                                               upperBound=budget, maximumDepth=99)]
+    timings["enumeration"] = time.time() - starting
+
+    configureLikelihoodSummaryStore()
+    starting = time.time()
+    for p in programs: g.closedLikelihoodSummary(request, p)
+    timings["likelihood"] = time.time() - starting
+
+    starting = time.time()
+    for p in programs: p.infer()
+    timings["inference"] = time.time() - starting
+
+    starting = time.time()
+    for p in programs: EtaLongVisitor(request).execute(p)
+    timings["eta-long"] = time.time() - starting
+
+    return len(programs), timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the type context engine")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="enumeration budget in nats (default: 11 for list, 13 for tower)")
+    parser.add_argument("--repeat", type=int, default=3)
+    arguments = parser.parse_args()
+
+    domains = [("list", Grammar.uniform(bootstrapTarget_extra()), arrow(tlist(tint), tlist(tint)), 11.),
+               ("tower", Grammar.uniform(towerPrimitives), arrow(ttower, ttower), 13.)]
+    for name, g, request, budget in domains:
+        budget = arguments.budget or budget
+        results = {}
+        for engine, switch in [("substitution list", PersistentContext.disable),
+                               ("persistent array", PersistentContext.enable)]:
+            switch()
+            best = None
+            for _ in range(arguments.repeat):
+                n, timings = workload(g, request, budget)
+                best = timings if best is None else {k: min(best[k], timings[k]) for k in timings}
+            results[engine] = best
+        PersistentContext.disable()
+
+        print(f"{name}: {n} programs with MDL < {budget}")
+        print("%-12s %18s %18s %8s" % ("", "substitution list", "persistent array", "speedup"))
+        for k in results["persistent array"]:
+            old, new = results["substitution list"][k], results["persistent array"][k]
+            print("%-12s %17.3fs %17.3fs %7.2fx" % (k, old, new, old/new))
+        print()
@@ -0,0 +1,78 @@
+"""
+Benchmark for making Helmholtz dreams in the background during recognition training.
+
+Trains a recognition model for the list domain on dreams only, once with a single
+CPU, where dreams are made in process, and once with --CPUs, where
+RecognitionModel.train hands them to HelmholtzDreamer workers. Dreams are either
+sampled from the generative model as training goes ("random"), or given as
+frontiers whose tasks are computed while training ("enumerated").
+Workers are only used when the machine has more than one core, so on a single
+core both runs dream in process and take about as long.
+
+Usage: python bin/benchmarkHelmholtzDreams.py [--CPUs N] [--steps N] [--dreams N]
+"""
+try:
+    import binutil  # required to import from dreamcoder modules
+except ModuleNotFoundError:
+    import bin.binutil  # alt import if called as module
+
+import argparse
+import random
+import time
+
+import torch
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget_extra
+from dreamcoder.domains.list.main import LearnedFeatureExtractor, retrieveJSONTasks
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.recognition import RecognitionModel
+from dreamcoder.task import Task
+from dreamcoder.utilities import numberOfCPUs
+
+
+def enumeratedDreams(g, requests, n):
+    frontiers = []
+    while len(frontiers) < n:
+        request = random.choice(requests)
+        p = g.sample(request, maximumDepth=6)
+        if p is None: continue
+        frontiers.append(Frontier([FrontierEntry(p, logPrior=g.logLikelihood(request, p), logLikelihood=0.)],
+                                  task=Task("dream", request, [])))
+    return frontiers
+
+
+def train(g, tasks, helmholtzFrontiers, CPUs, steps):
+    random.seed(0)
+    torch.manual_seed(0)
+    model = RecognitionModel(LearnedFeatureExtractor(tasks), g)
+    starting = time.time()
+    model.train([], steps=steps, CPUs=CPUs, helmholtzRatio=1., batchSize=32,
+                helmholtzFrontiers=helmholtzFrontiers, defaultRequest=tasks[0].request)
+    return time.time() - starting
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks background Helmholtz dreaming")
+    parser.add_argument("--CPUs", type=int, default=numberOfCPUs())
+    parser.add_argument("--steps", type=int, default=3000,
+                        help="frontiers trained on, in batches of 32")
+    parser.add_argument("--dreams", type=int, default=2000,
+                        help="how many enumerated frontiers to dream from")
+    arguments = parser.parse_args()
+
+    tasks = [t for t in retrieveJSONTasks("data/list_tasks.json")
+             if t.request.returns().name == "list"]
+    g = Grammar.uniform(bootstrapTarget_extra())
+    requests = list({t.request for t in tasks})
+    print(f"{numberOfCPUs()} cores; comparing 1 CPU with {arguments.CPUs}")
+    if numberOfCPUs() == 1:
+        print("(a single core: both runs dream in process)")
+
+    print("%-12s %12s %12s %8s" % ("", "1 CPU", "%d CPUs" % arguments.CPUs, "speedup"))
+    for name, dreams in [("random", lambda: []),
+                         ("enumerated", lambda: enumeratedDreams(g, requests, arguments.dreams))]:
+        frontiers = dreams()
+        sequential = train(g, tasks, frontiers, 1, arguments.steps)
+        parallel = train(g, tasks, frontiers, arguments.CPUs, arguments.steps)
+        print("%-12s %11.1fs %11.1fs %7.2fx" % (name, sequential, parallel, sequential/parallel))
@@ -0,0 +1,52 @@
+"""
+Benchmark for observational-equivalence pruning in the bottom-up enumerator.
+
+Runs the bottom-up worker on the list bootstrap tasks, one job per request
+type, with and without pruning, and reports how many programs it had to build,
+how many tasks it solved and how long it took to solve them.
+
+Usage: python bin/benchmarkObservationalEquivalence.py [--timeout SECONDS]
+"""
+try:
+    import binutil  # required to import from dreamcoder modules
+except ModuleNotFoundError:
+    import bin.binutil  # alt import if called as module
+
+import argparse
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget_extra
+from dreamcoder.domains.list.makeListTasks import make_list_bootstrap_tasks
+from dreamcoder.enumeration import bottom_up_parallel_worker
+from dreamcoder.grammar import Grammar, PCFG
+from dreamcoder.program import NamedHole
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks observational equivalence in the bottom-up enumerator")
+    parser.add_argument("--timeout", type=float, default=30.,
+                        help="seconds of enumeration per job")
+    arguments = parser.parse_args()
+
+    g = Grammar.uniform(bootstrapTarget_extra())
+    jobs = {}
+    for t in make_list_bootstrap_tasks():
+        # the enumerator only checks its timeout between programs, and with two
+        # arguments a single size class can take longer than the whole budget
+        if len(t.request.functionArguments()) == 1:
+            jobs[t.request] = jobs.get(t.request, []) + [t]
+
+    print("%-40s %22s %22s" % ("", "plain", "observational eq."))
+    print("%-40s %8s %6s %6s %8s %6s %6s" % ("request", "programs", "solved", "time",
+                                             "programs", "solved", "time"))
+    for request, tasks in jobs.items():
+        pcfg = PCFG.from_grammar(g, request).number_rules()
+        skeleton = NamedHole(pcfg.start_symbol).wrap_in_abstractions(pcfg.number_of_arguments)
+        row = []
+        for observationalEquivalence in [False, True]:
+            frontiers, programs = bottom_up_parallel_worker(g, pcfg, [skeleton], tasks, arguments.timeout,
+                                                            {t: 1 for t in tasks},
+                                                            evaluationTimeout=1.,
+                                                            observationalEquivalence=observationalEquivalence)
+            times = [f.entries[0].search_time for f in frontiers.values() if not f.empty]
+            row += [programs, len(times), sum(times)]
+        print("%-40s %8d %6d %5.1fs %8d %6d %5.1fs" % (str(request), *row))
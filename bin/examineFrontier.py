@@ -8,6 +8,7 @@ import pregex as pre
 from dreamcoder.utilities import *
 from dreamcoder.domains.regex.groundtruthRegexes import *
 from dreamcoder.program import Abstraction, Application
+from dreamcoder.checkpoint import loadECResult
 
 from dreamcoder.domains.regex.makeRegexTasks import regexHeldOutExamples
 from dreamcoder.domains.regex.regexPrimitives import PRC
@@ -167,8 +168,7 @@ if __name__ == "__main__":
     
     print("started:", flush=True)
 
-    with open(checkpoint_file, 'rb') as file:
-        checkpoint = pickle.load(file)
+    checkpoint = loadECResult(checkpoint_file, attributes={"testSearchTime", "recognitionTaskMetrics"})
 
 
 
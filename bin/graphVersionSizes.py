@@ -1,72 +1,145 @@
-import matplotlib.pyplot as plot
+"""
+Version space sizes.
+
+    python bin/graphVersionSizes.py LOG LOG LOG
+plots the DATA lines that the version space compressor logs, for 1, 2 and 3
+refactoring steps.
+
+    python bin/graphVersionSizes.py --benchmark [--arities 1 2 3 4]
+builds the super version spaces of a fixed set of list programs, once for
+each number of refactoring steps, and reports how many version spaces that
+makes, how long it takes and how much memory the table holds.
+"""
+try:
+    import binutil  # required to import from dreamcoder modules
+except ModuleNotFoundError:
+    import bin.binutil  # alt import if called as module
+
+import argparse
 import math
-import sys
 import re
+import sys
+import time
+import tracemalloc
+
+
+def plotLogs(paths):
+    import matplotlib.pyplot as plot
 
-plot.figure()
-A = len(sys.argv) - 1
-assert A == 3
-for a,fn in enumerate(sys.argv[1:]):
-    print(fn)
-    ss = []
-    hs = []
-    cs = []
-    es = []
-    with open(fn,"r") as handle:
-        for l in handle:
-            if not l.startswith("DATA"):
-                continue
-            try:
-                size = re.search("size=([^\s]+)\s",l)[1]
-                height = re.search("height=([^\s]+)\s",l)[1]
-                compressed = re.search("\|vs\|=([^\s]+)\s",l)[1]
-                expanded = re.search("\|\[vs\]\|=([^\s]+)",l)[1]
-                print(l)
-                print(size, height, compressed, expanded)
-                ss.append(int(size))
-                hs.append(int(height))
-                cs.append(int(compressed))
-                es.append(math.e**float(expanded))
-            except:
-                print("ERROR:")
-                print(l)
-                sys.exit(0)
-
-
-
-
-
-    plot.subplot(A,3,1 + a*3)
-    plot.title(" ")
-    plot.scatter(ss,cs)
-    #plot.gca().set_yscale('log')
-    plot.xlabel("expression size")
-    plot.ylabel("version space size")
-
-    if False:
-        plot.subplot(2,2,2)
+    plot.figure()
+    A = len(paths)
+    assert A == 3
+    for a,fn in enumerate(paths):
+        print(fn)
+        ss = []
+        hs = []
+        cs = []
+        es = []
+        with open(fn,"r") as handle:
+            for l in handle:
+                if not l.startswith("DATA"):
+                    continue
+                try:
+                    size = re.search("size=([^\s]+)\s",l)[1]
+                    height = re.search("height=([^\s]+)\s",l)[1]
+                    compressed = re.search("\|vs\|=([^\s]+)\s",l)[1]
+                    expanded = re.search("\|\[vs\]\|=([^\s]+)",l)[1]
+                    print(l)
+                    print(size, height, compressed, expanded)
+                    ss.append(int(size))
+                    hs.append(int(height))
+                    cs.append(int(compressed))
+                    es.append(math.e**float(expanded))
+                except:
+                    print("ERROR:")
+                    print(l)
+                    sys.exit(0)
+
+
+
+
+
+        plot.subplot(A,3,1 + a*3)
         plot.title(" ")
-        plot.scatter(hs,cs)
+        plot.scatter(ss,cs)
         #plot.gca().set_yscale('log')
-        plot.xlabel("expression height")
+        plot.xlabel("expression size")
         plot.ylabel("version space size")
 
+        if False:
+            plot.subplot(2,2,2)
+            plot.title(" ")
+            plot.scatter(hs,cs)
+            #plot.gca().set_yscale('log')
+            plot.xlabel("expression height")
+            plot.ylabel("version space size")
+
+
+        plot.subplot(A,3,2 + a*3)
+        plot.scatter(cs,es)
+        plot.gca().set_yscale('log')
+        #plot.gca().set_xscale('log')
+        plot.title(f"{a+1} refactoring steps")
+        plot.xlabel("version space size")
+        plot.ylabel("# refactorings")
+
+
+        plot.subplot(A,3,3 + a*3)
+        plot.title(" ")
+        plot.scatter(ss,es)
+        plot.gca().set_yscale('log')
+        plot.xlabel("expression size")
+        plot.ylabel("# refactorings")
+
+
+    plot.show()
+
+
+BENCHMARKPROGRAMS = ["(lambda (map (lambda (+ $0 1)) $0))",
+                     "(lambda (map (lambda (+ $0 $0)) (cdr $0)))",
+                     "(lambda (fold $0 0 (lambda (lambda (+ $0 $1)))))",
+                     "(lambda (cons 1 (map (lambda (- $0 1)) $0)))"]
+
+
+def buildVersionSpaces(programs, arity):
+    from dreamcoder.vs import VersionTable
+    v = VersionTable(typed=False, identity=False)
+    for p in programs:
+        v.superVersionSpace(v.incorporate(p), arity)
+    return v
+
+
+def benchmark(arities):
+    from dreamcoder.domains.list.listPrimitives import bootstrapTarget_extra
+    from dreamcoder.program import Program
 
-    plot.subplot(A,3,2 + a*3)
-    plot.scatter(cs,es)
-    plot.gca().set_yscale('log')
-    #plot.gca().set_xscale('log')
-    plot.title(f"{a+1} refactoring steps")
-    plot.xlabel("version space size")
-    plot.ylabel("# refactorings")
+    bootstrapTarget_extra()
+    programs = [Program.parse(p) for p in BENCHMARKPROGRAMS]
+    print("%5s %14s %10s %12s %14s" % ("arity", "version spaces", "time", "memory", "bytes/space"))
+    for arity in arities:
+        starting = time.time()
+        v = buildVersionSpaces(programs, arity)
+        seconds = time.time() - starting
+        n = len(v)
+        v = None
 
+        # tracemalloc slows everything down, so it gets its own run
+        tracemalloc.start()
+        v = buildVersionSpaces(programs, arity)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        v = None
+        print("%5d %14d %9.2fs %10.1fMB %14.0f" % (arity, n, seconds, memory/10**6, memory/n))
 
-    plot.subplot(A,3,3 + a*3)
-    plot.title(" ")
-    plot.scatter(ss,es)
-    plot.gca().set_yscale('log')
-    plot.xlabel("expression size")
-    plot.ylabel("# refactorings")
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Version space sizes")
+    parser.add_argument("logs", nargs="*",
+                        help="compressor logs with DATA lines, for 1, 2 and 3 refactoring steps")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="measure time and memory of building version spaces")
+    parser.add_argument("--arities", type=int, nargs="+", default=[1, 2, 3, 4])
+    arguments = parser.parse_args()
 
-plot.show()
+    if arguments.benchmark: benchmark(arguments.arities)
+    else: plotLogs(arguments.logs)
@@ -4,6 +4,7 @@ except ModuleNotFoundError:
     import bin.binutil  # alt import if called as module
 
 from dreamcoder.dreamcoder import *
+from dreamcoder.resultView import ECResultView
 import dill
 import matplotlib
 matplotlib.use('Agg')
@@ -19,9 +20,8 @@ from dreamcoder.domains.tower.main import TowerCNN
 
 
 def loadfun(x):
-    with open(x, 'rb') as handle:
-        result = dill.load(handle)
-    return result
+    # Indexes the checkpoint the first time, and then only reads what gets used
+    return ECResultView(x)
 
 TITLEFONTSIZE = 14
 TICKFONTSIZE = 12
@@ -57,7 +57,7 @@ TowerFeatureExtractor = 'TowerFeatureExtractor'
 def padSearchTimes(result, testingTimeout, enumerationTimeout):
     result.testingSearchTime = [ ts + [testingTimeout]*(result.numTestingTasks - len(ts))
                                      for ts in result.testingSearchTime ]
-    result.searchTimes = [ ts + [enumerationTimeout]*(len(result.taskSolutions) - len(ts))
+    result.searchTimes = [ ts + [enumerationTimeout]*(result.length("taskSolutions") - len(ts))
                                for ts in result.searchTimes ]
 
 def updatePriors(result, path):
@@ -436,7 +436,7 @@ def plotECResult(
                     if numTasks:
                         ys = [t for t in result.learningCurve[:iterations]]
                     else:
-                        ys = [100.*t/float(len(result.taskSolutions)) for t in result.learningCurve[:iterations]]
+                        ys = [100.*t/float(result.length("taskSolutions")) for t in result.learningCurve[:iterations]]
                 else:
                     if cutoff is None:
                         if numTasks:
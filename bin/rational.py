@@ -271,9 +271,6 @@ class FeatureExtractor(ImageFeatureExtractor):
                                                channels=1)
         self.tasks = tasks
 
-    def featuresOfTask(self, t):
-        return self(t.features)
-
     def taskOfProgram(self, p, t):
         p = p.visit(RandomParameterization.single)
 
@@ -14,6 +14,7 @@ except ModuleNotFoundError:
     import bin.binutil  # alt import if called as module
 
 from dreamcoder.dreamcoder import *
+from dreamcoder.resultView import ECResultView
 import dill
 import numpy as np
 import matplotlib
@@ -207,7 +208,7 @@ def parseResultsPath(p):
         return Bunch(parameters)
 
 def loadResult(path, export=None):
-        result = loadfun(path)
+        result = ECResultView(path)
         # print("loaded path:", path)
         if not hasattr(result, "recognitionTaskMetrics"):
                 print("No recognitionTaskMetrics found, aborting.")
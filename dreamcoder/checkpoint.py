@@ -0,0 +1,258 @@
+"""Checkpoints as directories of append-only, content-addressed segments.
+
+A checkpoint directory holds
+    objects/<digest>    dill pickles, each named by the sha1 of its bytes
+    manifest.jsonl      one line per export:
+                        {"iteration": j, "parent": line, "segments": {attribute: digest}}
+    index/<line>        an index of each export, for ECResultView
+An export only stores what changed since its parent line. Each segment holds
+a delta for one attribute of the ECResult:
+    ("set", value)
+    ("extend", items)               appended to a list
+    ("update", {key: delta}, keys)  applied to some keys of a dict, removing others
+Dictionaries are compared key by key, all the way down, and lists by their
+prefix. Anything else inside them is compared by identity, so frontiers,
+grammars and metrics have to be replaced rather than changed in place, which
+is what ecIterator does. Attributes that are objects, like the recognition
+model, are pickled at every export and only stored again if their bytes
+changed. Tasks are pickled once, in the
+"tasks" pseudo-attribute, and referred to by name everywhere else.
+
+Loading an iteration follows the parent links back to the first export and
+applies the segments of the attributes that were asked for, so that
+analysis scripts need not read the recognition model or the frontiers
+to look at a learning curve."""
+
+import hashlib
+import io
+import json
+import os
+
+import dill
+
+from dreamcoder.task import Task
+
+
+MANIFEST = "manifest.jsonl"
+OBJECTS = "objects"
+TASKS = "tasks"
+
+
+def isCheckpointDirectory(path):
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+
+class _SegmentPickler(dill.Pickler):
+    """Pickles tasks as their names, remembering the tasks it has seen"""
+    def __init__(self, handle, tasks):
+        super(_SegmentPickler, self).__init__(handle)
+        self.tasks = tasks
+
+    def persistent_id(self, x):
+        if isinstance(x, Task):
+            self.tasks.setdefault(x.name, x)
+            return x.name
+        return None
+
+
+class _SegmentUnpickler(dill.Unpickler):
+    def __init__(self, handle, tasks):
+        super(_SegmentUnpickler, self).__init__(handle)
+        self.tasks = tasks
+
+    def persistent_load(self, name): return self.tasks()[name]
+
+
+class _Snapshot(object):
+    """What an attribute looked like when it was last exported: the value,
+    and, for dictionaries and lists, what they contained"""
+    def __init__(self, value):
+        self.value = value
+        if isinstance(value, dict):
+            self.contents = {k: _Snapshot(v) for k, v in value.items()}
+        elif isinstance(value, list):
+            self.contents = list(value)
+        else:
+            self.contents = None
+
+    def delta(self, value):
+        """The delta that takes the snapshot to value, or None if there is no change"""
+        if isinstance(value, dict) and isinstance(self.contents, dict):
+            changes = {}
+            for k, v in value.items():
+                old = self.contents.get(k, None)
+                d = ("set", v) if old is None else old.delta(v)
+                if d is not None: changes[k] = d
+            removed = [k for k in self.contents if k not in value]
+            if not changes and not removed: return None
+            return ("update", changes, removed)
+        if isinstance(value, list) and isinstance(self.contents, list):
+            n = len(self.contents)
+            if len(value) >= n and all(x is y for x, y in zip(value, self.contents)):
+                if len(value) == n: return None
+                return ("extend", value[n:])
+            return ("set", value)
+        if value is self.value and self.contents is None: return None
+        return ("set", value)
+
+
+def applyDelta(value, delta):
+    kind = delta[0]
+    if kind == "set": return delta[1]
+    if kind == "extend":
+        value.extend(delta[1])
+        return value
+    assert kind == "update", "Unknown checkpoint delta %s" % kind
+    _, changes, removed = delta
+    for k in removed: value.pop(k, None)
+    for k, d in changes.items():
+        value[k] = applyDelta(value.get(k, None), d)
+    return value
+
+
+class CheckpointDirectory(object):
+    """Reads and appends to a checkpoint directory. Exports are incremental
+    with respect to the last export or load of this object, which becomes
+    the parent of the next export."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.join(path, OBJECTS), exist_ok=True)
+        self.head = None
+        self.snapshots = {}
+        # digest of the last segment of each attribute
+        self.digests = {}
+        self.taskNames = set()
+
+    def manifest(self):
+        if not os.path.exists(os.path.join(self.path, MANIFEST)): return []
+        with open(os.path.join(self.path, MANIFEST), "r") as handle:
+            return [json.loads(line) for line in handle if line.strip()]
+
+    def iterations(self):
+        return sorted({entry["iteration"] for entry in self.manifest()})
+
+    def chain(self, iteration=None):
+        """Line numbers of the exports leading to iteration (default: the last export), oldest first"""
+        manifest = self.manifest()
+        assert manifest, "Empty checkpoint directory %s" % self.path
+        if iteration is None: line = len(manifest) - 1
+        else:
+            lines = [n for n, entry in enumerate(manifest) if entry["iteration"] == iteration]
+            assert lines, "No iteration %s in checkpoint directory %s" % (iteration, self.path)
+            line = lines[-1]
+        chain = []
+        while line is not None:
+            chain.append(line)
+            line = manifest[line]["parent"]
+        return manifest, chain[::-1]
+
+    def objectPath(self, digest):
+        return os.path.join(self.path, OBJECTS, digest)
+
+    def write(self, value, tasks=None):
+        """Stores value, unless an identical segment is already there. Returns its digest."""
+        handle = io.BytesIO()
+        if tasks is None: dill.dump(value, handle)
+        else: _SegmentPickler(handle, tasks).dump(value)
+        data = handle.getvalue()
+        digest = hashlib.sha1(data).hexdigest()
+        path = self.objectPath(digest)
+        if not os.path.exists(path):
+            temporary = "%s.%d" % (path, os.getpid())
+            with open(temporary, "wb") as handle: handle.write(data)
+            os.replace(temporary, path)
+        return digest
+
+    def read(self, digest, tasks=None):
+        with open(self.objectPath(digest), "rb") as handle:
+            if tasks is None: return dill.load(handle)
+            return _SegmentUnpickler(handle, tasks).load()
+
+    def export(self, result, iteration):
+        """Appends the parts of result that changed since the last export or load"""
+        tasks = {}
+        segments = {}
+        for name, value in result.__dict__.items():
+            if name == TASKS: continue
+            snapshot = self.snapshots.get(name, None)
+            if snapshot is None or not isinstance(value, (dict, list, type(None), bool, int, float, str)):
+                delta = ("set", value)
+            else:
+                delta = snapshot.delta(value)
+                if delta is None: continue
+            digest = self.write(delta, tasks)
+            self.snapshots[name] = _Snapshot(value)
+            unchanged = delta[0] == "set" and self.digests.get(name, None) == digest
+            self.digests[name] = digest
+            if not unchanged: segments[name] = digest
+        newTasks = {name: t for name, t in tasks.items() if name not in self.taskNames}
+        if newTasks:
+            segments[TASKS] = self.write(("update", {name: ("set", t) for name, t in newTasks.items()}, []))
+            self.taskNames.update(newTasks)
+
+        entry = {"iteration": iteration, "parent": self.head, "segments": segments}
+        with open(os.path.join(self.path, MANIFEST), "a") as handle:
+            handle.write(json.dumps(entry) + "\n")
+            handle.flush()
+            os.fsync(handle.fileno())
+        self.head = len(self.manifest()) - 1
+        self.index(result, iteration)
+        return entry
+
+    def index(self, result, iteration):
+        """Indexes the last export for ECResultView, from result, which is in
+        memory anyway, so that views never have to index it themselves"""
+        from dreamcoder.resultView import INDEXES, sourceOfLine, writeIndex
+
+        manifest, chain = self.chain(iteration)
+        assert chain[-1] == self.head
+        names = {name for line in chain for name in manifest[line]["segments"]} - {TASKS}
+        writeIndex(os.path.join(self.path, INDEXES, str(self.head)), sourceOfLine(manifest, chain),
+                   [(name, value) for name, value in result.__dict__.items() if name in names],
+                   directory=names)
+
+    def load(self, iteration=None, attributes=None):
+        """The ECResult exported for iteration (default: the last one). With
+        attributes, only those are read, and the others keep their defaults.
+        Loading everything makes the next export incremental with respect to
+        what was loaded."""
+        from dreamcoder.dreamcoder import ECResult
+
+        manifest, chain = self.chain(iteration)
+        digests = {}
+        for line in chain:
+            for name, digest in manifest[line]["segments"].items():
+                digests[name] = digests.get(name, []) + [digest]
+
+        table = []
+        def tasks():
+            if not table:
+                value = {}
+                for digest in digests.get(TASKS, []): value = applyDelta(value, self.read(digest))
+                table.append(value)
+            return table[0]
+
+        result = ECResult()
+        for name, ds in digests.items():
+            if name == TASKS or (attributes is not None and name not in attributes): continue
+            value = None
+            for digest in ds: value = applyDelta(value, self.read(digest, tasks))
+            setattr(result, name, value)
+
+        if attributes is None:
+            self.head = chain[-1]
+            self.snapshots = {name: _Snapshot(value) for name, value in result.__dict__.items()
+                              if name in digests}
+            self.digests = {name: ds[-1] for name, ds in digests.items()}
+            self.taskNames = set(tasks())
+        return result
+
+
+def loadECResult(path, attributes=None, iteration=None):
+    """Loads a checkpoint, either a dill pickle or a checkpoint directory.
+    attributes: for a directory, only load these attributes of the ECResult"""
+    if isCheckpointDirectory(path):
+        return CheckpointDirectory(path).load(iteration=iteration, attributes=attributes)
+    with open(path, "rb") as handle:
+        return dill.load(handle)
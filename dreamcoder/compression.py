@@ -11,7 +11,7 @@ from dreamcoder.grammar import Grammar
 from dreamcoder.task import Task
 from dreamcoder.program import Program, Invented
 from dreamcoder.utilities import eprint, timing, callCompiled, get_root_dir
-from dreamcoder.vs import induceGrammar_Beta
+from dreamcoder.vs import induceGrammar_Beta, induceGrammarWithStore
 
 
 def induceGrammar(*args, **kwargs):
@@ -19,6 +19,12 @@ def induceGrammar(*args, **kwargs):
         eprint("No nonempty frontiers, exiting grammar induction early.")
         return args[0], args[1]
     backend = kwargs.pop("backend", "pypy")
+    # only the python version space compressor keeps work from one call to the next
+    store = kwargs.pop("store", None)
+    # the python compressors fit weights by EM themselves, the others get refit below
+    emTolerance = kwargs.pop("emTolerance", None)
+    if backend in {"pypy", "pypy_vs"} and emTolerance is not None:
+        kwargs["emTolerance"] = emTolerance
     if 'pypy' in backend:
         # pypy might not like some of the imports needed for the primitives
         # but the primitive values are irrelevant for compression
@@ -46,7 +52,12 @@ def induceGrammar(*args, **kwargs):
             with open(fn, 'wb') as handle:
                 pickle.dump((args, kwargs), handle)
             eprint("For debugging purposes, the version space compression invocation has been saved to", fn)
-            g, newFrontiers = callCompiled(induceGrammar_Beta, *args, **kwargs)
+            if store is None:
+                g, newFrontiers = callCompiled(induceGrammar_Beta, *args, **kwargs)
+            else:
+                g, newFrontiers, newStore = callCompiled(induceGrammarWithStore, *args,
+                                                         store=store, **kwargs)
+                store.update(newStore)
         elif backend == "ocaml" or backend == "vs_factored":
             kwargs.pop('iteration')
             kwargs.pop('topk_use_only_likelihood')
@@ -63,7 +74,13 @@ def induceGrammar(*args, **kwargs):
                           [front.unstrip_primitive_values() for front in newFrontiers]
         newFrontiers = [Frontier(f.entries, original_tasks[f.task.name])
                         for f in newFrontiers] 
-        
+
+    if emTolerance is not None and backend not in {"pypy", "pypy_vs"}:
+        with timing("Refit production weights"):
+            topK = kwargs.get("topK", 1)
+            g = g.insideOutside([f.topK(topK) for f in newFrontiers if not f.empty],
+                                kwargs.get("pseudoCounts", 1.), tolerance=emTolerance)
+            newFrontiers = g.rescoreFrontiers(newFrontiers)
 
     return g, newFrontiers
 
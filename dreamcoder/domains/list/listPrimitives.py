@@ -76,6 +76,25 @@ def _fold(l): return lambda x0: lambda f: reduce(
     lambda a, x: f(x)(a), l[::-1], x0)
 
 
+# What calls to the looping primitives cost (see Primitive.fuel): one unit of
+# fuel per element they go through
+
+
+def _rangeFuel(n): return max(n, 0)
+
+
+def _mapFuel(f): return len
+
+
+def _reduceFuel(f): return lambda x0: len
+
+
+def _foldFuel(l): return lambda x0: lambda f: len(l)
+
+
+def _zipFuel(a): return lambda b: lambda f: min(len(a), len(b))
+
+
 def _eq(x): return lambda y: x == y
 
 
@@ -241,7 +260,7 @@ def primitives():
     return [Primitive(str(j), tint, j) for j in range(6)] + [
         Primitive("empty", tlist(t0), []),
         Primitive("singleton", arrow(t0, tlist(t0)), _single),
-        Primitive("range", arrow(tint, tlist(tint)), _range),
+        Primitive("range", arrow(tint, tlist(tint)), _range, _rangeFuel),
         Primitive("++", arrow(tlist(t0), tlist(t0), tlist(t0)), _append),
         # Primitive("map", arrow(arrow(t0, t1), tlist(t0), tlist(t1)), _map),
         Primitive(
@@ -253,7 +272,8 @@ def primitives():
                     t1),
                 tlist(t0),
                 tlist(t1)),
-            _mapi),
+            _mapi,
+            _mapFuel),
         # Primitive("reduce", arrow(arrow(t1, t0, t1), t1, tlist(t0), t1), _reduce),
         Primitive(
             "reducei",
@@ -266,7 +286,8 @@ def primitives():
                 t1,
                 tlist(t0),
                 t1),
-            _reducei),
+            _reducei,
+            _reduceFuel),
 
         Primitive("true", tbool, True),
         Primitive("not", arrow(tbool, tbool), _not),
@@ -291,13 +312,13 @@ def primitives():
         # (lambda (lambda (reduce (lambda (lambda (+ $0 $1))) 0 $0)))
         Primitive("reverse", arrow(tlist(t0), tlist(t0)), _reverse),
         # (lambda (reduce (lambda (lambda (++ (singleton $0) $1))) empty $0))
-        Primitive("all", arrow(arrow(t0, tbool), tlist(t0), tbool), _all),
+        Primitive("all", arrow(arrow(t0, tbool), tlist(t0), tbool), _all, _mapFuel),
         # (lambda (lambda (reduce (lambda (lambda (and $0 $1))) true (map $1 $0))))
-        Primitive("any", arrow(arrow(t0, tbool), tlist(t0), tbool), _any),
+        Primitive("any", arrow(arrow(t0, tbool), tlist(t0), tbool), _any, _mapFuel),
         # (lambda (lambda (reduce (lambda (lambda (or $0 $1))) true (map $1 $0))))
         Primitive("index", arrow(tint, tlist(t0), t0), _index),
         # (lambda (lambda (reducei (lambda (lambda (lambda (if (eq? $1 $4) $0 0)))) 0 $0)))
-        Primitive("filter", arrow(arrow(t0, tbool), tlist(t0), tlist(t0)), _filter),
+        Primitive("filter", arrow(arrow(t0, tbool), tlist(t0), tlist(t0)), _filter, _mapFuel),
         # (lambda (lambda (reduce (lambda (lambda (++ $1 (if ($3 $0) (singleton $0) empty)))) empty $0)))
         #Primitive("replace", arrow(arrow(tint, t0, tbool), tlist(t0), tlist(t0), tlist(t0)), _replace),
         # (FLATTEN (lambda (lambda (lambda (mapi (lambda (lambda (if ($4 $1 $0) $3 (singleton $1)))) $0)))))
@@ -324,17 +345,17 @@ def basePrimitives():
         Primitive("-", arrow(tint, tint, tint), _subtraction)
     ]
 
-zip_primitive = Primitive("zip", arrow(tlist(t0), tlist(t1), arrow(t0, t1, t2), tlist(t2)), _zip)
+zip_primitive = Primitive("zip", arrow(tlist(t0), tlist(t1), arrow(t0, t1, t2), tlist(t2)), _zip, _zipFuel)
 
 def bootstrapTarget():
     """These are the primitives that we hope to learn from the bootstrapping procedure"""
     return [
         # learned primitives
-        Primitive("map", arrow(arrow(t0, t1), tlist(t0), tlist(t1)), _map),
+        Primitive("map", arrow(arrow(t0, t1), tlist(t0), tlist(t1)), _map, _mapFuel),
         Primitive("unfold", arrow(t0, arrow(t0,tbool), arrow(t0,t1), arrow(t0,t0), tlist(t1)), _unfold),
-        Primitive("range", arrow(tint, tlist(tint)), _range),
+        Primitive("range", arrow(tint, tlist(tint)), _range, _rangeFuel),
         Primitive("index", arrow(tint, tlist(t0), t0), _index),
-        Primitive("fold", arrow(tlist(t0), t1, arrow(t0, t1, t1), t1), _fold),
+        Primitive("fold", arrow(tlist(t0), t1, arrow(t0, t1, t1), t1), _fold, _foldFuel),
         Primitive("length", arrow(tlist(t0), tint), len),
 
         # built-ins
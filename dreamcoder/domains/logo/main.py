@@ -23,7 +23,7 @@ from dreamcoder.dreamcoder import ecIterator
 from dreamcoder.grammar import Grammar
 from dreamcoder.program import Program
 try:
-    from dreamcoder.recognition import variable, maybe_cuda
+    from dreamcoder.recognition import variable, maybe_cuda, TaskCache
 except:
     print("WARNING: Could not import recognition. This is only okay when doing pypy compression.",
           file=sys.stderr)
@@ -125,7 +125,8 @@ try:
 
 
 
-        def forward(self, v):
+        def image(self, v):
+            """The input of the encoder for the image v"""
             assert len(v) == self.inputImageDimension*self.inputImageDimension
             floatOnlyTask = list(map(float, v))
             reshaped = [floatOnlyTask[i:i + self.inputImageDimension]
@@ -136,12 +137,16 @@ try:
             v = torch.unsqueeze(v, 0)
             v = maybe_cuda(v, next(self.parameters()).is_cuda)/256.
             window = int(self.inputImageDimension/self.resizedDimension)
-            v = F.avg_pool2d(v, (window,window))
-            v = self.encoder(v)
-            return v.view(-1)
+            return F.avg_pool2d(v, (window,window))
+
+        def forward(self, v):
+            return self.encoder(self.image(v)).view(-1)
 
         def featuresOfTask(self, t):  # Take a task and returns [features]
-            return self(t.highresolution)
+            # the image of each task is only converted once
+            images = TaskCache.of(self, maximumSize=1000)
+            v = images.get(t, lambda t: self.image(t.highresolution))
+            return self.encoder(v).view(-1)
 
         def tasksOfPrograms(self, ps, types):
             images = drawLogo(*ps, resolution=128)
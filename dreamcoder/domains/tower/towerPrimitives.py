@@ -113,7 +113,7 @@ new_primitives = common_primitives + [
 
 def executeTower(p, timeout=None):
     try:
-        return runWithTimeout(lambda : p.evaluate([])(_empty_tower)(TowerState())[1],
+        return runWithTimeout(lambda : p.compile(EvaluationBudget.forTimeout(timeout))(())(_empty_tower)(TowerState())[1],
                               timeout=timeout)
     except RunWithTimeout: return None
     except: return None
@@ -2,7 +2,10 @@ import datetime
 
 import dill
 
+from dreamcoder.checkpoint import CheckpointDirectory, isCheckpointDirectory, loadECResult
 from dreamcoder.compression import induceGrammar
+from dreamcoder.task import configureEvaluationCache
+from dreamcoder.vs import CompressionStore
 from dreamcoder.utilities import *
 try:
     from dreamcoder.recognition import *
@@ -79,6 +82,7 @@ class ECResult():
                      "ensembleSize": "ES",
                      "recognitionTimeout": "RT",
                      "recognitionSteps": "RS",
+                     "recognitionBatchSize": "RB",
                      "iterations": "it",
                      "maximumFrontier": "MF",
                      "pseudoCounts": "pc",
@@ -144,6 +148,11 @@ def ecIterator(grammar, tasks,
                addFullTaskMetrics=False,
                matrixRank=None,
                solver='ocaml',
+               solverOptions=None,
+               hashConsing=False,
+               persistentContexts=False,
+               evaluationCache=None,
+               incrementalCheckpoints=False,
                compressor="rust",
                biasOptimal=False,
                contextual=False,
@@ -158,6 +167,7 @@ def ecIterator(grammar, tasks,
                useRecognitionModel=True,
                recognitionTimeout=None,
                recognitionSteps=None,
+               recognitionBatchSize=None,
                helmholtzRatio=0.,
                featureExtractor=None,
                activation='relu',
@@ -167,6 +177,7 @@ def ecIterator(grammar, tasks,
                maximumFrontier=None,
                pseudoCounts=1.0, aic=1.0,
                structurePenalty=0.001, arity=0,
+               emTolerance=None,
                evaluationTimeout=1.0,  # seconds
                taskBatchSize=None,
                taskReranker='default',
@@ -210,6 +221,18 @@ def ecIterator(grammar, tasks,
     if testingTimeout > 0 and len(testingTasks) == 0:
         eprint("You specified a testingTimeout, but did not provide any held out testing tasks, aborting.")
         assert False
+    if solverOptions is None: solverOptions = SolverOptions()
+    if solverOptions.binaryProtocol and not binaryProtocolAvailable():
+        eprint("Warning: the binary protocol needs the msgpack package. Falling back to json.")
+        solverOptions = solverOptions.replace(binaryProtocol=False)
+    if hashConsing:
+        HashConsing.enable()
+    if persistentContexts:
+        PersistentContext.enable()
+    if evaluationCache is not None:
+        # an empty path keeps the cache in memory
+        configureEvaluationCache(path=evaluationCache or None)
+        for t in tasks + testingTasks: t.cache = True
 
     
     #tasks=[t for t in tasks if t.name=="bool-identify-geq-k with k=0" ]
@@ -237,10 +260,16 @@ def ecIterator(grammar, tasks,
             "evaluationTimeout",
             "testingTasks",
             "compressor",
+            "solverOptions",
+            "hashConsing",
+            "persistentContexts",
+            "evaluationCache",
+            "incrementalCheckpoints",
             "custom_wake_generative"} and v is not None}
     if not useRecognitionModel:
         for k in {"helmholtzRatio", "recognitionTimeout", "biasOptimal", "mask",
-                  "contextual", "matrixRank", "reuseRecognition", "auxiliaryLoss", "ensembleSize"}:
+                  "contextual", "matrixRank", "reuseRecognition", "auxiliaryLoss", "ensembleSize",
+                  "recognitionBatchSize"}:
             if k in parameters: del parameters[k]
     else: del parameters["useRecognitionModel"];
     if useRecognitionModel and not contextual:
@@ -265,6 +294,18 @@ def ecIterator(grammar, tasks,
                 parameters.keys())]
         return "{}_{}{}.pickle".format(outputPrefix, "_".join(kvs), extra)
 
+    # With incrementalCheckpoints, every iteration goes into one directory
+    def checkpointDirectoryPath():
+        kvs = [
+            "{}={}".format(
+                ECResult.abbreviate(k),
+                parameters[k]) for k in sorted(
+                parameters.keys()) if k != "iterations"]
+        return "{}_{}.checkpoint".format(outputPrefix, "_".join(kvs))
+    checkpoints = None
+    if incrementalCheckpoints and outputPrefix is not None:
+        checkpoints = CheckpointDirectory(checkpointDirectoryPath())
+
     if message:
         message = " (" + message + ")"
     eprint("Running EC%s on %s @ %s with %d CPUs and parameters:" %
@@ -283,13 +324,21 @@ def ecIterator(grammar, tasks,
     
     # Restore checkpoint
     if resume is not None:
+        iteration = None
         try:
             resume = int(resume)
-            path = checkpointPath(resume)
+            if checkpoints is not None: path, iteration = checkpoints.path, resume
+            else: path = checkpointPath(resume)
         except ValueError:
             path = resume
-        with open(path, "rb") as handle:
-            result = dill.load(handle)
+        if isCheckpointDirectory(path):
+            # Loading through the directory we export to makes the next export incremental
+            sameDirectory = checkpoints is not None and \
+                            os.path.abspath(path) == os.path.abspath(checkpoints.path)
+            result = (checkpoints if sameDirectory else CheckpointDirectory(path)).load(iteration=iteration)
+        else:
+            with open(path, "rb") as handle:
+                result = dill.load(handle)
         resume = len(result.grammars) - 1
         eprint("Loaded checkpoint from", path)
         grammar = result.grammars[-1] if result.grammars else grammar
@@ -340,6 +389,7 @@ def ecIterator(grammar, tasks,
                                                      maximumFrontier=maximumFrontier, 
                                                      CPUs=CPUs, evaluationTimeout=evaluationTimeout,
                                                      solver=solver,
+                                                     solverOptions=solverOptions,
                                                      **kw)
         trainFrontiers, _, trainingTimes = enumerator(tasks, enumerationTimeout=enumerationTimeout)
         testFrontiers, _, testingTimes = enumerator(testingTasks, enumerationTimeout=testingTimeout, testing=True)
@@ -367,7 +417,10 @@ def ecIterator(grammar, tasks,
             
         sys.exit(0)
     
-    
+    # Version spaces and rewrites that the compressor keeps between iterations.
+    # They are not checkpointed: after resuming, the first compression rebuilds them.
+    compressionStore = CompressionStore()
+
     for j in range(resume or 0, iterations):
         if storeTaskMetrics and rewriteTaskMetrics:
             eprint("Resetting task metrics for next iteration.")
@@ -380,7 +433,7 @@ def ecIterator(grammar, tasks,
             eprint("Evaluating on held out testing tasks for iteration: %d" % (j))
             evaluateOnTestingTasks(result, testingTasks, grammar,
                                    CPUs=CPUs, maximumFrontier=maximumFrontier,
-                                   solver=solver,
+                                   solver=solver, solverOptions=solverOptions,
                                    enumerationTimeout=testingTimeout, evaluationTimeout=evaluationTimeout)            
         # If we have to also enumerate Helmholtz frontiers,
         # do this extra sneaky in the background
@@ -390,7 +443,8 @@ def ecIterator(grammar, tasks,
             if useDSL or 'helmholtzFrontiers' not in locals():
                 helmholtzFrontiers = backgroundHelmholtzEnumeration(tasks, grammar, enumerationTimeout,
                                                                     evaluationTimeout=evaluationTimeout,
-                                                                    special=featureExtractor.special)
+                                                                    special=featureExtractor.special,
+                                                                    binaryProtocol=solverOptions.binaryProtocol)
             else:
                 print("Reusing dreams from previous iteration.")
         else:
@@ -404,7 +458,12 @@ def ecIterator(grammar, tasks,
 
         # WAKING UP
         if useDSL:
-            wake_generative = custom_wake_generative if custom_wake_generative is not None else default_wake_generative
+            if custom_wake_generative is not None:
+                wake_generative = custom_wake_generative
+            else:
+                wake_generative = lambda *a, **k: default_wake_generative(*a,
+                                                                          solverOptions=solverOptions,
+                                                                          **k)
             topDownFrontiers, times = wake_generative(grammar, wakingTaskBatch,
                                                       solver=solver,
                                                       maximumFrontier=maximumFrontier,
@@ -449,7 +508,9 @@ def ecIterator(grammar, tasks,
                                enumerationTimeout=enumerationTimeout,
                                helmholtzRatio=thisRatio, helmholtzFrontiers=helmholtzFrontiers(),
                                auxiliaryLoss=auxiliaryLoss, cuda=cuda, CPUs=CPUs, solver=solver,
-                               recognitionSteps=recognitionSteps, maximumFrontier=maximumFrontier)
+                               solverOptions=solverOptions,
+                               recognitionSteps=recognitionSteps, recognitionBatchSize=recognitionBatchSize,
+                               maximumFrontier=maximumFrontier)
 
             showHitMatrix(tasksHitTopDown, tasksHitBottomUp, wakingTaskBatch)
             
@@ -469,13 +530,18 @@ def ecIterator(grammar, tasks,
             eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
             grammar = consolidate(result, grammar, topK=topK, pseudoCounts=pseudoCounts, arity=arity, aic=aic,
                                   structurePenalty=structurePenalty, compressor=compressor, CPUs=CPUs,
-                                  iteration=j)
+                                  iteration=j, emTolerance=emTolerance, store=compressionStore)
             eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
         else:
             eprint("Skipping consolidation.")
             result.grammars.append(grammar)
             
-        if outputPrefix is not None:
+        if checkpoints is not None:
+            entry = checkpoints.export(result, j + 1)
+            eprint("Exported iteration %d to checkpoint directory %s (%d changed segments)" %
+                   (j + 1, checkpoints.path, len(entry["segments"])))
+            graphPrimitives(result, "%s_primitives_%d_"%(outputPrefix,j))
+        elif outputPrefix is not None:
             path = checkpointPath(j + 1)
             with open(path, "wb") as handle:
                 try:
@@ -510,13 +576,15 @@ def showHitMatrix(top, bottom, tasks):
                                              len(top & bottom)))
 
 def evaluateOnTestingTasks(result, testingTasks, grammar, _=None,
-                           CPUs=None, solver=None, maximumFrontier=None, enumerationTimeout=None, evaluationTimeout=None):
+                           CPUs=None, solver=None, maximumFrontier=None, enumerationTimeout=None, evaluationTimeout=None,
+                           solverOptions=None):
     if result.recognitionModel is not None:
         recognizer = result.recognitionModel
         testingFrontiers, times = \
          recognizer.enumerateFrontiers(testingTasks, 
                                        CPUs=CPUs,
                                        solver=solver,
+                                       solverOptions=solverOptions,
                                        maximumFrontier=maximumFrontier,
                                        enumerationTimeout=enumerationTimeout,
                                        evaluationTimeout=evaluationTimeout,
@@ -527,6 +595,7 @@ def evaluateOnTestingTasks(result, testingTasks, grammar, _=None,
     else:
         testingFrontiers, times = multicoreEnumeration(grammar, testingTasks, 
                                                        solver=solver,
+                                                       solverOptions=solverOptions,
                                                        maximumFrontier=maximumFrontier,
                                                        enumerationTimeout=enumerationTimeout,
                                                        CPUs=CPUs,
@@ -550,12 +619,14 @@ def default_wake_generative(grammar, tasks,
                     enumerationTimeout=None,
                     CPUs=None,
                     solver=None,
-                    evaluationTimeout=None):
+                    evaluationTimeout=None,
+                    solverOptions=None):
     topDownFrontiers, times = multicoreEnumeration(grammar, tasks, 
                                                    maximumFrontier=maximumFrontier,
                                                    enumerationTimeout=enumerationTimeout,
                                                    CPUs=CPUs,
                                                    solver=solver,
+                                                   solverOptions=solverOptions,
                                                    evaluationTimeout=evaluationTimeout)
     eprint("Generative model enumeration results:")
     eprint(Frontier.describe(topDownFrontiers))
@@ -565,10 +636,11 @@ def default_wake_generative(grammar, tasks,
 def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFrontiers, _=None,
                       ensembleSize=1, featureExtractor=None, matrixRank=None, mask=False,
                       activation=None, contextual=True, biasOptimal=True,
-                      previousRecognitionModel=None, recognitionSteps=None,
+                      previousRecognitionModel=None, recognitionSteps=None, recognitionBatchSize=None,
                       timeout=None, enumerationTimeout=None, evaluationTimeout=None,
                       helmholtzRatio=None, helmholtzFrontiers=None, maximumFrontier=None,
-                      auxiliaryLoss=None, cuda=None, CPUs=None, solver=None):
+                      auxiliaryLoss=None, cuda=None, CPUs=None, solver=None,
+                      solverOptions=None):
     eprint("Using an ensemble size of %d. Note that we will only store and test on the best recognition model." % ensembleSize)
 
     featureExtractorObjects = [featureExtractor(tasks, testingTasks=testingTasks, cuda=cuda) for i in range(ensembleSize)]
@@ -582,35 +654,32 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
                                     previousRecognitionModel=previousRecognitionModel,
                                     id=i) for i in range(ensembleSize)]
     eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
-    trainedRecognizers = parallelMap(min(CPUs,len(recognizers)),
-                                     lambda recognizer: recognizer.train(allFrontiers,
-                                                                         biasOptimal=biasOptimal,
-                                                                         helmholtzFrontiers=helmholtzFrontiers, 
-                                                                         CPUs=CPUs,
-                                                                         evaluationTimeout=evaluationTimeout,
-                                                                         timeout=timeout,
-                                                                         steps=recognitionSteps,
-                                                                         helmholtzRatio=helmholtzRatio,
-                                                                         auxLoss=auxiliaryLoss,
-                                                                         vectorized=True),
-                                     recognizers,
-                                     seedRandom=True)
+    trainedRecognizers = trainEnsemble(recognizers, allFrontiers,
+                                       biasOptimal=biasOptimal,
+                                       helmholtzFrontiers=helmholtzFrontiers,
+                                       CPUs=CPUs,
+                                       evaluationTimeout=evaluationTimeout,
+                                       timeout=timeout,
+                                       steps=recognitionSteps,
+                                       helmholtzRatio=helmholtzRatio,
+                                       auxLoss=auxiliaryLoss,
+                                       vectorized=True,
+                                       batchSize=recognitionBatchSize or 1)
     eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
-    # Enumerate frontiers for each of the recognizers.
+    # Enumerate frontiers for each of the recognizers, at the same time.
     eprint("Trained an ensemble of %d recognition models, now enumerating." % len(trainedRecognizers))
     ensembleFrontiers, ensembleTimes, ensembleRecognitionTimes = [], [], []
     mostTasks = 0
     bestRecognizer = None
     totalTasksHitBottomUp = set()
-    for recIndex, recognizer in enumerate(trainedRecognizers):
-        eprint("Enumerating from recognizer %d of %d" % (recIndex, len(trainedRecognizers)))
-        bottomupFrontiers, allRecognitionTimes = \
-                        recognizer.enumerateFrontiers(taskBatch, 
-                                                      CPUs=CPUs,
-                                                      maximumFrontier=maximumFrontier,
-                                                      enumerationTimeout=enumerationTimeout,
-                                                      evaluationTimeout=evaluationTimeout,
-                                                      solver=solver)
+    enumerated = enumerateEnsemble(trainedRecognizers, taskBatch,
+                                   CPUs=CPUs,
+                                   maximumFrontier=maximumFrontier,
+                                   enumerationTimeout=enumerationTimeout,
+                                   evaluationTimeout=evaluationTimeout,
+                                   solver=solver,
+                                   solverOptions=solverOptions)
+    for recIndex, (bottomupFrontiers, allRecognitionTimes) in enumerate(enumerated):
         ensembleFrontiers.append(bottomupFrontiers)
         ensembleTimes.append([t for t in allRecognitionTimes.values() if t is not None])
         ensembleRecognitionTimes.append(allRecognitionTimes)
@@ -621,6 +690,7 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
         if len(recognizerTasksHitBottomUp) >= mostTasks:
             # TODO (cathywong): could consider keeping the one that put the highest likelihood on the solved tasks.
             bestRecognizer = recIndex
+            mostTasks = len(recognizerTasksHitBottomUp)
 
     # Store the recognizer that discovers the most frontiers in the result.
     eprint("Best recognizer: %d." % bestRecognizer)
@@ -666,7 +736,9 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
     return totalTasksHitBottomUp
 
 def consolidate(result, grammar, _=None, topK=None, arity=None, pseudoCounts=None, aic=None,
-                structurePenalty=None, compressor=None, CPUs=None, iteration=None):
+                structurePenalty=None, compressor=None, CPUs=None, iteration=None, emTolerance=None,
+                store=None):
+    """store: a CompressionStore that the compressor keeps its work in from one iteration to the next"""
     eprint("Showing the top 5 programs in each frontier being sent to the compressor:")
     for f in result.allFrontiers.values():
         if f.empty:
@@ -690,7 +762,8 @@ def consolidate(result, grammar, _=None, topK=None, arity=None, pseudoCounts=Non
                                                       pseudoCounts=pseudoCounts, a=arity,
                                                       aic=aic, structurePenalty=structurePenalty,
                                                       topk_use_only_likelihood=False,
-                                                      backend=compressor, CPUs=CPUs, iteration=iteration)
+                                                      backend=compressor, CPUs=CPUs, iteration=iteration,
+                                                      emTolerance=emTolerance, store=store)
         # Store compression frontiers in the result.
         for c in compressionFrontiers:
             result.allFrontiers[c.task] = c.topK(0) if c in needToSupervise else c
@@ -752,6 +825,10 @@ def commandlineArguments(_=None,
                         default=None,
                         help="Number of gradient steps to train the recognition model. Can be specified instead of train time.",
                         type=int)
+    parser.add_argument("--recognitionBatchSize",
+                        default=None,
+                        help="Number of frontiers in each gradient step of the recognition model. Default: 1, one step per frontier",
+                        type=int)
     parser.add_argument(
         "-k",
         "--topK",
@@ -771,6 +848,10 @@ def commandlineArguments(_=None,
                         default=structurePenalty,
                         help="default: %f" % structurePenalty,
                         type=float)
+    parser.add_argument("--emTolerance",
+                        default=None,
+                        help="Fit production weights by EM until no log weight moves by more than this. Default: a single round of EM",
+                        type=float)
     parser.add_argument("-a", "--arity",
                         default=a,
                         help="default: %d" % a,
@@ -857,6 +938,40 @@ def commandlineArguments(_=None,
         help="""Solver for enumeration.
                         Default: %s""" %
         solver)
+    parser.add_argument("--persistentSolvers",
+                        default=False, action="store_true",
+                        help="""Keep one ocaml solver process per job alive across
+                        enumeration budget slices, instead of launching a new one per slice.""")
+    parser.add_argument("--binaryProtocol",
+                        default=False, action="store_true",
+                        help="""Talk to the ocaml solver and helmholtz binaries in length-prefixed
+                        msgpack frames instead of json. Needs the msgpack package.""")
+    parser.add_argument("--observationalEquivalence",
+                        default=False, action="store_true",
+                        help="""With the bottom-up solver, keep only the cheapest subexpression
+                        for each behaviour on the task inputs.""")
+    parser.add_argument("--streamHits",
+                        default=False, action="store_true",
+                        help="""Have ocaml and python solvers report each hit as soon as they find it,
+                        and cancel jobs as soon as all of their tasks are solved.""")
+    parser.add_argument("--incrementalCheckpoints",
+                        default=False, action="store_true",
+                        help="""Export checkpoints into one directory of content-addressed segments,
+                        writing only what changed in each iteration, instead of one pickle per iteration.
+                        --resume takes the directory, or an iteration number.""")
+    parser.add_argument("--hashConsing",
+                        default=False, action="store_true",
+                        help="""Hash-cons programs, so that structurally equal programs share
+                        one node in memory and compare by identity.""")
+    parser.add_argument("--persistentContexts",
+                        default=False, action="store_true",
+                        help="""Keep type substitutions in persistent arrays instead of lists,
+                        when enumerating, scoring and inferring types. See bin/benchmarkContexts.py.""")
+    parser.add_argument("--evaluationCache",
+                        default=None, nargs="?", const="", metavar="DATABASE",
+                        help="""Cache the outputs of programs on the inputs of every task, when they are
+                        evaluated in python (python, pypy and bottom-up solvers). Given a path, the cache
+                        is also kept in an sqlite database there, shared by the enumeration workers.""")
     parser.add_argument(
         "-r",
         "--Helmholtz",
@@ -963,8 +1078,7 @@ def commandlineArguments(_=None,
     if v["primitive-graph"] is not None:
         
         for n,pg in enumerate(v["primitive-graph"]):
-            with open(pg,'rb') as handle:
-                result = dill.load(handle)
+            result = loadECResult(pg, attributes={"grammars"})
             graphPrimitives(result,f"figures/deepProgramLearning/{sys.argv[0]}{n}",view=True)
         sys.exit(0)
     else:
@@ -972,8 +1086,7 @@ def commandlineArguments(_=None,
 
     if v["addTaskMetrics"] is not None:
         for path in v["addTaskMetrics"]:
-            with open(path,'rb') as handle:
-                result = dill.load(handle)
+            result = loadECResult(path)
             addTaskMetrics(result, path)
         sys.exit(0)
     else:
@@ -983,8 +1096,7 @@ def commandlineArguments(_=None,
         v["recognitionTimeout"] = v["enumerationTimeout"]
 
     if v["countParameters"]:
-        with open(v["countParameters"], "rb") as handle:
-            result = dill.load(handle)
+        result = loadECResult(v["countParameters"], attributes={"recognitionModel"})
         eprint("The recognition model has",
                sum(p.numel() for p in result.recognitionModel.parameters() if p.requires_grad),
                "trainable parameters and",
@@ -998,6 +1110,10 @@ def commandlineArguments(_=None,
                "of those parameters.\n")
         sys.exit(0)
     del v["countParameters"]
+
+    v["solverOptions"] = SolverOptions(**{k: v.pop(k)
+                                          for k in ["persistentSolvers", "binaryProtocol", "streamHits",
+                                                    "observationalEquivalence"]})
         
         
     return v
@@ -8,35 +8,58 @@ from dreamcoder.grammar import Grammar
 from dreamcoder.program import Program
 from dreamcoder.task import Task
 from dreamcoder.type import arrow, tint
-from dreamcoder.utilities import tuplify, timing, eprint, get_root_dir, mean
+from dreamcoder.utilities import tuplify, timing, eprint, get_root_dir, mean, frameMessage, unframeMessage, \
+    binaryProtocolAvailable, binaryCapabilities
+
+
+def helmholtzBinaryProtocol(binaryProtocol):
+    """Whether helmholtz can be talked to in msgpack: that needs the msgpack
+    package, and a helmholtz binary that was built with --msgpack"""
+    return binaryProtocol and binaryProtocolAvailable() and \
+        "msgpack" in binaryCapabilities(os.path.join(get_root_dir(), 'helmholtz'))
 
 
 def helmholtzEnumeration(g, request, inputs, timeout, _=None,
-                         special=None, evaluationTimeout=None):
-    """Returns json (as text)"""
+                         special=None, evaluationTimeout=None, binaryProtocol=False):
+    """Returns json (as text), or a msgpack frame if binaryProtocol.
+    Use decodeHelmholtzResponse to parse either.
+    Without the msgpack package, or with an older binary, binaryProtocol falls back to json."""
+    binaryProtocol = helmholtzBinaryProtocol(binaryProtocol)
     message = {"request": request.json(),
                "timeout": timeout,
                "DSL": g.json(),
                "extras": inputs}
     if evaluationTimeout: message["evaluationTimeout"] = evaluationTimeout
     if special: message["special"] = special
-    message = json.dumps(message)
-    with open('/tmp/hm', 'w') as handle:
-        handle.write(message)
+    if binaryProtocol:
+        message = frameMessage(message)
+    else:
+        message = json.dumps(message)
+        with open('/tmp/hm', 'w') as handle:
+            handle.write(message)
+        message = bytes(message, encoding="utf-8")
     try:
         binary = os.path.join(get_root_dir(), 'helmholtz')
-        process = subprocess.Popen(binary,
+        process = subprocess.Popen([binary, "--msgpack"] if binaryProtocol else binary,
                                    stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE)
-        response, error = process.communicate(bytes(message, encoding="utf-8"))
+        response, error = process.communicate(message)
     except OSError as exc:
         raise exc
     return response
 
 
+def decodeHelmholtzResponse(response, binaryProtocol=False):
+    if helmholtzBinaryProtocol(binaryProtocol): return unframeMessage(response)
+    return json.loads(response.decode("utf-8"))
+
+
 def backgroundHelmholtzEnumeration(tasks, g, timeout, _=None,
-                                   special=None, evaluationTimeout=None):
+                                   special=None, evaluationTimeout=None, binaryProtocol=False):
     from pathos.multiprocessing import Pool
+    if binaryProtocol and not helmholtzBinaryProtocol(binaryProtocol):
+        eprint("The helmholtz binary does not support the binary protocol (rebuild it with make); falling back to json.")
+        binaryProtocol = False
     requests = list({t.request for t in tasks})
     inputs = {r: list({tuplify(xs)
                        for t in tasks if t.request == r
@@ -46,7 +69,8 @@ def backgroundHelmholtzEnumeration(tasks, g, timeout, _=None,
     promises = [workers.apply_async(helmholtzEnumeration,
                                     args=(g, r, inputs[r], float(timeout)),
                                     kwds={'special': special,
-                                          'evaluationTimeout': evaluationTimeout})
+                                          'evaluationTimeout': evaluationTimeout,
+                                          'binaryProtocol': binaryProtocol})
                 for r in requests]
 
     def get():
@@ -54,7 +78,7 @@ def backgroundHelmholtzEnumeration(tasks, g, timeout, _=None,
         frontiers = []
         with timing("(Helmholtz enumeration) Decoded json into frontiers"):
             for request, result in zip(requests, results):
-                response = json.loads(result.decode("utf-8"))
+                response = decodeHelmholtzResponse(result, binaryProtocol=binaryProtocol)
                 for b, entry in enumerate(response):
                     frontiers.append(Frontier([FrontierEntry(program=Program.parse(p),
                                                              logPrior=entry["ll"],
@@ -1,12 +1,43 @@
 from dreamcoder.likelihoodModel import AllOrNothingLikelihoodModel
 from dreamcoder.grammar import *
-from dreamcoder.utilities import get_root_dir
+from dreamcoder.utilities import get_root_dir, binaryProtocolAvailable, binaryCapabilities, Prepacked, frameMessage, unframeMessage, readFrame
 
 import os
 import traceback
 import subprocess
 
 
+class SolverOptions(object):
+    """How enumeration runs its solvers. Made once, by ecIterator or the command
+    line, and handed down to multicoreEnumeration.
+    persistentSolvers: with the ocaml solver, keep one solver process per job
+    alive across budget slices instead of forking a fresh one for every slice.
+    binaryProtocol: talk to the ocaml solver and helmholtz binaries in msgpack
+    frames instead of json.
+    streamHits: with the ocaml and python solvers, workers send each hit as
+    soon as they find it rather than with the rest of their slice, and a job
+    is cancelled, freeing its CPUs, as soon as all of its tasks are solved.
+    observationalEquivalence: with the bottom solver, keep only the cheapest
+    subexpression for each behaviour on the inputs of the job's tasks."""
+
+    def __init__(self,
+                 persistentSolvers=False,
+                 binaryProtocol=False,
+                 streamHits=False,
+                 observationalEquivalence=False):
+        self.persistentSolvers = persistentSolvers
+        self.binaryProtocol = binaryProtocol
+        self.streamHits = streamHits
+        self.observationalEquivalence = observationalEquivalence
+
+    def replace(self, **changes):
+        """A copy of these options, with some of them changed"""
+        return SolverOptions(**dict(self.__dict__, **changes))
+
+    def __repr__(self):
+        return "SolverOptions(%s)" % ", ".join("%s=%r" % kv for kv in self.__dict__.items())
+
+
 def multicoreEnumeration(g, tasks, _=None,
                          enumerationTimeout=None,
                          solver='ocaml',
@@ -14,8 +45,10 @@ def multicoreEnumeration(g, tasks, _=None,
                          maximumFrontier=None,
                          verbose=True,
                          evaluationTimeout=None,
-                         testing=False):
+                         testing=False,
+                         solverOptions=None):
     '''g: Either a Grammar, or a map from task to grammar.
+    solverOptions: a SolverOptions, for how the solvers are run.
     Returns (list-of-frontiers, map-from-task-to-search-time)'''
 
     # We don't use actual threads but instead use the multiprocessing
@@ -23,9 +56,15 @@ def multicoreEnumeration(g, tasks, _=None,
     #from multiprocess import Process, Queue
 
     from multiprocessing import Queue
+    from queue import Empty
 
      # everything that gets sent between processes will be dilled
     import dill
+    import dreamcoder.task
+
+    # (hits, misses) of the evaluation cache, here and in the workers
+    cacheStatistics = dreamcoder.task.EVALUATIONTABLE.statistics()
+    workerCacheStatistics = [0, 0]
     
     solvers = {"ocaml": solveForTask_ocaml,
                "bottom": solveForTask_bottom,   
@@ -52,6 +91,61 @@ def multicoreEnumeration(g, tasks, _=None,
     solver_str = solver
     solver = solvers[solver]
 
+    if solverOptions is None: solverOptions = SolverOptions()
+    persistentSolvers = solverOptions.persistentSolvers
+    binaryProtocol = solverOptions.binaryProtocol
+    streamHits = solverOptions.streamHits
+    observationalEquivalence = solverOptions.observationalEquivalence
+
+    # What the solver binary that was built can do, when something beyond one-shot json is asked of it
+    capabilities = set()
+    if solver_str == "ocaml" and (binaryProtocol or streamHits or persistentSolvers):
+        capabilities = binaryCapabilities(os.path.join(get_root_dir(), 'solver'))
+
+    # extra keyword arguments for the solver
+    solverKeywords = {}
+    if binaryProtocol:
+        if solver_str != "ocaml":
+            eprint("The binary protocol is only supported by the ocaml solver; ignoring.")
+            binaryProtocol = False
+        elif not binaryProtocolAvailable():
+            eprint("The binary protocol needs the msgpack package; falling back to json.")
+            binaryProtocol = False
+        elif "msgpack" not in capabilities:
+            eprint("The solver binary does not support the binary protocol (rebuild it with make); falling back to json.")
+            binaryProtocol = False
+        else:
+            solverKeywords["binaryProtocol"] = True
+            # Intern before forking, so that the workers inherit the encoded examples
+            for t in tasks: internedExamples(t)
+
+    if streamHits:
+        if solver_str == "ocaml" and "stream" not in capabilities:
+            eprint("The solver binary does not support streaming hits (rebuild it with make); ignoring.")
+            streamHits = False
+        elif solver_str in {"ocaml", "python"}:
+            solverKeywords["reportHits"] = True
+        else:
+            eprint("Streaming hits is only supported by the ocaml and python solvers; ignoring.")
+            streamHits = False
+
+    if observationalEquivalence:
+        if solver_str == "bottom":
+            solverKeywords["observationalEquivalence"] = True
+        else:
+            eprint("Observational equivalence is only supported by the bottom solver; ignoring.")
+
+    workerPool = None
+    if persistentSolvers:
+        if solver_str == "ocaml" and "server" not in capabilities:
+            eprint("The solver binary does not support persistent solvers (rebuild it with make); ignoring.")
+        elif solver_str == "ocaml":
+            workerPool = SolverWorkerPool(evaluationTimeout=evaluationTimeout,
+                                          binaryProtocol=binaryProtocol,
+                                          streamHits=streamHits)
+        else:
+            eprint("Persistent solvers are only supported by the ocaml solver; ignoring.")
+
     # If we are not evaluating on held out testing tasks:
     # Bin the tasks by request type and grammar
     # If these are the same then we can enumerate for multiple tasks simultaneously
@@ -132,8 +226,63 @@ def multicoreEnumeration(g, tasks, _=None,
     id2CPUs = {}
     # What job was each ID working on?
     id2job = {}
+    # Which tasks, by name, was each ID working on?
+    id2tasks = {}
+    # The process or thread of each forked ID
+    id2worker = {}
+    # IDs that were cancelled before they finished
+    cancelled = set()
     nextID = 0
 
+    def recordFrontier(t, f, dt):
+        oldBest = None if len(
+            frontiers[t]) == 0 else frontiers[t].bestPosterior
+        frontiers[t] = frontiers[t].combine(f)
+        newBest = None if len(
+            frontiers[t]) == 0 else frontiers[t].bestPosterior
+
+        if dt is not None:
+            if bestSearchTime[t] is None:
+                bestSearchTime[t] = dt
+            else:
+                # newBest & oldBest should both be defined
+                assert oldBest is not None
+                assert newBest is not None
+                newScore = newBest.logPrior + newBest.logLikelihood
+                oldScore = oldBest.logPrior + oldBest.logLikelihood
+
+                if newScore > oldScore:
+                    bestSearchTime[t] = dt
+                elif newScore == oldScore:
+                    bestSearchTime[t] = min(bestSearchTime[t], dt)
+
+    def finish(ID):
+        """Mark the CPUs of ID as no longer being used and pause the stopwatch of its job"""
+        nonlocal activeCPUs
+        activeCPUs -= id2CPUs[ID]
+        stopwatches[id2job[ID]].stop()
+
+    def cancelSolvedJob(ID):
+        """Stops ID early if all of its tasks have enough hits, so that its CPUs go to other jobs.
+        Returns whether it did. If ID is running in this process, stopping it is up to the caller."""
+        if ID in cancelled: return False
+        if any(numberOfHits(frontiers[t]) < maximumFrontier for t in id2tasks[ID].values()): return False
+        eprint("(frontend) Cancelling %s: all of its %d tasks are solved." %
+               (id2job[ID][1], len(id2tasks[ID])))
+        if workerPool is not None: workerPool.cancel(id2job[ID])
+        elif id2worker.get(ID, None) is not None: id2worker[ID].terminate()
+        cancelled.add(ID)
+        finish(ID)
+        return True
+
+    def recordHitInProcess(ID):
+        """With a single job the solver runs in this process, not in a worker that can be terminated.
+        Its hits are recorded as soon as they come, and it is stopped once they solve the job."""
+        def reportHit(task, entry, searchTime):
+            recordFrontier(task, Frontier([entry], task=task), searchTime)
+            if cancelSolvedJob(ID): raise SolverCancelled()
+        return reportHit
+
     while True:
         refreshJobs()
         # Don't launch a job that we are already working on
@@ -157,24 +306,41 @@ def multicoreEnumeration(g, tasks, _=None,
                 eprint("(frontend) Launching %s (%d tasks) w/ %d CPUs. %f <= MDL < %f. Timeout %f." %
                        (request, len(jobs[j]), allocation[j], lowerBounds[j], lowerBounds[j] + bi, thisTimeout))
                 stopwatches[j].start()
-                parallelCallback(wrapInThread(solver),
-                                 q=q, g=g, ID=nextID,
-                                 elapsedTime=stopwatches[j].elapsed,
-                                 CPUs=allocation[j],
-                                 tasks=jobs[j],
-                                 lowerBound=lowerBounds[j],
-                                 upperBound=lowerBounds[j] + bi,
-                                 budgetIncrement=bi,
-                                 timeout=thisTimeout,
-                                 evaluationTimeout=evaluationTimeout,
-                                 maximumFrontiers=maximumFrontiers(j),
-                                 testing=testing,
-                                 likelihoodModel=likelihoodModel)
                 id2CPUs[nextID] = allocation[j]
                 id2job[nextID] = j
-                nextID += 1
-
+                id2tasks[nextID] = {t.name: t for t in jobs[j]}
                 activeCPUs += allocation[j]
+                if workerPool is not None:
+                    id2worker[nextID] = workerPool.launch(j, q=q, g=g, ID=nextID,
+                                      elapsedTime=stopwatches[j].elapsed,
+                                      CPUs=allocation[j],
+                                      tasks=jobs[j],
+                                      lowerBound=lowerBounds[j],
+                                      upperBound=lowerBounds[j] + bi,
+                                      budgetIncrement=bi,
+                                      timeout=thisTimeout,
+                                      maximumFrontiers=maximumFrontiers(j),
+                                      reportHits=streamHits)
+                else:
+                    options = solverKeywords
+                    if disableParallelism and solverKeywords.get("reportHits", False):
+                        options = dict(solverKeywords, reportHits=False, reportHit=recordHitInProcess(nextID))
+                    id2worker[nextID] = parallelCallback(wrapInThread(solver if disableParallelism
+                                                                      else cancellable(solver)),
+                                     q=q, g=g, ID=nextID,
+                                     elapsedTime=stopwatches[j].elapsed,
+                                     CPUs=allocation[j],
+                                     tasks=jobs[j],
+                                     lowerBound=lowerBounds[j],
+                                     upperBound=lowerBounds[j] + bi,
+                                     budgetIncrement=bi,
+                                     timeout=thisTimeout,
+                                     evaluationTimeout=evaluationTimeout,
+                                     maximumFrontiers=maximumFrontiers(j),
+                                     testing=testing,
+                                     likelihoodModel=likelihoodModel,
+                                     **options)
+                nextID += 1
                 lowerBounds[j] += bi
 
         # If nothing is running, and we just tried to launch jobs,
@@ -184,66 +350,110 @@ def multicoreEnumeration(g, tasks, _=None,
 
         # Wait to get a response
         message = Bunch(dill.loads(q.get()))
-
-        if message.result == "failure":
+        if getattr(message, "evaluations", None) is not None:
+            pid, counts = message.evaluations
+            if pid != os.getpid():
+                workerCacheStatistics = [total + n for total, n in zip(workerCacheStatistics, counts)]
+
+        if message.ID in cancelled and message.result in {"failure", "cancelled"}:
+            continue
+        elif message.result == "failure":
             eprint("PANIC! Exception in child worker:", message.exception)
             eprint(message.stacktrace)
+            if workerPool is not None: workerPool.close()
             assert False
+        elif message.result == "hit":
+            name, entry, dt = message.value
+            t = id2tasks[message.ID][name]
+            recordFrontier(t, Frontier([entry], task=t), dt)
+            cancelSolvedJob(message.ID)
         elif message.result == "success":
-            # Mark the CPUs is no longer being used and pause the stopwatch
-            activeCPUs -= id2CPUs[message.ID]
-            stopwatches[id2job[message.ID]].stop()
+            # A cancelled ID already gave back its CPUs, but what it found still counts
+            if message.ID not in cancelled: finish(message.ID)
 
             newFrontiers, searchTimes, pc = message.value
             for t, f in newFrontiers.items():
-                oldBest = None if len(
-                    frontiers[t]) == 0 else frontiers[t].bestPosterior
-                frontiers[t] = frontiers[t].combine(f)
-                newBest = None if len(
-                    frontiers[t]) == 0 else frontiers[t].bestPosterior
-
                 taskToNumberOfPrograms[t] += pc
-
-                dt = searchTimes[t]
-                if dt is not None:
-                    if bestSearchTime[t] is None:
-                        bestSearchTime[t] = dt
-                    else:
-                        # newBest & oldBest should both be defined
-                        assert oldBest is not None
-                        assert newBest is not None
-                        newScore = newBest.logPrior + newBest.logLikelihood
-                        oldScore = oldBest.logPrior + oldBest.logLikelihood
-
-                        if newScore > oldScore:
-                            bestSearchTime[t] = dt
-                        elif newScore == oldScore:
-                            bestSearchTime[t] = min(bestSearchTime[t], dt)
+                recordFrontier(t, f, searchTimes[t])
         else:
             eprint("Unknown message result:", message.result)
             assert False
 
+    if workerPool is not None: workerPool.close()
+
+    # Cancelled workers cannot exit until their last messages are out of the queue
+    while any(id2worker[ID] is not None and id2worker[ID].is_alive() for ID in cancelled):
+        try: q.get(timeout=0.1)
+        except Empty: pass
+
     eprint("We enumerated this many programs, for each task:\n\t",
            list(taskToNumberOfPrograms.values()))
+    hits, misses = [now - before + elsewhere
+                    for now, before, elsewhere in zip(dreamcoder.task.EVALUATIONTABLE.statistics(),
+                                                      cacheStatistics, workerCacheStatistics)]
+    if hits + misses > 0:
+        eprint("Evaluation cache: %d hits, %d misses (%.1f%% hit rate)" %
+               (hits, misses, 100.*hits/(hits + misses)))
 
     return [frontiers[t] for t in tasks], bestSearchTime
 
+class SolverCancelled(Exception):
+    pass
+
+def cancellable(f):
+    """
+    For a forked worker: while f runs, SIGTERM raises SolverCancelled in it,
+    so that the worker can clean up and exit when its job is cancelled.
+    """
+    def _f(*a, **k):
+        import signal
+
+        def cancel(signalNumber, frame): raise SolverCancelled()
+        signal.signal(signal.SIGTERM, cancel)
+        try:
+            return f(*a, **k)
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    return _f
+
 def wrapInThread(f):
     """
     Returns a function that is designed to be run in a thread/threadlike process.
     Result will be either put into the q
+    With reportHits, f also gets a reportHit(task, entry, searchTime) callback
+    which puts each hit into the q as soon as it is found.
+    The result also says how often f hit and missed the evaluation cache, and in
+    which process, since a forked worker's counts are not seen by its parent.
     """
     import dill
+    import dreamcoder.task
 
     def _f(*a, **k):
         q = k.pop("q")
         ID = k.pop("ID")
+        before = dreamcoder.task.EVALUATIONTABLE.statistics()
+
+        def evaluations():
+            return os.getpid(), [now - then for now, then in zip(dreamcoder.task.EVALUATIONTABLE.statistics(),
+                                                                 before)]
+
+        if k.pop("reportHits", False):
+            def reportHit(task, entry, searchTime):
+                q.put(dill.dumps({"result": "hit",
+                       "ID": ID,
+                       "value": (task.name, entry, searchTime)}))
+            k["reportHit"] = reportHit
 
         try:
             r = f(*a, **k)
             q.put(dill.dumps({"result": "success",
                    "ID": ID,
-                   "value": r}))
+                   "value": r,
+                   "evaluations": evaluations()}))
+        except SolverCancelled:
+            q.put(dill.dumps({"result": "cancelled",
+                   "ID": ID,
+                   "evaluations": evaluations()}))
         except Exception as e:
             q.put(dill.dumps({"result": "failure",
                    "exception": e,
@@ -261,13 +471,84 @@ def solveForTask_ocaml(_=None,
                        timeout=None,
                        testing=None, # FIXME: unused
                        likelihoodModel=None,
-                       evaluationTimeout=None, maximumFrontiers=None):
+                       evaluationTimeout=None, maximumFrontiers=None,
+                       binaryProtocol=False,
+                       reportHit=None):
 
     import json
 
+    message = solverMessage(g, tasks, maximumFrontiers,
+                            evaluationTimeout=evaluationTimeout,
+                            binaryProtocol=binaryProtocol)
+    message.update({"nc": CPUs,
+                    "timeout": timeout,
+                    "lowerBound": lowerBound,
+                    "upperBound": upperBound,
+                    "budgetIncrement": budgetIncrement})
+    if binaryProtocol:
+        message = frameMessage(message)
+    else:
+        message = bytes(json.dumps(message), encoding="utf-8")
+    # uncomment this if you want to save the messages being sent to the solver
+    
+
+    try:
+        solver_file = os.path.join(get_root_dir(), 'solver')
+        flags = (["--msgpack"] if binaryProtocol else []) + (["--stream"] if reportHit else [])
+        process = subprocess.Popen([solver_file] + flags if flags else solver_file,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        if reportHit is not None:
+            # Hits come first, one per line or frame, and then the response
+            process.stdin.write(message)
+            process.stdin.close()
+            try:
+                response, scored = receiveSolverResponse(lambda: receiveSolverMessage(process.stdout, binaryProtocol),
+                                                         g, tasks, reportHit, elapsedTime=elapsedTime)
+            except SolverCancelled:
+                process.kill()
+                raise
+            process.wait()
+        else:
+            scored = {}
+            response, error = process.communicate(message)
+            if binaryProtocol:
+                response = unframeMessage(response)
+            else:
+                response = json.loads(response.decode("utf-8"))
+    except (OSError, SolverCancelled) as exc:
+        raise exc
+
+    except:
+        eprint("response:", response)
+        eprint("error:", error)
+        with open("message", "wb") as f:
+            f.write(message)
+        eprint("message,", message)
+        assert False, "MAX RAISE"
+
+    return frontiersOfSolverResponse(g, tasks, response, elapsedTime=elapsedTime, scored=scored)
+
+# Task examples, msgpack-encoded once per run: task id -> Prepacked
+INTERNEDEXAMPLES = {}
+
+def internedExamples(task):
+    import weakref
+    key = id(task)
+    if key not in INTERNEDEXAMPLES:
+        INTERNEDEXAMPLES[key] = Prepacked([{"inputs": list(xs), "output": y}
+                                           for xs, y in task.examples])
+        weakref.finalize(task, INTERNEDEXAMPLES.pop, key, None)
+    return INTERNEDEXAMPLES[key]
+
+def solverMessage(g, tasks, maximumFrontiers, evaluationTimeout=None, binaryProtocol=False):
+    """The part of a solver message that describes the DSL and the tasks.
+    Bounds, timeout and CPU count are added by the caller.
+    With binaryProtocol the examples are interned, and the message can only be sent with frameMessage."""
     def taskMessage(t):
         m = {
-            "examples": [{"inputs": list(xs), "output": y} for xs, y in t.examples],
+            "examples": internedExamples(t) if binaryProtocol else \
+                        [{"inputs": list(xs), "output": y} for xs, y in t.examples],
             "name": t.name,
             "request": t.request.json(),
             "maximumFrontier": maximumFrontiers[t]}
@@ -282,11 +563,6 @@ def solveForTask_ocaml(_=None,
                "tasks": [taskMessage(t)
                          for t in tasks],
                "programTimeout": evaluationTimeout,
-               "nc": CPUs,
-               "timeout": timeout,
-               "lowerBound": lowerBound,
-               "upperBound": upperBound,
-               "budgetIncrement": budgetIncrement,
                "verbose": False,
                "shatter": 5 if len(tasks) == 1 and "turtle" in str(tasks[0].request) else 10}
     
@@ -296,44 +572,61 @@ def solveForTask_ocaml(_=None,
     if hasattr(tasks[0], 'maxParameters') and tasks[0].maxParameters is not None:
         message["maxParameters"] = tasks[0].maxParameters
 
-    message = json.dumps(message)
-    # uncomment this if you want to save the messages being sent to the solver
-    
-
-    try:
-        solver_file = os.path.join(get_root_dir(), 'solver')
-        process = subprocess.Popen(solver_file,
-                                   stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE)
-        response, error = process.communicate(bytes(message, encoding="utf-8"))
-        response = json.loads(response.decode("utf-8"))
-    except OSError as exc:
-        raise exc
-
-    except:
-        eprint("response:", response)
-        eprint("error:", error)
-        with open("message", "w") as f:
-            f.write(message)
-        eprint("message,", message)
-        assert False, "MAX RAISE"
-
+    return message
 
+def receiveSolverMessage(stream, binaryProtocol=False):
+    """One line of json, or one frame, from a solver's stdout. None at end of file."""
+    import json
+    if binaryProtocol: return readFrame(stream)
+    line = stream.readline()
+    return json.loads(line.decode("utf-8")) if line else None
+
+def receiveSolverResponse(receive, g, tasks, reportHit, elapsedTime=0.):
+    """Reads messages with receive() until the response of a solver run with
+    --stream, which comes after every hit is sent on its own as
+    {task, program, time, logLikelihood, logPrior}. Hits go to reportHit.
+    Returns the response, and {(task name, program): (program, log prior)}
+    for the hits, so that frontiersOfSolverResponse does not score them again."""
+    names = {t.name: t for t in tasks}
+    scored = {}
+    while True:
+        message = receive()
+        assert message is not None, "solver exited before sending its response"
+        if "number_enumerated" in message: return message, scored
+        t = names[message["task"]]
+        p = Program.parse(message["program"])
+        l = g.logLikelihood(t.request, p)
+        scored[(t.name, message["program"])] = (p, l)
+        reportHit(t, FrontierEntry(program=p,
+                                   logLikelihood=message["logLikelihood"],
+                                   logPrior=l),
+                  message["time"] + elapsedTime)
+
+def frontiersOfSolverResponse(g, tasks, response, elapsedTime=0., scored={}):
+    """Turns the solver's json response into (frontiers, searchTimes, number of programs)
+    scored: programs that have already been parsed and scored, as returned by receiveSolverResponse"""
     pc = response.get("number_enumerated",0)  # TODO
     frontiers = {}
     searchTimes = {}
     for t in tasks:
         solutions = response[t.name]
-        for e in solutions:
-            p=Program.parse(e["program"])
-            try: g.logLikelihood(t.request, p)
-            except:
-                eprint(t, p, "TYPING ERROR")
+        programs = [scored[(t.name, e["program"])][0] if (t.name, e["program"]) in scored
+                    else Program.parse(e["program"])
+                    for e in solutions]
+        unscored = [p for e, p in zip(solutions, programs) if (t.name, e["program"]) not in scored]
+        try: newPriors = iter(g.logLikelihoods([(t.request, p) for p in unscored]).tolist())
+        except:
+            for p in unscored:
+                try: g.logLikelihood(t.request, p)
+                except: eprint(t, p, "TYPING ERROR")
+            raise
+        logPriors = [scored[(t.name, e["program"])][1] if (t.name, e["program"]) in scored
+                     else next(newPriors)
+                     for e in solutions]
         frontier = Frontier([FrontierEntry(program=p,
                                            logLikelihood=e["logLikelihood"],
-                                           logPrior=g.logLikelihood(t.request, p))
-                             for e in solutions
-                             for p in [Program.parse(e["program"])]],
+                                           logPrior=l)
+                             for e, p, l in zip(solutions, programs, logPriors)],
                             task=t)
         frontiers[t] = frontier
         if frontier.empty:
@@ -351,6 +644,103 @@ def solveForTask_ocaml(_=None,
 
     return frontiers, searchTimes, pc
 
+
+class SolverWorker(object):
+    """A long-lived `solver --server` process dedicated to one job.
+    The DSL and the tasks are sent once, when the worker starts.
+    Each budget slice afterwards is a one-line message with the bounds,
+    the timeout and the tasks that are still being searched for.
+    With streamHits the solver sends each hit ahead of the slice's response."""
+
+    def __init__(self, g, tasks, maximumFrontiers, evaluationTimeout=None,
+                 binaryProtocol=False, streamHits=False):
+        self.g = g
+        self.binaryProtocol = binaryProtocol
+        solver_file = os.path.join(get_root_dir(), 'solver')
+        self.process = subprocess.Popen([solver_file, "--server"] + (["--msgpack"] if binaryProtocol else []) +
+                                        (["--stream"] if streamHits else []),
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.send(solverMessage(g, tasks, maximumFrontiers,
+                                evaluationTimeout=evaluationTimeout,
+                                binaryProtocol=binaryProtocol))
+
+    def send(self, message):
+        import json
+        if self.binaryProtocol:
+            self.process.stdin.write(frameMessage(message))
+        else:
+            self.process.stdin.write(bytes(json.dumps(message) + "\n", encoding="utf-8"))
+        self.process.stdin.flush()
+
+    def receive(self):
+        response = receiveSolverMessage(self.process.stdout, self.binaryProtocol)
+        assert response is not None, "solver worker exited with code %s" % self.process.poll()
+        return response
+
+    def extend(self, _=None,
+               elapsedTime=0.,
+               CPUs=1,
+               tasks=None,
+               lowerBound=None, upperBound=None, budgetIncrement=None,
+               timeout=None, maximumFrontiers=None, reportHit=None):
+        """Enumerates lowerBound <= MDL < upperBound. Same return value as solveForTask_ocaml."""
+        self.send({"nc": CPUs,
+                   "timeout": timeout,
+                   "lowerBound": lowerBound,
+                   "upperBound": upperBound,
+                   "budgetIncrement": budgetIncrement,
+                   "tasks": {t.name: maximumFrontiers[t] for t in tasks}})
+        if reportHit is None: response, scored = self.receive(), {}
+        else: response, scored = receiveSolverResponse(self.receive, self.g, tasks, reportHit,
+                                                       elapsedTime=elapsedTime)
+        return frontiersOfSolverResponse(self.g, tasks, response, elapsedTime=elapsedTime, scored=scored)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+
+
+class SolverWorkerPool(object):
+    """Keeps one SolverWorker per job for the whole of a multicoreEnumeration call.
+    Slices are served from threads, which put their results on the same queue as forked workers."""
+
+    def __init__(self, evaluationTimeout=None, binaryProtocol=False, streamHits=False):
+        self.evaluationTimeout = evaluationTimeout
+        self.binaryProtocol = binaryProtocol
+        self.streamHits = streamHits
+        self.workers = {}
+
+    def launch(self, job, q=None, ID=None, g=None, tasks=None, maximumFrontiers=None, **keywords):
+        import threading
+
+        if job not in self.workers:
+            self.workers[job] = SolverWorker(g, tasks, maximumFrontiers,
+                                             evaluationTimeout=self.evaluationTimeout,
+                                             binaryProtocol=self.binaryProtocol,
+                                             streamHits=self.streamHits)
+        worker = self.workers[job]
+        thread = threading.Thread(target=wrapInThread(worker.extend),
+                                  kwargs=dict(q=q, ID=ID, tasks=tasks,
+                                              maximumFrontiers=maximumFrontiers,
+                                              **keywords))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def cancel(self, job):
+        """Kills the worker of job in the middle of its slice; the thread serving it reports a failure"""
+        worker = self.workers.pop(job, None)
+        if worker is not None: worker.process.kill()
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.close()
+        self.workers = {}
+
 def solveForTask_pypy(_=None,
                       elapsedTime=0.,
                       g=None, task=None,
@@ -375,7 +765,8 @@ def solveForTask_python(_=None,
                         timeout=None,
                         CPUs=1,
                         likelihoodModel=None,
-                        evaluationTimeout=None, maximumFrontiers=None, testing=False):
+                        evaluationTimeout=None, maximumFrontiers=None, testing=False,
+                        reportHit=None):
     return enumerateForTasks(g, tasks, likelihoodModel,
                              timeout=timeout,
                              testing=testing,
@@ -383,7 +774,8 @@ def solveForTask_python(_=None,
                              evaluationTimeout=evaluationTimeout,
                              maximumFrontiers=maximumFrontiers,
                              budgetIncrement=budgetIncrement,
-                             lowerBound=lowerBound, upperBound=upperBound)
+                             lowerBound=lowerBound, upperBound=upperBound,
+                             reportHit=reportHit)
 
 def solveForTask_bottom(_=None,
                         elapsedTime=0.,
@@ -393,6 +785,7 @@ def solveForTask_bottom(_=None,
                         CPUs=1,
                         likelihoodModel=None,
                         evaluationTimeout=None, maximumFrontiers=None, testing=False,
+                        observationalEquivalence=False,
                         compile_me=True):
     if compile_me:
         return callCompiled(solveForTask_bottom,
@@ -404,6 +797,7 @@ def solveForTask_bottom(_=None,
                             likelihoodModel=None,
                             evaluationTimeout=evaluationTimeout,
                             maximumFrontiers=maximumFrontiers, testing=testing,
+                            observationalEquivalence=observationalEquivalence,
                             compile_me=False,
                             #profile="tower_profile"
         )
@@ -428,7 +822,9 @@ def solveForTask_bottom(_=None,
     splits = pcfg.split(CPUs)
 
     results = parallelMap(CPUs, 
-                          lambda pps: bottom_up_parallel_worker(g, pcfg, pps, tasks, timeout, maximumFrontiers, evaluationTimeout=evaluationTimeout),
+                          lambda pps: bottom_up_parallel_worker(g, pcfg, pps, tasks, timeout, maximumFrontiers,
+                                                                evaluationTimeout=evaluationTimeout,
+                                                                observationalEquivalence=observationalEquivalence),
                           splits)
     number_of_programs = sum(np for _, np in results )
     eprint("Enumerated", number_of_programs, "programs")
@@ -448,10 +844,16 @@ def solveForTask_bottom(_=None,
 
 
 def bottom_up_parallel_worker(g, pcfg, pps, tasks, timeout, maximumFrontiers,
-                              evaluationTimeout=None):
+                              evaluationTimeout=None, observationalEquivalence=False):
     from time import time
     
     maximumFrontiers = [maximumFrontiers[t] for t in tasks]
+
+    # Subexpressions that behave the same on every input of every task are
+    # interchangeable for all of the tasks
+    inputs = None
+    if observationalEquivalence:
+        inputs = list({repr(x): x for t in tasks for x, _ in t.examples}.values())
     # store all of the hits in a priority queue
     # we will never maintain maximumFrontier best solutions
     hits = [PQ() for _ in tasks]
@@ -460,7 +862,8 @@ def bottom_up_parallel_worker(g, pcfg, pps, tasks, timeout, maximumFrontiers,
 
     totalNumberOfPrograms=0
 
-    for e in pcfg.quantized_enumeration(skeletons=pps):
+    for e in pcfg.quantized_enumeration(skeletons=pps, inputs=inputs,
+                                        evaluationTimeout=evaluationTimeout):
         totalNumberOfPrograms+=1
         
         if time()-starting>timeout:
@@ -512,6 +915,133 @@ def bottom_up_parallel_worker(g, pcfg, pps, tasks, timeout, maximumFrontiers,
 
     return frontiers, totalNumberOfPrograms
 
+class IncrementalEnumerator(object):
+    """Iterative deepening enumeration that does not restart from the root.
+    Each call to enumerate(upperBound) yields the programs with
+    previousUpperBound <= MDL < upperBound, exactly as
+    g.enumeration(..., lowerBound=previousUpperBound, upperBound=upperBound) would.
+
+    A partial program is (cost, context, work, values), where work and values
+    are linked lists of pairs. Work items are holes still to be filled,
+    ABSTRACT (wrap the last value in a lambda) or (APPLY, f, n) (apply f to the last n values).
+    When a hole is expanded its candidates are sorted by cost; if some are too
+    expensive for the current window, the partial program is parked with the
+    position of the first of them, and resumed by the first window that can
+    afford it. Candidates are rebuilt on resumption rather than kept around:
+    holding on to them costs more in memory and garbage collection than
+    recomputing them does."""
+
+    HOLE, ABSTRACT, APPLY = 0, 1, 2
+
+    def __init__(self, g, request, lowerBound=0., maximumDepth=20):
+        self.g = g
+        self.contextual = isinstance(g, ContextualGrammar)
+        self.lowerBound = lowerBound
+        # heap of (cost of cheapest remaining candidate, counter, partial program, candidate index)
+        self.deferred = []
+        # tie breaker so that the heap never compares partial programs
+        self.counter = 0
+        hole = (self.HOLE, request, [], maximumDepth, None, None, False)
+        self.initial = (0., emptyContext(), (hole, None), None)
+
+    def grammarOfHole(self, parent, parentIndex):
+        if not self.contextual: return self.g
+        if parent is None: return self.g.noParent
+        if parent.isIndex: return self.g.variableParent
+        return self.g.library[parent][parentIndex]
+
+    def candidates(self, context, hole):
+        """Candidates for filling hole, cheapest first. Returns (request, candidates)."""
+        _, request, environment, depth, parent, parentIndex, isArgument = hole
+        if isArgument: request = request.apply(context)
+        if request.isArrow(): return request, None
+        try:
+            candidates = self.grammarOfHole(parent, parentIndex).buildCandidates(request, context, environment,
+                                                                                 normalize=True)
+        except NoCandidates:
+            return request, []
+        # The symmetry rules only look at the head of the argument,
+        # so they can be applied as soon as the head is chosen
+        if isArgument:
+            candidates = [c for c in candidates if not violatesSymmetry(parent, c[2], parentIndex)]
+        candidates.sort(key=lambda c: -c[0])
+        return request, candidates
+
+    def expand(self, stack, upperBound, partial, candidates, index):
+        """Pushes the children of the hole at the front of partial,
+        starting from candidate number index, while they fit under upperBound"""
+        import heapq
+
+        cost, _, work, values = partial
+        (_, _, environment, depth, _, _, _), work = work
+        while index < len(candidates):
+            l, t, p, newContext = candidates[index]
+            newCost = cost - l
+            if not (newCost < upperBound):
+                self.counter += 1
+                heapq.heappush(self.deferred, (newCost, self.counter, partial, index))
+                return
+            xs = t.functionArguments()
+            newWork = ((self.APPLY, p, len(xs)), work)
+            for i in reversed(range(len(xs))):
+                newWork = ((self.HOLE, xs[i], environment, depth - 1, p, i, True), newWork)
+            stack.append((newCost, newContext, newWork, values))
+            index += 1
+
+    def enumerate(self, upperBound):
+        import heapq
+
+        stack = []
+        if self.initial is not None:
+            stack.append(self.initial)
+            self.initial = None
+        while self.deferred and self.deferred[0][0] < upperBound:
+            _, _, partial, index = heapq.heappop(self.deferred)
+            _, context, (hole, _), _ = partial
+            self.expand(stack, upperBound, partial, self.candidates(context, hole)[1], index)
+
+        while stack:
+            cost, context, work, values = stack.pop()
+            # Run the bookkeeping items until we hit a hole
+            while work is not None and work[0][0] != self.HOLE:
+                item, work = work
+                if item[0] == self.ABSTRACT:
+                    body, values = values
+                    values = (Abstraction(body), values)
+                else:
+                    _, f, n = item
+                    arguments = []
+                    for _ in range(n):
+                        x, values = values
+                        arguments.append(x)
+                    for x in reversed(arguments): f = Application(f, x)
+                    values = (f, values)
+
+            if work is None:
+                if cost >= self.lowerBound:
+                    yield -cost, context, values[0]
+                continue
+
+            hole, rest = work
+            _, _, environment, depth, parent, parentIndex, _ = hole
+            if depth == 1: continue
+            request, candidates = self.candidates(context, hole)
+
+            if candidates is None:
+                body = (self.HOLE, request.arguments[1], [request.arguments[0]] + environment,
+                        depth, parent, parentIndex, False)
+                stack.append((cost, context, (body, ((self.ABSTRACT,), rest)), values))
+                continue
+
+            # An application at depth 1 enumerates nothing, not even leaves
+            if depth - 1 == 1: continue
+            self.expand(stack, upperBound, (cost, context, work, values), candidates, 0)
+
+    @property
+    def exhausted(self):
+        return self.initial is None and len(self.deferred) == 0
+
+
 class EnumerationTimeout(Exception):
     pass
 
@@ -524,7 +1054,10 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                       evaluationTimeout=None,
                       lowerBound=0.,
                       upperBound=100.,
-                      budgetIncrement=1.0, maximumFrontiers=None):
+                      budgetIncrement=1.0, maximumFrontiers=None,
+                      reportHit=None):
+    """reportHit: called with (task, entry, search time) on each hit that
+    makes it into a frontier, as soon as it is found"""
     assert timeout is not None, \
         "enumerateForTasks: You must provide a timeout."
 
@@ -542,17 +1075,16 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
     starting = time()
     previousBudget = lowerBound
     budget = lowerBound + budgetIncrement
+    # Keeps the partial programs from one budget window to the next
+    enumerator = IncrementalEnumerator(g, request, lowerBound=lowerBound, maximumDepth=99)
     try:
         totalNumberOfPrograms = 0
         while time() < starting + timeout and \
                 any(len(h) < mf for h, mf in zip(hits, maximumFrontiers)) and \
-                budget <= upperBound:
+                budget <= upperBound and not enumerator.exhausted:
             numberOfPrograms = 0
 
-            for prior, _, p in g.enumeration(Context.EMPTY, [], request,
-                                             maximumDepth=99,
-                                             upperBound=budget,
-                                             lowerBound=previousBudget):
+            for prior, _, p in enumerator.enumerate(budget):
                 descriptionLength = -prior
                 # Shouldn't see it on this iteration
                 assert descriptionLength <= budget
@@ -575,12 +1107,14 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                         
                     dt = time() - starting + elapsedTime
                     priority = -(likelihood + prior)
-                    hits[n].push(priority,
-                                 (dt, FrontierEntry(program=p,
-                                                    logLikelihood=likelihood,
-                                                    logPrior=prior)))
-                    if len(hits[n]) > maximumFrontiers[n]:
-                        hits[n].popMaximum()
+                    entry = FrontierEntry(program=p,
+                                          logLikelihood=likelihood,
+                                          logPrior=prior)
+                    hits[n].push(priority, (dt, entry))
+                    if len(hits[n]) > maximumFrontiers[n] and \
+                       hits[n].popMaximum()[1] is entry:
+                        continue
+                    if reportHit is not None: reportHit(task, entry, dt)
 
                 if timeout is not None and time() - starting > timeout:
                     raise EnumerationTimeout
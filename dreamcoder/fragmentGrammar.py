@@ -56,7 +56,7 @@ class FragmentGrammar(object):
         return [(l - z, c, t, p) for l, c, t, p in candidates]
 
     def logLikelihood(self, request, expression):
-        _, l, _ = self._logLikelihood(Context.EMPTY, [], request, expression)
+        _, l, _ = self._logLikelihood(emptyContext(), [], request, expression)
         if invalid(l):
             f = 'failures/likelihoodFailure%s.pickle' % (time() + getPID())
             eprint("PANIC: Invalid log likelihood. expression:",
@@ -67,7 +67,7 @@ class FragmentGrammar(object):
         return l
 
     def closedUses(self, request, expression):
-        _, l, u = self._logLikelihood(Context.EMPTY, [], request, expression)
+        _, l, u = self._logLikelihood(emptyContext(), [], request, expression)
         return l, u
 
     def _logLikelihood(self, context, environment, request, expression):
@@ -291,7 +291,10 @@ class FragmentGrammar(object):
             aic=1.0,
             structurePenalty=0.001,
             a=0,
+            emTolerance=None,
             CPUs=1):
+        """emTolerance: if given, the final production weights are fit by EM
+        until they move by less than it"""
         _ = topk_use_only_likelihood # not used in python compressor
         originalFrontiers = frontiers
         frontiers = [frontier for frontier in frontiers if not frontier.empty]
@@ -385,8 +388,14 @@ class FragmentGrammar(object):
         elif True:
             # Reestimate the parameters using the best programs
             restrictedFrontiers = restrictFrontiers()
-            bestGrammar = bestGrammar.makeUniform().insideOutside(
-                restrictedFrontiers, pseudoCounts)
+            if emTolerance is None:
+                bestGrammar = bestGrammar.makeUniform().insideOutside(
+                    restrictedFrontiers, pseudoCounts)
+            else:
+                # every fragment has been made concrete by now
+                bestGrammar = FragmentGrammar.fromGrammar(
+                    bestGrammar.toGrammar().insideOutside(restrictedFrontiers, pseudoCounts,
+                                                          tolerance=emTolerance))
         else:
             # Use parameters that were found during search
             pass
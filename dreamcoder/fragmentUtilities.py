@@ -228,7 +228,7 @@ class RewriteFragments(object):
     def tryRewrite(self, e, numberOfArguments):
         try:
             context, t, bindings = Matcher.match(
-                Context.EMPTY, self.fragment, e, numberOfArguments)
+                emptyContext(), self.fragment, e, numberOfArguments)
         except MatchFailure:
             return None
 
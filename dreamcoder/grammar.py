@@ -1,5 +1,5 @@
 from frozendict import frozendict
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from dreamcoder.frontier import *
 from dreamcoder.program import *
@@ -21,6 +21,12 @@ class NoCandidates(Exception):
 
 
 class Grammar(object):
+    # How many (request, environment) entries buildCandidates remembers, per grammar
+    CANDIDATECACHESIZE = 10000
+
+    # Every assignment to productions draws a fresh version from here
+    PRODUCTIONSVERSIONS = itertools.count()
+
     def __init__(self, logVariable, productions, continuationType=None):
         self.logVariable = logVariable
         self.productions = productions
@@ -30,6 +36,32 @@ class Grammar(object):
         self.expression2likelihood = dict((p, l) for l, _, p in productions)
         self.expression2likelihood[Index(0)] = self.logVariable
 
+        self.clearCandidateCache()
+
+    @property
+    def productions(self): return self._productions
+
+    @productions.setter
+    def productions(self, productions):
+        """Caches built from the productions are keyed on productionsVersion.
+        Modifying the list in place does not bump it: assign a new list instead."""
+        self._productions = productions
+        self.productionsVersion = next(Grammar.PRODUCTIONSVERSIONS)
+
+    def clearCandidateCache(self):
+        self._candidateCache = OrderedDict()
+        self._candidateCacheVersion = (self.logVariable, self.productionsVersion)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["productions"] = state.pop("_productions")
+        state.pop("productionsVersion", None)
+        state.pop("_candidateCache", None)
+        state.pop("_candidateCacheVersion", None)
+        state.pop("_summaryStructure", None)
+        state.pop("_summaryStructureVersion", None)
+        return state
+
     def randomWeights(self, r):
         """returns a new grammar with random weights drawn from r. calls `r` w/ old weight"""
         return Grammar(logVariable=r(self.logVariable),
@@ -146,6 +178,73 @@ class Grammar(object):
         if returnProbabilities:
             assert normalize
 
+        entry = self._candidateCacheEntry(request, context, environment, mustBeLeaf)
+        if entry is not None:
+            candidates = entry[2 if returnProbabilities else 1 if normalize else 0]
+            if candidates == []:
+                raise NoCandidates()
+            n = context.nextVariable
+            candidates = [(l, t.shiftVariables(n), p,
+                           context.extendMany(k + n, [(v + n, b.shiftVariables(n))
+                                                      for v, b in delta]))
+                          for l, t, p, k, delta in candidates]
+        else:
+            candidates = self._buildCandidates(request, context, environment, mustBeLeaf)
+            if normalize:
+                z = lse([l for l, t, p, k in candidates])
+                if returnProbabilities:
+                    candidates = [(exp(l - z), t, p, k)
+                                  for l, t, p, k in candidates]
+                else:
+                    candidates = [(l - z, t, p, k) for l, t, p, k in candidates]
+
+        if returnTable:
+            return {p: (l, t, k) for l, t, p, k in candidates}
+        else:
+            return candidates
+
+    def _candidateCacheEntry(self, request, context, environment, mustBeLeaf):
+        """When the request and the environment are monomorphic, the candidates
+        only depend on the context through nextVariable: fresh type variables are
+        numbered from it, and unification can only bind those fresh variables.
+        So they are built once against an empty substitution whose fresh
+        variables start at 0, and callers shift those variables up by their
+        nextVariable and write the bindings on top of their context.
+        Returns (unnormalized, normalized, probabilities), each a list of
+        (weight, type, expression, nextVariable, new bindings),
+        or None when type variables are in play and the context matters."""
+        if request.isPolymorphic: return None
+        environment = tuple(t.apply(context) for t in environment)
+        if any(t.isPolymorphic for t in environment): return None
+
+        if self._candidateCacheVersion != (self.logVariable, self.productionsVersion):
+            self.clearCandidateCache()
+        key = (request, environment, mustBeLeaf)
+        entry = self._candidateCache.get(key, None)
+        if entry is not None:
+            self._candidateCache.move_to_end(key)
+            return entry
+
+        try:
+            candidates = [(l, t, p, k.nextVariable, k.substitution)
+                          for l, t, p, k in self._buildCandidates(request,
+                                                                  type(context)(0),
+                                                                  list(environment),
+                                                                  mustBeLeaf)]
+            z = lse([l for l, t, p, k, delta in candidates])
+            entry = (candidates,
+                     [(l - z, t, p, k, delta) for l, t, p, k, delta in candidates],
+                     [(exp(l - z), t, p, k, delta) for l, t, p, k, delta in candidates])
+        except NoCandidates:
+            entry = ([], [], [])
+
+        self._candidateCache[key] = entry
+        if len(self._candidateCache) > self.CANDIDATECACHESIZE:
+            self._candidateCache.popitem(last=False)
+        return entry
+
+    def _buildCandidates(self, request, context, environment, mustBeLeaf):
+        """Unnormalized candidates, computed from scratch"""
         candidates = []
         variableCandidates = []
         for l, t, p in self.productions:
@@ -179,24 +278,7 @@ class Grammar(object):
                        for t, p, k in variableCandidates]
         if candidates == []:
             raise NoCandidates()
-        #eprint("candidates inside buildCandidates before norm:")
-        #eprint(candidates)
-
-        if normalize:
-            z = lse([l for l, t, p, k in candidates])
-            if returnProbabilities:
-                candidates = [(exp(l - z), t, p, k)
-                              for l, t, p, k in candidates]
-            else:
-                candidates = [(l - z, t, p, k) for l, t, p, k in candidates]
-
-        #eprint("candidates inside buildCandidates after norm:")
-        #eprint(candidates)
-
-        if returnTable:
-            return {p: (l, t, k) for l, t, p, k in candidates}
-        else:
-            return candidates
+        return candidates
 
 
     def sample(self, request, maximumDepth=6, maxAttempts=None):
@@ -205,7 +287,7 @@ class Grammar(object):
         while True:
             try:
                 _, e = self._sample(
-                    request, Context.EMPTY, [], maximumDepth=maximumDepth)
+                    request, emptyContext(), [], maximumDepth=maximumDepth)
                 return e
             except NoCandidates:
                 if maxAttempts is not None:
@@ -328,7 +410,7 @@ class Grammar(object):
 
             assert k is not None
             if context is None:
-                context = Context.EMPTY
+                context = emptyContext()
 
             if request.isArrow():
                 g(parentCost,
@@ -372,7 +454,7 @@ class Grammar(object):
         def receiveResult(MDL, _, expression):
             heappush(pq, (MDL, expression))
 
-        g(0., request, context=Context.EMPTY, environment=[], k=receiveResult)
+        g(0., request, context=emptyContext(), environment=[], k=receiveResult)
         frontier = []
         while len(frontier) < 10**3:
             MDL, action = heappop(pq)
@@ -383,9 +465,24 @@ class Grammar(object):
             else:
                 action()
 
+    def _likelihoodSummaryTable(self):
+        # Only the structure is cached: the store may have evicted the table
+        if getattr(self, "_summaryStructureVersion", None) != self.productionsVersion:
+            self._summaryStructure = LikelihoodSummaryStore.structure(self)
+            self._summaryStructureVersion = self.productionsVersion
+        return LIKELIHOODSUMMARIES.tableForStructure(self._summaryStructure)
+
     def closedLikelihoodSummary(self, request, expression, silent=False):
+        """Summaries are shared through LIKELIHOODSUMMARIES by every grammar
+        with the same productions, so callers must not modify them"""
+        table = self._likelihoodSummaryTable()
+        summary = table.get((request, expression), None)
+        if summary is not None:
+            table.move_to_end((request, expression))
+            return summary
+
         try:
-            context, summary = self.likelihoodSummary(Context.EMPTY, [], request, expression, silent=silent)
+            context, summary = self.likelihoodSummary(emptyContext(), [], request, expression, silent=silent)
         except GrammarFailure as e:
             failureExport = 'failures/grammarFailure%s.pickle' % (
                 time.time() + getPID())
@@ -394,6 +491,10 @@ class Grammar(object):
                 pickle.dump((e, self, request, expression), handle)
             assert False
 
+        if summary is not None:
+            table[(request, expression)] = summary
+            if len(table) > LIKELIHOODSUMMARIES.maximumSize:
+                table.popitem(last=False)
         return summary
 
     def logLikelihood(self, request, expression):
@@ -405,12 +506,25 @@ class Grammar(object):
             assert False
         return summary.logLikelihood(self)
 
+    def logLikelihoods(self, requestsAndPrograms):
+        """Log likelihoods of a list of (request, program), as a numpy array.
+        To score the same programs under several grammars, keep a LikelihoodBatch."""
+        return LikelihoodBatch(self, requestsAndPrograms).logLikelihoods(self)
+
     def rescoreFrontier(self, frontier):
-        return Frontier([FrontierEntry(e.program,
-                                       logPrior=self.logLikelihood(frontier.task.request, e.program),
-                                       logLikelihood=e.logLikelihood)
-                         for e in frontier],
-                        frontier.task)
+        return self.rescoreFrontiers([frontier])[0]
+
+    def rescoreFrontiers(self, frontiers):
+        """Rescores every entry of every frontier in one batch"""
+        frontiers = list(frontiers)
+        logPriors = iter(self.logLikelihoods([(f.task.request, e.program)
+                                              for f in frontiers for e in f]).tolist())
+        return [Frontier([FrontierEntry(e.program,
+                                        logPrior=next(logPriors),
+                                        logLikelihood=e.logLikelihood)
+                          for e in f],
+                         f.task)
+                for f in frontiers]
 
     def productionUses(self, frontiers):
         """Returns the expected number of times that each production was used. {production: expectedUses}"""
@@ -425,46 +539,40 @@ class Grammar(object):
                     uses[p] += u * math.exp(e.logPosterior)
         return uses
 
-    def insideOutside(self, frontiers, pseudoCounts, iterations=1):
-        # Replace programs with (likelihood summary, uses)
-        frontiers = [ Frontier([ FrontierEntry((summary, summary.toUses()),
-                                               logPrior=summary.logLikelihood(self),
-                                               logLikelihood=e.logLikelihood)
-                                 for e in f
-                                 for summary in [self.closedLikelihoodSummary(f.task.request, e.program)] ],
-                               task=f.task)
-                      for f in frontiers ]
+    def insideOutside(self, frontiers, pseudoCounts, iterations=None, tolerance=None):
+        """Fits the production weights to the frontiers by expectation maximization.
+        Without a tolerance this runs `iterations` rounds, one by default. With a
+        tolerance it runs until no log weight moves by more than that, for at
+        most `iterations` rounds if given."""
+        import numpy as np
+
+        if iterations is None and tolerance is None: iterations = 1
+        frontiers = [f for f in frontiers if not f.empty]
+        batch = LikelihoodBatch(self, [(f.task.request, e.program)
+                                       for f in frontiers for e in f])
+        logLikelihoods = np.array([e.logLikelihood for f in frontiers for e in f], dtype=float)
+        sizes = [len(f) for f in frontiers]
 
         g = self
-        for i in range(iterations):
-            u = Uses()
-            for f in frontiers:
-                f = f.normalize()
-                for e in f:
-                    _, eu = e.program
-                    u += math.exp(e.logPosterior) * eu
-
-            lv = math.log(u.actualVariables + pseudoCounts) - \
-                 math.log(u.possibleVariables + pseudoCounts)
-            g = Grammar(lv,
-                        [ (math.log(u.actualUses.get(p,0.) + pseudoCounts) - \
-                           math.log(u.possibleUses.get(p,0.) + pseudoCounts),
-                           t,p)
-                          for _,t,p in g.productions ],
+        weights = np.array([self.logVariable] + [l for l, _, _ in self.productions], dtype=float)
+        i = 0
+        while iterations is None or i < iterations:
+            actual, possible = batch.expectedUses(g, logLikelihoods, sizes)
+            newWeights = np.log(actual + pseudoCounts) - np.log(possible + pseudoCounts)
+            g = Grammar(float(newWeights[0]),
+                        [ (l, t, p)
+                          for l, (_, t, p) in zip(newWeights[1:].tolist(), self.productions) ],
                         continuationType=self.continuationType)
-            if i < iterations - 1:
-                frontiers = [Frontier([ FrontierEntry((summary, uses),
-                                                      logPrior=summary.logLikelihood(g),
-                                                      logLikelihood=e.logLikelihood)
-                                        for e in f
-                                        for (summary, uses) in [e.program] ],
-                                      task=f.task)
-                             for f in frontiers ]
+            i += 1
+            if tolerance is not None and np.max(np.abs(newWeights - weights)) <= tolerance:
+                break
+            weights = newWeights
         return g
 
     def frontierMDL(self, frontier):
-        return max( e.logLikelihood + self.logLikelihood(frontier.task.request, e.program)
-                    for e in frontier )                
+        return max( e.logLikelihood + l
+                    for e, l in zip(frontier, self.logLikelihoods([(frontier.task.request, e.program)
+                                                                   for e in frontier]).tolist()) )                
 
 
     def enumeration(self,context,environment,request,upperBound,
@@ -631,10 +739,11 @@ class Grammar(object):
 
                     yield resultL + argL, resultK, result
 
-    def sketchLogLikelihood(self, request, full, sk, context=Context.EMPTY, environment=[]):
+    def sketchLogLikelihood(self, request, full, sk, context=None, environment=[]):
         """
         calculates mdl of full program 'full' from sketch 'sk'
         """
+        if context is None: context = emptyContext()
         if sk.isHole:
             _, summary = self.likelihoodSummary(context, environment, request, full)
             if summary is None:
@@ -709,7 +818,7 @@ class Grammar(object):
         else:
             def mutations(tp, loss):
                 for l, _, expr in self.enumeration(
-                        Context.EMPTY, [], tp, distance - loss):
+                        emptyContext(), [], tp, distance - loss):
                     yield expr, l
             yield from Mutator(self, mutations).execute(expr, request)
 
@@ -821,15 +930,142 @@ normalizers = {%s})""" % (self.constant,
                     possibleUses, actualUses)
 
 
+class LikelihoodSummaryStore(object):
+    """Closed likelihood summaries of programs, for grammars with the same
+    structure: the same productions with the same types, whatever their
+    weights, which summaries do not depend on. There is one table per
+    structure, keyed by (request, program). Only the tables of the most recent
+    structures are kept, so summaries are only recomputed after the production
+    set changes. It is only a cache, and is not checkpointed: a resumed run
+    rebuilds it as it scores programs."""
+
+    def __init__(self, maximumSize=100000, maximumStructures=2):
+        self.maximumSize = maximumSize
+        self.maximumStructures = maximumStructures
+        self.tables = OrderedDict()
+
+    @staticmethod
+    def structure(grammar):
+        return grammar.continuationType, frozenset((t, p) for _, t, p in grammar.productions)
+
+    def table(self, grammar):
+        """The table for the structure of grammar, an OrderedDict from
+        (request, program) to LikelihoodSummary, least recently used first"""
+        return self.tableForStructure(self.structure(grammar))
+
+    def tableForStructure(self, key):
+        table = self.tables.get(key, None)
+        if table is None:
+            table = self.tables[key] = OrderedDict()
+            if len(self.tables) > self.maximumStructures:
+                self.tables.popitem(last=False)
+        else:
+            self.tables.move_to_end(key)
+        return table
+
+    def __len__(self): return sum(len(table) for table in self.tables.values())
+
+
+LIKELIHOODSUMMARIES = LikelihoodSummaryStore()
+
+
+def configureLikelihoodSummaryStore(store=None):
+    """Replaces the store behind Grammar.closedLikelihoodSummary, for instance
+    with an empty one, or one with other limits"""
+    global LIKELIHOODSUMMARIES
+    LIKELIHOODSUMMARIES = store if store is not None else LikelihoodSummaryStore()
+    return LIKELIHOODSUMMARIES
+
+
+class LikelihoodBatch(object):
+    """Log likelihoods of many programs under grammars over the same library.
+    Each program's LikelihoodSummary is computed once, up front: it does not
+    depend on the production weights. The summaries become sparse matrices of
+    how many times each program uses each production and each distinct set of
+    normalizing productions, so scoring every program under a grammar is a few
+    sparse matrix-vector products and one logsumexp per normalizer set."""
+
+    def __init__(self, grammar, requestsAndPrograms):
+        import numpy as np
+        from scipy.sparse import csr_matrix
+
+        self.summaries = []
+        for request, p in requestsAndPrograms:
+            summary = grammar.closedLikelihoodSummary(request, p)
+            if summary is None:
+                eprint(
+                    "FATAL: program [ %s ] does not have a likelihood summary." %
+                    p, "r = ", request, "\n", grammar)
+                assert False
+            self.summaries.append(summary)
+
+        self.productions = [Index(0)] + [p for _, _, p in grammar.productions]
+        column = {p: j for j, p in enumerate(self.productions)}
+        normalizers = {}
+        uses, normalizerCounts = ([], [], []), ([], [], [])
+        for i, summary in enumerate(self.summaries):
+            for p, count in summary.uses.items():
+                uses[0].append(count)
+                uses[1].append(i)
+                uses[2].append(column[p])
+            for ps, count in summary.normalizers.items():
+                normalizerCounts[0].append(count)
+                normalizerCounts[1].append(i)
+                normalizerCounts[2].append(normalizers.setdefault(ps, len(normalizers)))
+        shape = (len(self.summaries), len(self.productions))
+        self.uses = csr_matrix((uses[0], (uses[1], uses[2])), shape=shape, dtype=float)
+        self.normalizerCounts = csr_matrix((normalizerCounts[0], (normalizerCounts[1], normalizerCounts[2])),
+                                           shape=(len(self.summaries), len(normalizers)), dtype=float)
+        members = [(k, column[p]) for ps, k in normalizers.items() for p in ps]
+        self.normalizers = csr_matrix(([1.]*len(members), ([k for k, _ in members], [j for _, j in members])),
+                                      shape=(len(normalizers), len(self.productions)), dtype=float)
+        self.constants = np.array([summary.constant for summary in self.summaries], dtype=float)
+        # how many times each production could have been used, by each program
+        self.possibles = self.normalizerCounts.dot(self.normalizers).tocsr()
+
+    def __len__(self): return len(self.summaries)
+
+    def expectedUses(self, grammar, logLikelihoods, frontierSizes):
+        """The E-step of Grammar.insideOutside. The programs are consecutive
+        frontiers, of the given sizes, over which their posteriors under grammar
+        are normalized. Returns numpy arrays of the expected number of times each
+        of self.productions was used, and could have been used."""
+        import numpy as np
+
+        if len(self) == 0:
+            return np.zeros(len(self.productions)), np.zeros(len(self.productions))
+        starts = np.cumsum([0] + list(frontierSizes[:-1]))
+        joint = self.logLikelihoods(grammar) + logLikelihoods
+        biggest = np.repeat(np.maximum.reduceat(joint, starts), frontierSizes)
+        with np.errstate(invalid='ignore'):
+            posteriors = np.exp(joint - biggest)
+            posteriors /= np.repeat(np.add.reduceat(posteriors, starts), frontierSizes)
+        # frontiers where every program is impossible contribute nothing
+        posteriors[np.isnan(posteriors)] = 0.
+        return self.uses.T.dot(posteriors), self.possibles.T.dot(posteriors)
+
+    def logLikelihoods(self, grammar):
+        """Numpy array with the log likelihood of each program under grammar"""
+        import numpy as np
+
+        weights = np.array([grammar.expression2likelihood[p] for p in self.productions], dtype=float)
+        finite = weights[np.isfinite(weights)]
+        biggest = finite.max() if len(finite) > 0 else 0.
+        with np.errstate(divide='ignore'):
+            z = biggest + np.log(self.normalizers.dot(np.exp(weights - biggest)))
+        return self.constants + self.uses.dot(weights) - self.normalizerCounts.dot(z)
+
+
 class Uses(object):
     '''Tracks uses of different grammar productions'''
 
     def __init__(self, possibleVariables=0., actualVariables=0.,
-                 possibleUses={}, actualUses={}):
+                 possibleUses=None, actualUses=None):
         self.actualVariables = actualVariables
         self.possibleVariables = possibleVariables
-        self.possibleUses = possibleUses
-        self.actualUses = actualUses
+        # fresh dictionaries, because += updates them in place
+        self.possibleUses = {} if possibleUses is None else possibleUses
+        self.actualUses = {} if actualUses is None else actualUses
 
     def __str__(self):
         return "Uses(actualVariables = %f, possibleVariables = %f, actualUses = %s, possibleUses = %s)" %\
@@ -1043,7 +1279,7 @@ class ContextualGrammar:
 
     def closedLikelihoodSummary(self, request, expression):
         return self.likelihoodSummary(None,None,
-                                      Context.EMPTY,[],
+                                      emptyContext(),[],
                                       request, expression)[1]
 
     def logLikelihood(self, request, expression):
@@ -1053,7 +1289,7 @@ class ContextualGrammar:
         attempts = 0
         while True:
             try:
-                _, e = self._sample(None, None, Context.EMPTY, [], request, maximumDepth)
+                _, e = self._sample(None, None, emptyContext(), [], request, maximumDepth)
                 return e
             except NoCandidates:
                 if maxAttempts is not None:
@@ -1297,6 +1533,11 @@ def batchLikelihood(jobs):
             response[(program, request, grammar)] = fast
     return response
 
+class _EvaluationFailed():
+    def __repr__(self): return "<evaluation failed>"
+EVALUATIONFAILED = _EvaluationFailed()
+
+
 class PCFG():
     def __init__(self, productions, start_symbol, number_of_arguments):
         # productions: nonterminal -> [(log probability, constructor, [(#lambdas, nonterminal)])]
@@ -1628,7 +1869,12 @@ class PCFG():
 
         
 
-    def quantized_enumeration(self, resolution=0.5, skeletons=None):        
+    def quantized_enumeration(self, resolution=0.5, skeletons=None, inputs=None,
+                              evaluationTimeout=None):
+        """inputs: optionally, a list of argument tuples. Subexpressions that can
+        only refer to the arguments are run on them, and only the cheapest
+        subexpression of each nonterminal with given outputs is kept
+        (observational equivalence). Each run gets the fuel of evaluationTimeout"""
         self = self.number_rules()
 
         if skeletons is None:
@@ -1648,6 +1894,56 @@ class PCFG():
         expressions = [ [None for _ in range(int(100/resolution))]
                         for _ in range(nonterminals) ]
 
+        # observed[symbol]: outputs of the expressions kept so far, for nonterminals
+        # whose environment is just the arguments, if we are pruning
+        observed = [None]*nonterminals
+        if inputs:
+            environments = [tuple(reversed(x)) for x in inputs]
+            lambdas = {self.start_symbol: 0}
+            stack = [self.start_symbol]
+            while stack:
+                symbol = stack.pop()
+                for _, _, arguments in productions[symbol]:
+                    for nl, at in arguments:
+                        if at not in lambdas:
+                            lambdas[at] = lambdas[symbol] + nl
+                            stack.append(at)
+            for symbol, n in lambdas.items():
+                if n == 0: observed[symbol] = set()
+
+        # id of a kept expression -> its outputs, so that a primitive applied to
+        # kept expressions is run on their outputs instead of being evaluated again
+        outputs = {}
+        def behavior(e):
+            """The outputs of e on the inputs, or None if they are not data"""
+            f, xs = e.applicationParse()
+            known = [outputs.get(id(x)) for x in xs]
+            if f.isPrimitive and f.name != "if" and None not in known:
+                ys = []
+                for i in range(len(environments)):
+                    y = f.value
+                    try:
+                        for k in known:
+                            if k[i] is EVALUATIONFAILED: raise RunFailure()
+                            y = y(k[i])
+                    except Exception:
+                        y = EVALUATIONFAILED
+                    ys.append(y)
+            else:
+                budget = EvaluationBudget.forTimeout(evaluationTimeout)
+                fuel = budget and budget.remaining
+                f = e.compile(budget)
+                ys = []
+                for environment in environments:
+                    if budget: budget.remaining = fuel
+                    try:
+                        y = f(environment)
+                    except Exception:
+                        y = EVALUATIONFAILED
+                    ys.append(y)
+            if any(callable(y) for y in ys): return None
+            return ys
+
         def expressions_of_size(symbol, size):
             nonlocal expressions
             
@@ -1656,6 +1952,9 @@ class PCFG():
                 return []
             
             if expressions[symbol][size] is None:
+                if observed[symbol] is not None:
+                    # cheaper expressions have to claim their behaviors first
+                    for smaller in range(1, size): expressions_of_size(symbol, smaller)
                 new=[]
                 for cost, k, arguments in productions[symbol]:
                     if cost>size: continue
@@ -1730,6 +2029,17 @@ class PCFG():
                                                             new.append(Application(Application(Application(Application(Application(k, a1), a2), a3), a4), a5))
                     else:
                         assert False, "more than five arguments not supported for the enumeration algorithm but that is not for any good reason"
+                if observed[symbol] is not None:
+                    distinct = []
+                    for e in new:
+                        ys = behavior(e)
+                        if ys is not None:
+                            b = repr(ys)
+                            if b in observed[symbol]: continue
+                            observed[symbol].add(b)
+                            outputs[id(e)] = ys
+                        distinct.append(e)
+                    new = distinct
                 expressions[symbol][size] = new
                 
             return expressions[symbol][size]
@@ -1,3 +1,4 @@
+from dreamcoder.program import EvaluationBudget, OutOfFuel
 from dreamcoder.task import Task, EvaluationTimeout
 import gc
 from dreamcoder.utilities import *
@@ -236,11 +237,9 @@ class ProbabilisticLikelihoodModel:
         # need a try, catch here for problems, and for timeouts
         # can copy task.py for the timeout structure
         try:
-            def timeoutCallBack(_1, _2): raise EvaluationTimeout()
-            signal.signal(signal.SIGVTALRM, timeoutCallBack)
-            signal.setitimer(signal.ITIMER_VIRTUAL, self.timeout)
+            Backstop.arm(self.timeout, EvaluationTimeout)
             try:
-                string_pregex = program.evaluate([])
+                string_pregex = program.compile(EvaluationBudget.forTimeout(self.timeout))(())
                 # if 'left_paren' in program.show(False):
                 #eprint("string_pregex:", string_pregex)
                 #eprint("string_pregex:", string_pregex)
@@ -248,9 +247,11 @@ class ProbabilisticLikelihoodModel:
             except IndexError:
                 # free variable
                 return False, NEGATIVEINFINITY
+            except (EvaluationTimeout, OutOfFuel):
+                raise
             except Exception as e:
                 eprint("Exception during evaluation:", e)
-                if "Attempt to evaluate fragment variable" in e:
+                if "Attempt to evaluate fragment variable" in str(e):
                     eprint("program (bc fragment error)", program)
                 return False, NEGATIVEINFINITY
 
@@ -308,12 +309,11 @@ class ProbabilisticLikelihoodModel:
 
             return success, normalized_cum_ll
 
-        except EvaluationTimeout:
+        except (EvaluationTimeout, OutOfFuel):
             eprint("Timed out while evaluating", program)
             return False, NEGATIVEINFINITY
         finally:
-            signal.signal(signal.SIGVTALRM, lambda *_: None)
-            signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+            Backstop.disarm()
 
 
 try:
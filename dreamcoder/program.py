@@ -5,6 +5,8 @@ from dreamcoder.utilities import *
 
 from time import time
 import math
+import operator
+import weakref
 
 
 class InferenceFailure(Exception):
@@ -18,7 +20,36 @@ class RunFailure(Exception):
     pass
 
 
+class OutOfFuel(Exception):
+    pass
+
+
+class EvaluationBudget(object):
+    """Fuel for compiled programs: each call to a function that the program
+    itself built spends one unit, and once the fuel is gone every call raises
+    OutOfFuel. Recursion and the loops of higher-order primitives mostly go
+    through such calls; primitives that loop on their own, like range, or over
+    other primitives, like (map +1 l), say what a call costs them (see
+    Primitive), so a budget bounds any evaluation without signals.
+    Budgets are bound at compile time, so each thread can have its own."""
+    __slots__ = ["remaining"]
+    # about how many such calls a compiled program makes per second
+    stepsPerSecond = 1000000
+
+    def __init__(self, fuel):
+        self.remaining = fuel
+
+    @staticmethod
+    def forTimeout(timeout):
+        if timeout is None: return None
+        return EvaluationBudget(max(1, int(timeout*EvaluationBudget.stepsPerSecond)))
+
+
 class Program(object):
+    # see HashConsing
+    interned = False
+    hashConsed = False
+
     def __repr__(self): return str(self)
 
     def __ne__(self, o): return not (self == o)
@@ -27,7 +58,7 @@ class Program(object):
 
     def canHaveType(self, t):
         try:
-            context, actualType = self.inferType(Context.EMPTY, [], {})
+            context, actualType = self.inferType(emptyContext(), [], {})
             context, t = t.instantiate(context)
             context.unify(t, actualType)
             return True
@@ -39,6 +70,10 @@ class Program(object):
             self = Abstraction(self)
         return self
 
+    def intern(self):
+        """The hash-consed copy of this program"""
+        return HashConsing.intern(self)
+
     def betaNormalForm(self):
         n = self
         while True:
@@ -48,7 +83,7 @@ class Program(object):
 
     def infer(self):
         try:
-            return self.inferType(Context.EMPTY, [], {})[1].canonical()
+            return self.inferType(emptyContext(), [], {})[1].canonical()
         except UnificationFailure as e:
             raise InferenceFailure(self, e)
 
@@ -86,8 +121,16 @@ class Program(object):
         except InferenceFailure:
             return False
 
-    def runWithArguments(self, xs):
-        f = self.evaluate([])
+    def compile(self, budget=None):
+        """Compiles the program, once, into a function from environments to values,
+        such that self.compile()(()) behaves like self.evaluate([]).
+        Environments are tuples, innermost binding first, so that de Bruijn indices
+        are fixed slots. Evaluating the compiled function walks no syntax tree.
+        Given an EvaluationBudget, the functions the program builds spend its fuel."""
+        return lambda environment: self.evaluate(list(environment))
+
+    def runWithArguments(self, xs, budget=None):
+        f = self.compile(budget)(())
         for x in xs:
             f = f(x)
         return f
@@ -221,10 +264,89 @@ class Program(object):
                 
 
 
+class HashConsing(object):
+    """Opt-in hash consing of programs.
+    While enabled, constructing an Application, Abstraction, Index or Invented
+    returns the one live node with that structure, so structurally equal programs
+    share all of their subterms and two interned programs are equal exactly when
+    they are the same object. Nodes are held weakly: the table only costs memory
+    for programs that are still alive somewhere.
+    Nodes built while disabled (or unpickled) are ordinary nodes; intern() gives
+    their hash-consed copy. Interned nodes are shared, so they must not be mutated."""
+    enabled = False
+    # structure -> weak reference to the node
+    table = {}
+
+    @staticmethod
+    def enable():
+        # Program only gets a __new__ once hash consing has been turned on, so
+        # that constructing programs costs nothing extra otherwise
+        HashConsing.enabled = True
+        if "__new__" not in Program.__dict__:
+            Program.__new__ = staticmethod(HashConsing.construct)
+
+    @staticmethod
+    def disable(): HashConsing.enabled = False
+
+    @staticmethod
+    def construct(cls, *arguments, **keywords):
+        # arguments is empty when unpickling. Keywords are for subclasses
+        # that are not hash consed, like Union.
+        if not (HashConsing.enabled and cls.hashConsed and arguments):
+            return object.__new__(cls)
+        return HashConsing.node(cls, arguments)
+
+    @staticmethod
+    def node(cls, arguments):
+        if cls is Index:
+            key = (cls, arguments[0])
+        else:
+            # Children are identified by identity if they are interned, and by
+            # name if they are primitives. Nothing else can be a child of an
+            # interned node.
+            key = [cls]
+            for a in arguments:
+                if getattr(a, "interned", False): key.append(id(a))
+                elif isinstance(a, Primitive): key.append(a.name)
+                else: return object.__new__(cls)
+            key = tuple(key)
+        table = HashConsing.table
+        r = table.get(key)
+        if r is not None:
+            e = r()
+            if e is not None: return e
+        e = object.__new__(cls)
+        e.__init__(*arguments)
+        e.interned = True
+        def collected(r, key=key):
+            if table.get(key) is r: del table[key]
+        table[key] = weakref.ref(e, collected)
+        return e
+
+    @staticmethod
+    def intern(e):
+        if e.interned: return e
+        if e.isApplication:
+            return HashConsing.node(Application, (HashConsing.intern(e.f), HashConsing.intern(e.x)))
+        if e.isAbstraction:
+            return HashConsing.node(Abstraction, (HashConsing.intern(e.body),))
+        if e.isIndex:
+            return HashConsing.node(Index, (e.i,))
+        if e.isInvented:
+            return HashConsing.node(Invented, (HashConsing.intern(e.body),))
+        return e
+
+    @staticmethod
+    def size(): return len(HashConsing.table)
+
+
 class Application(Program):
     '''Function application'''
 
+    hashConsed = True
+
     def __init__(self, f, x):
+        if self.interned: return
         self.f = f
         self.x = x
         self.hashCode = None
@@ -276,11 +398,10 @@ class Application(Program):
     @property
     def isApplication(self): return True
 
-    def __eq__(
-        self,
-        other): return isinstance(
-        other,
-        Application) and self.f == other.f and self.x == other.x
+    def __eq__(self, other):
+        if self is other: return True
+        if self.interned and getattr(other, "interned", False): return False
+        return isinstance(other, Application) and self.f == other.f and self.x == other.x
 
     def __hash__(self):
         if self.hashCode is None:
@@ -339,6 +460,64 @@ class Application(Program):
         else:
             return self.f.evaluate(environment)(self.x.evaluate(environment))
 
+    def compile(self, budget=None):
+        if self.isConditional:
+            branch = self.branch.compile(budget)
+            yes = self.trueBranch.compile(budget)
+            no = self.falseBranch.compile(budget)
+            return lambda environment: yes(environment) if branch(environment) else no(environment)
+
+        # Uncurry the application, so that calling a primitive on its arguments
+        # is one closure rather than a chain of them
+        f = self
+        xs = []
+        while f.isApplication and not f.isConditional:
+            xs.append(f.x.compile(budget))
+            f = f.f
+        xs.reverse()
+
+        if f.isPrimitive:
+            v = f.value
+            fuel = f.fuel
+            arity = fuel and len(f.tp.functionArguments())
+            if budget is not None and fuel is not None and len(xs) >= arity:
+                def application(environment):
+                    arguments = [x(environment) for x in xs]
+                    cost = fuel
+                    for a in arguments[:arity]: cost = cost(a)
+                    budget.remaining -= cost
+                    if budget.remaining < 0: raise OutOfFuel()
+                    g = v
+                    for a in arguments: g = g(a)
+                    return g
+                return application
+            if len(xs) == 1:
+                x, = xs
+                return lambda environment: v(x(environment))
+            if len(xs) == 2:
+                x, y = xs
+                return lambda environment: v(x(environment))(y(environment))
+            if len(xs) == 3:
+                x, y, z = xs
+                return lambda environment: v(x(environment))(y(environment))(z(environment))
+            def application(environment):
+                g = v
+                for x in xs: g = g(x(environment))
+                return g
+        else:
+            v = f.compile(budget)
+            if len(xs) == 1:
+                x, = xs
+                return lambda environment: v(environment)(x(environment))
+            if len(xs) == 2:
+                x, y = xs
+                return lambda environment: v(environment)(x(environment))(y(environment))
+            def application(environment):
+                g = v(environment)
+                for x in xs: g = g(x(environment))
+                return g
+        return application
+
     def inferType(self, context, environment, freeVariables):
         (context, ft) = self.f.inferType(context, environment, freeVariables)
         (context, xt) = self.x.inferType(context, environment, freeVariables)
@@ -409,7 +588,10 @@ class Index(Program):
     These indices encode variables.
     '''
 
+    hashConsed = True
+
     def __init__(self, i):
+        if self.interned: return
         self.i = i
 
     def show(self, isFunction): return "$%d" % self.i
@@ -418,6 +600,11 @@ class Index(Program):
 
     def __hash__(self): return self.i
 
+    def __getstate__(self): return self.i
+    def __setstate__(self, state):
+        # backward compatibility: indices used to be pickled with their __dict__
+        self.i = state["i"] if isinstance(state, dict) else state
+
     def visit(self,
               visitor,
               *arguments,
@@ -428,6 +615,8 @@ class Index(Program):
     def evaluate(self, environment):
         return environment[self.i]
 
+    def compile(self, budget=None): return operator.itemgetter(self.i)
+
     def inferType(self, context, environment, freeVariables):
         if self.bound(len(environment)):
             return (context, environment[self.i].apply(context))
@@ -501,15 +690,20 @@ class Index(Program):
 class Abstraction(Program):
     '''Lambda abstraction. Creates a new function.'''
 
+    hashConsed = True
+
     def __init__(self, body):
+        if self.interned: return
         self.body = body
         self.hashCode = None
 
     @property
     def isAbstraction(self): return True
 
-    def __eq__(self, o): return isinstance(
-        o, Abstraction) and o.body == self.body
+    def __eq__(self, o):
+        if self is o: return True
+        if self.interned and getattr(o, "interned", False): return False
+        return isinstance(o, Abstraction) and o.body == self.body
 
     def __hash__(self):
         if self.hashCode is None:
@@ -549,6 +743,18 @@ class Abstraction(Program):
     def evaluate(self, environment):
         return lambda x: self.body.evaluate([x] + environment)
 
+    def compile(self, budget=None):
+        body = self.body.compile(budget)
+        if budget is None:
+            return lambda environment: lambda x: body((x,) + environment)
+        def abstraction(environment):
+            def f(x):
+                budget.remaining -= 1
+                if budget.remaining < 0: raise OutOfFuel()
+                return body((x,) + environment)
+            return f
+        return abstraction
+
     def betaReduce(self):
         b = self.body.betaReduce()
         if b is None: return None
@@ -595,11 +801,15 @@ class Abstraction(Program):
 
 class Primitive(Program):
     GLOBALS = {}
+    # Curried like value, and gives the fuel that a call on all of its
+    # arguments spends, for primitives that loop (see EvaluationBudget)
+    fuel = None
 
-    def __init__(self, name, ty, value):
+    def __init__(self, name, ty, value, fuel=None):
         self.tp = ty
         self.name = name
         self.value = value
+        if fuel is not None: self.fuel = fuel
         if name not in Primitive.GLOBALS:
             Primitive.GLOBALS[name] = self
 
@@ -620,13 +830,17 @@ class Primitive(Program):
 
     def show(self, isFunction): return self.name
 
-    def clone(self): return Primitive(self.name, self.tp, self.value)
+    def clone(self): return Primitive(self.name, self.tp, self.value, self.fuel)
 
     def annotateTypes(self, context, environment):
         self.annotatedType = self.tp.instantiateMutable(context)
 
     def evaluate(self, environment): return self.value
 
+    def compile(self, budget=None):
+        value = self.value
+        return lambda environment: value
+
     def betaReduce(self): return None
 
     def isBetaLong(self): return True
@@ -677,7 +891,10 @@ class Primitive(Program):
 class Invented(Program):
     '''New invented primitives'''
 
+    hashConsed = True
+
     def __init__(self, body):
+        if self.interned: return
         self.body = body
         self.tp = self.body.infer()
         self.hashCode = None
@@ -694,7 +911,10 @@ class Invented(Program):
                                                    *arguments,
                                                    **keywords)
 
-    def __eq__(self, o): return isinstance(o, Invented) and o.body == self.body
+    def __eq__(self, o):
+        if self is o: return True
+        if self.interned and getattr(o, "interned", False): return False
+        return isinstance(o, Invented) and o.body == self.body
 
     def __hash__(self):
         if self.hashCode is None:
@@ -715,6 +935,15 @@ class Invented(Program):
 
     def evaluate(self, e): return self.body.evaluate([])
 
+    def compile(self, budget=None):
+        # the body is closed, so its value is computed once
+        body = self.body.compile(budget)
+        value = []
+        def invented(environment):
+            if not value: value.append(body(()))
+            return value[0]
+        return invented
+
     def betaReduce(self): return self.body
 
     def isBetaLong(self): return True
@@ -996,7 +1225,7 @@ class Mutator:
     def logLikelihood(self, tp, e, env):
         summary = None
         try:
-            _, summary = self.grammar.likelihoodSummary(Context.EMPTY, env,
+            _, summary = self.grammar.likelihoodSummary(emptyContext(), env,
                 tp, e, silent=True)
         except AssertionError as err:
             #print(f"closedLikelihoodSummary failed on tp={tp}, e={e}, error={err}")
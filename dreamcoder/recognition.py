@@ -56,6 +56,119 @@ def is_torch_invalid(v):
 
 def _relu(x): return x.clamp(min=0)
 
+
+class TaskCache(object):
+    """What a network computes from a task and can reuse, like its tokenized
+    examples or its image: a least recently used table keyed by task, which
+    keeps its tasks alive so that their ids are not reused. Caches pickle
+    empty, so they do not end up in checkpoints."""
+
+    def __init__(self, maximumSize=10000):
+        self.maximumSize = maximumSize
+        self.table = OrderedDict()
+
+    @staticmethod
+    def of(owner, name="_taskCache", maximumSize=10000):
+        """The cache called name of owner, created on first use so that
+        networks unpickled from old checkpoints get one as well"""
+        cache = owner.__dict__.get(name, None)
+        if cache is None:
+            cache = owner.__dict__[name] = TaskCache(maximumSize)
+        return cache
+
+    def get(self, task, compute):
+        """The value cached for task, or compute(task), which is cached"""
+        entry = self.table.get(id(task), None)
+        if entry is not None:
+            self.table.move_to_end(id(task))
+            return entry[1]
+        value = compute(task)
+        self.table[id(task)] = (task, value)
+        if len(self.table) > self.maximumSize:
+            self.table.popitem(last=False)
+        return value
+
+    def clear(self): self.table.clear()
+
+    def __len__(self): return len(self.table)
+
+    def __getstate__(self): return {"maximumSize": self.maximumSize}
+
+    def __setstate__(self, state):
+        self.__init__(state["maximumSize"])
+
+
+class HelmholtzDreamer(object):
+    """Background processes making Helmholtz dreams while the recognition
+    model trains. Each worker is forked and runs produce(k, workers), a
+    generator, putting what it yields into a bounded queue that get() reads
+    from; workers block once the queue is full, so at most maximumSize
+    dreams are waiting. Forked workers need the main process to not be a
+    daemon, which rules out training inside a parallelMap."""
+
+    FINISHED = "FINISHED"
+
+    def __init__(self, produce, workers, maximumSize=1000):
+        from multiprocessing import Process, Queue
+        self.queue = Queue(maximumSize)
+        self.running = set(range(workers))
+        # running workers that had exited when the queue last ran dry
+        self.exited = set()
+        self.received = 0
+        self.starting = time.time()
+        seed = random.random()
+        self.workers = [Process(target=self._work, args=(produce, k, workers, seed + k), daemon=True)
+                        for k in range(workers)]
+        for worker in self.workers: worker.start()
+
+    @staticmethod
+    def possible():
+        import multiprocessing
+        return not multiprocessing.current_process().daemon
+
+    def _work(self, produce, k, workers, seed):
+        random.seed(seed)
+        np.random.seed(int(seed*2**20) % 2**32)
+        torch.set_num_threads(1)
+        try:
+            for x in produce(k, workers): self.queue.put(x)
+        except Exception:
+            eprint("Exception in Helmholtz dreamer %d:\n%s" % (k, traceback.format_exc()))
+        finally:
+            self.queue.put((HelmholtzDreamer.FINISHED, k))
+
+    def get(self):
+        """The next thing a worker produced, or None once they have all finished.
+        A worker that dies without saying it has finished, say because it was
+        killed, counts as finished once it has exited and the queue has been
+        empty for a second."""
+        from queue import Empty
+        while self.running:
+            try:
+                x = self.queue.get(timeout=1.)
+            except Empty:
+                exited = {k for k in self.running if self.workers[k].exitcode is not None}
+                # those that had already exited last time have had a whole timeout for their dreams to come through
+                for k in exited & self.exited:
+                    eprint("Helmholtz dreamer %d died with exit code %s" % (k, self.workers[k].exitcode))
+                self.running -= exited & self.exited
+                self.exited = exited
+                continue
+            if isinstance(x, tuple) and len(x) == 2 and x[0] == HelmholtzDreamer.FINISHED:
+                self.running.discard(x[1])
+                continue
+            self.received += 1
+            return x
+        return None
+
+    def rate(self):
+        """Dreams received per second"""
+        return self.received/(time.time() - self.starting)
+
+    def close(self):
+        for worker in self.workers: worker.terminate()
+        for worker in self.workers: worker.join()
+
 class Entropy(nn.Module):
     """Calculates the entropy of logits"""
     def __init__(self):
@@ -82,52 +195,167 @@ class GrammarNetwork(nn.Module):
                         for k, (_, t, program) in enumerate(self.grammar.productions)],
                        continuationType=self.grammar.continuationType)
 
-    def batchedLogLikelihoods(self, xs, summaries):
-        """Takes as input BxinputDimensionality vector & B likelihood summaries;
-        returns B-dimensional vector containing log likelihood of each summary"""
-        use_cuda = xs.device.type == 'cuda'
+    def summaryRows(self):
+        return SummaryRows(self.grammar)
 
-        B = xs.size(0)
-        assert len(summaries) == B
-        logProductions = self.logProductions(xs)
+    def batchedLogProductions(self, xs):
+        """BxinputDimensionality -> Bx(len(grammar)+1) log productions, variable last"""
+        return self.logProductions(xs)
 
-        # uses[b][p] is # uses of primitive p by summary b
-        uses = np.zeros((B,len(self.grammar) + 1))
-        for b,summary in enumerate(summaries):
-            for p, production in enumerate(self.grammar.primitives):
-                uses[b,p] = summary.uses.get(production, 0.)
-            uses[b,len(self.grammar)] = summary.uses.get(Index(0), 0)
-
-        numerator = (logProductions * maybe_cuda(torch.from_numpy(uses).float(),use_cuda)).sum(1)
-        numerator += maybe_cuda(torch.tensor([summary.constant for summary in summaries ]).float(), use_cuda)
-
-        alternativeSet = {normalizer
-                          for s in summaries
-                          for normalizer in s.normalizers }
-        alternativeSet = list(alternativeSet)
-
-        mask = np.zeros((len(alternativeSet), len(self.grammar) + 1))
-        for tau in range(len(alternativeSet)):
-            for p, production in enumerate(self.grammar.primitives):
-                mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-            mask[tau,len(self.grammar)] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-        mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-        # mask: Rx|G|
-        # logProductions: Bx|G|
-        # Want: mask + logProductions : BxRx|G| = z
-        z = mask.repeat(B,1,1) + logProductions.repeat(len(alternativeSet),1,1).transpose(1,0)
-        # z: BxR
-        z = torch.logsumexp(z, 2) # pytorch 1.0 dependency
-
-        # Calculate how many times each normalizer was used
-        N = np.zeros((B, len(alternativeSet)))
-        for b, summary in enumerate(summaries):
-            for tau, alternatives in enumerate(alternativeSet):
-                N[b, tau] = summary.normalizers.get(alternatives,0.)
-
-        denominator = (maybe_cuda(torch.tensor(N).float(),use_cuda) * z).sum(1)
-        return numerator - denominator
+    def batchedLogLikelihoods(self, xs, summaries, rows=None):
+        """Takes as input BxinputDimensionality vector & B likelihood summaries;
+        returns B-dimensional vector containing log likelihood of each summary.
+        rows: a SummaryRows for this network, which remembers the summaries it has seen"""
+        assert xs.size(0) == len(summaries)
+        if rows is None: rows = self.summaryRows()
+        return rows.logLikelihoods(self.logProductions(xs), summaries)
+
+
+def grammarOfLogProductions(grammar, logProductions, library=None):
+    """The untorched counterpart of a grammar network's forward pass: the Grammar
+    whose log probabilities are the array logProductions, productions of grammar
+    first and the variable last. Given the library of a contextual network,
+    logProductions has one such row per context and this builds a ContextualGrammar."""
+    def unigram(row):
+        row = row.tolist()
+        return Grammar(row[-1],
+                       [(row[k], t, program)
+                        for k, (_, t, program) in enumerate(grammar.productions)],
+                       continuationType=grammar.continuationType)
+    if library is None: return unigram(logProductions)
+    return ContextualGrammar(unigram(logProductions[-1]), unigram(logProductions[-2]),
+                             {prim: [unigram(logProductions[j]) for j in js]
+                              for prim, js in library.items()})
+
+
+class SummaryRows(object):
+    """Likelihood summaries as rows of tensors over the outputs of a grammar
+    network: for each context, the productions of the grammar, then the
+    variable. Unigram networks have a single context; contextual networks have
+    one per argument of each primitive, then one for a variable parent and one
+    for no parent, and their summaries are ContextualGrammar summaries. Each
+    summary is converted the first time it is seen, so training can reuse the
+    conversion for every minibatch that the summary appears in."""
+
+    def __init__(self, grammar, library=None, maximumSize=100000):
+        """library: for contextual networks, the contexts of the arguments of each primitive"""
+        self.library = library
+        self.contexts = 1 if library is None else 2 + sum(len(js) for js in library.values())
+        self.width = len(grammar) + 1
+        self.column = {p: j for j, p in enumerate(grammar.primitives)}
+        self.column[Index(0)] = len(grammar)
+        # normalizer set -> its index, and the mask of each set: 0 for its members, -inf otherwise
+        self.normalizers = {}
+        self.masks = []
+        # id(summary) -> (summary, columns of uses, uses, [(context, normalizer, count)], constant)
+        # least recently used first
+        self.maximumSize = maximumSize
+        self.rows = OrderedDict()
+        # (request, program) -> its summary, least recently used first
+        self.summaries = OrderedDict()
+        # see share
+        self.shared = []
+
+    def summary(self, grammar, request, program):
+        """grammar.closedLikelihoodSummary(request, program), remembered, so
+        that contextual summaries, which grammars do not cache, are computed
+        once as well"""
+        summary = self.summaries.get((request, program), None)
+        if summary is not None:
+            self.summaries.move_to_end((request, program))
+            return summary
+        summary = self.summaries[(request, program)] = grammar.closedLikelihoodSummary(request, program)
+        if len(self.summaries) > self.maximumSize:
+            self.summaries.popitem(last=False)
+        return summary
+
+    def parts(self, summary):
+        """The unigram summaries making up summary, with their contexts"""
+        if self.library is None: return [(0, summary)]
+        return [(g, s)
+                for e, ss in summary.library.items()
+                for g, s in zip(self.library[e], ss)] + \
+               [(self.contexts - 2, summary.variableParent),
+                (self.contexts - 1, summary.noParent)]
+
+    def row(self, summary):
+        row = self.rows.get(id(summary), None)
+        if row is not None:
+            self.rows.move_to_end(id(summary))
+            return row
+
+        columns, uses, normalizers, constant = [], [], [], 0.
+        for g, s in self.parts(summary):
+            for p, count in s.uses.items():
+                columns.append(g*self.width + self.column[p])
+                uses.append(count)
+            for ps, count in s.normalizers.items():
+                if ps not in self.normalizers:
+                    mask = np.full(self.width, NEGATIVEINFINITY, dtype=np.float32)
+                    for p in ps:
+                        mask[self.column[p]] = 0.
+                    self.normalizers[ps] = len(self.masks)
+                    self.masks.append(mask)
+                normalizers.append((g, self.normalizers[ps], count))
+            constant += s.constant
+        # keep the summary alive, so that its id is not reused
+        row = (summary, np.array(columns, dtype=np.int64), np.array(uses, dtype=np.float32),
+               normalizers, constant)
+        self.rows[id(summary)] = row
+        if len(self.rows) > self.maximumSize:
+            self.rows.popitem(last=False)
+        return row
+
+    def share(self):
+        """Moves the arrays of the rows made so far, and the masks, into tensors
+        in shared memory, one for each kind of array, so that forked workers
+        read them from there. Rows made afterwards are ordinary arrays."""
+        rows = list(self.rows.items())
+        offsets = np.cumsum([0] + [len(columns) for _, (_, columns, _, _, _) in rows])
+        columns = torch.zeros(int(offsets[-1]), dtype=torch.long).share_memory_()
+        uses = torch.zeros(int(offsets[-1]), dtype=torch.float32).share_memory_()
+        c, u = columns.numpy(), uses.numpy()
+        for (key, (summary, cs, us, normalizers, constant)), start, end in zip(rows, offsets, offsets[1:]):
+            c[start:end] = cs
+            u[start:end] = us
+            self.rows[key] = (summary, c[start:end], u[start:end], normalizers, constant)
+        self.shared = [columns, uses]
+        if self.masks:
+            masks = torch.from_numpy(np.stack(self.masks)).share_memory_()
+            self.masks = list(masks.numpy())
+            self.shared.append(masks)
+
+    def tensors(self, summaries, device=None):
+        """Returns uses: Bx(CW), constants: B, normalizer counts: BxN, and the
+        context: N and mask: NxW of each normalizer, where C counts contexts
+        and N the distinct (context, normalizer set) pairs of these B summaries"""
+        rows = [self.row(summary) for summary in summaries]
+        used = {}
+        for _, _, _, normalizers, _ in rows:
+            for g, r, _ in normalizers:
+                used.setdefault((g, r), len(used))
+        uses = np.zeros((len(rows), self.contexts*self.width), dtype=np.float32)
+        counts = np.zeros((len(rows), len(used)), dtype=np.float32)
+        for b, (_, columns, values, normalizers, _) in enumerate(rows):
+            np.add.at(uses[b], columns, values)
+            for g, r, count in normalizers:
+                counts[b, used[(g, r)]] += count
+        masks = np.stack([self.masks[r] for _, r in used]) if used else np.zeros((0, self.width), dtype=np.float32)
+        return (torch.from_numpy(uses).to(device),
+                torch.tensor([constant for _, _, _, _, constant in rows]).float().to(device),
+                torch.from_numpy(counts).to(device),
+                torch.tensor([g for g, _ in used], dtype=torch.long).to(device),
+                torch.from_numpy(masks).to(device))
+
+    def logLikelihoods(self, logProductions, summaries):
+        """logProductions: BxW or BxCxW outputs of a grammar network; returns the B log likelihoods"""
+        B = logProductions.size(0)
+        logProductions = logProductions.contiguous().view(B, self.contexts, self.width)
+        uses, constants, counts, contexts, masks = self.tensors(summaries, logProductions.device)
+        numerator = (logProductions.view(B, -1) * uses).sum(1) + constants
+        # z: BxN, the log normalizing constant of each normalizer under each grammar
+        z = torch.logsumexp(logProductions.index_select(1, contexts) + masks.unsqueeze(0), 2)
+        return numerator - (counts * z).sum(1)
 
         
 
@@ -253,101 +481,20 @@ class ContextualGrammarNetwork_LowRank(nn.Module):
         assert False, "This function is still in progress."
         
 
-    def batchedLogLikelihoods(self, xs, summaries):
-        """Takes as input BxinputDimensionality vector & B likelihood summaries;
-        returns B-dimensional vector containing log likelihood of each summary"""
-        use_cuda = xs.device.type == 'cuda'
-        
-        B = xs.shape[0]
-        G = len(self.grammar) + 1
-        assert len(summaries) == B
-
-        # logProductions: Bx n_grammars x G
-        logProductions = self.transitionMatrix(xs)
-        # uses[b][g][p] is # uses of primitive p by summary b for parent g
-        uses = np.zeros((B,self.n_grammars,len(self.grammar)+1))
-        for b,summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for p, production in enumerate(self.grammar.primitives):
-                        uses[b,g,p] = s.uses.get(production, 0.)
-                    uses[b,g,len(self.grammar)] = s.uses.get(Index(0), 0)
-                    
-            # noParent: this is the last network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 1, p] = summary.noParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 1, G - 1] = summary.noParent.uses.get(Index(0), 0.)
-
-            # variableParent: this is the penultimate network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 2, p] = summary.variableParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 2, G - 1] = summary.variableParent.uses.get(Index(0), 0.)
-            
-        numerator = (logProductions*maybe_cuda(torch.tensor(uses).float(),use_cuda)).view(B,-1).sum(1)
-
-        constant = np.zeros(B)
-        for b,summary in enumerate(summaries):
-            constant[b] += summary.noParent.constant + summary.variableParent.constant
-            for ss in summary.library.values():
-                for s in ss:
-                    constant[b] += s.constant
-            
-        numerator += maybe_cuda(torch.tensor(constant).float(),use_cuda)
-        
-        if True:
-
-            # Calculate the god-awful denominator
-            alternativeSet = set()
-            for summary in summaries:
-                for normalizer in summary.noParent.normalizers: alternativeSet.add(normalizer)
-                for normalizer in summary.variableParent.normalizers: alternativeSet.add(normalizer)
-                for ss in summary.library.values():
-                    for s in ss:
-                        for normalizer in s.normalizers: alternativeSet.add(normalizer)
-            alternativeSet = list(alternativeSet)
-
-            mask = np.zeros((len(alternativeSet), G))
-            for tau in range(len(alternativeSet)):
-                for p, production in enumerate(self.grammar.primitives):
-                    mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-                mask[tau, G - 1] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-            mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-            z = mask.repeat(self.n_grammars,1,1).repeat(B,1,1,1) + \
-                logProductions.repeat(len(alternativeSet),1,1,1).transpose(0,1).transpose(1,2)
-            z = torch.logsumexp(z, 3) # pytorch 1.0 dependency
-
-            N = np.zeros((B, self.n_grammars, len(alternativeSet)))
-            for b, summary in enumerate(summaries):
-                for e, ss in summary.library.items():
-                    for g,s in zip(self.library[e], ss):
-                        assert g < self.n_grammars - 2
-                        for r, alternatives in enumerate(alternativeSet):                
-                            N[b,g,r] = s.normalizers.get(alternatives, 0.)
-                # noParent: this is the last network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 1,r] = summary.noParent.normalizers.get(alternatives, 0.)
-                # variableParent: this is the penultimate network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 2,r] = summary.variableParent.normalizers.get(alternatives, 0.)
-            N = maybe_cuda(torch.tensor(N).float(), use_cuda)
-            denominator = (N*z).sum(1).sum(1)
-        else:
-            gs = [ self(xs[b]) for b in range(B) ]
-            denominator = torch.cat([ summary.denominator(g) for summary,g in zip(summaries, gs) ])
-            
-            
+    def summaryRows(self):
+        return SummaryRows(self.grammar, self.library)
 
-        
-        
-        ll = numerator - denominator 
+    def batchedLogProductions(self, xs):
+        """BxinputDimensionality -> Bxn_grammarsx(len(grammar)+1) log productions"""
+        return self.transitionMatrix(xs)
 
-        if False: # verifying that batching works correctly
-            gs = [ self(xs[b]) for b in range(B) ]
-            _l = torch.cat([ summary.logLikelihood(g) for summary,g in zip(summaries, gs) ])
-            assert torch.all((ll - _l).abs() < 0.0001)
-        return ll
+    def batchedLogLikelihoods(self, xs, summaries, rows=None):
+        """Takes as input BxinputDimensionality vector & B likelihood summaries;
+        returns B-dimensional vector containing log likelihood of each summary.
+        rows: a SummaryRows for this network, which remembers the summaries it has seen"""
+        assert xs.size(0) == len(summaries)
+        if rows is None: rows = self.summaryRows()
+        return rows.logLikelihoods(self.transitionMatrix(xs), summaries)
     
 class ContextualGrammarNetwork_Mask(nn.Module):
     def __init__(self, inputDimensionality, grammar):
@@ -398,101 +545,20 @@ class ContextualGrammarNetwork_Mask(nn.Module):
                 {prim: [self.grammarFromVector(transitionMatrix[j]) for j in js]
                  for prim, js in self.library.items()} )
         
-    def batchedLogLikelihoods(self, xs, summaries):
-        """Takes as input BxinputDimensionality vector & B likelihood summaries;
-        returns B-dimensional vector containing log likelihood of each summary"""
-        use_cuda = xs.device.type == 'cuda'
-        
-        B = xs.shape[0]
-        G = len(self.grammar) + 1
-        assert len(summaries) == B
+    def summaryRows(self):
+        return SummaryRows(self.grammar, self.library)
 
-        # logProductions: Bx n_grammars x G
-        logProductions = self.transitionMatrix(xs)
-        # uses[b][g][p] is # uses of primitive p by summary b for parent g
-        uses = np.zeros((B,self.n_grammars,len(self.grammar)+1))
-        for b,summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for p, production in enumerate(self.grammar.primitives):
-                        uses[b,g,p] = s.uses.get(production, 0.)
-                    uses[b,g,len(self.grammar)] = s.uses.get(Index(0), 0)
-                    
-            # noParent: this is the last network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 1, p] = summary.noParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 1, G - 1] = summary.noParent.uses.get(Index(0), 0.)
+    def batchedLogProductions(self, xs):
+        """BxinputDimensionality -> Bxn_grammarsx(len(grammar)+1) log productions"""
+        return self.transitionMatrix(xs)
 
-            # variableParent: this is the penultimate network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 2, p] = summary.variableParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 2, G - 1] = summary.variableParent.uses.get(Index(0), 0.)
-            
-        numerator = (logProductions*maybe_cuda(torch.tensor(uses).float(),use_cuda)).view(B,-1).sum(1)
-
-        constant = np.zeros(B)
-        for b,summary in enumerate(summaries):
-            constant[b] += summary.noParent.constant + summary.variableParent.constant
-            for ss in summary.library.values():
-                for s in ss:
-                    constant[b] += s.constant
-            
-        numerator += maybe_cuda(torch.tensor(constant).float(),use_cuda)
-        
-        if True:
-
-            # Calculate the god-awful denominator
-            alternativeSet = set()
-            for summary in summaries:
-                for normalizer in summary.noParent.normalizers: alternativeSet.add(normalizer)
-                for normalizer in summary.variableParent.normalizers: alternativeSet.add(normalizer)
-                for ss in summary.library.values():
-                    for s in ss:
-                        for normalizer in s.normalizers: alternativeSet.add(normalizer)
-            alternativeSet = list(alternativeSet)
-
-            mask = np.zeros((len(alternativeSet), G))
-            for tau in range(len(alternativeSet)):
-                for p, production in enumerate(self.grammar.primitives):
-                    mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-                mask[tau, G - 1] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-            mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-            z = mask.repeat(self.n_grammars,1,1).repeat(B,1,1,1) + \
-                logProductions.repeat(len(alternativeSet),1,1,1).transpose(0,1).transpose(1,2)
-            z = torch.logsumexp(z, 3) # pytorch 1.0 dependency
-
-            N = np.zeros((B, self.n_grammars, len(alternativeSet)))
-            for b, summary in enumerate(summaries):
-                for e, ss in summary.library.items():
-                    for g,s in zip(self.library[e], ss):
-                        assert g < self.n_grammars - 2
-                        for r, alternatives in enumerate(alternativeSet):                
-                            N[b,g,r] = s.normalizers.get(alternatives, 0.)
-                # noParent: this is the last network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 1,r] = summary.noParent.normalizers.get(alternatives, 0.)
-                # variableParent: this is the penultimate network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 2,r] = summary.variableParent.normalizers.get(alternatives, 0.)
-            N = maybe_cuda(torch.tensor(N).float(), use_cuda)
-            denominator = (N*z).sum(1).sum(1)
-        else:
-            gs = [ self(xs[b]) for b in range(B) ]
-            denominator = torch.cat([ summary.denominator(g) for summary,g in zip(summaries, gs) ])
-            
-            
-
-        
-        
-        ll = numerator - denominator
-
-        if False: # verifying that batching works correctly
-            gs = [ self(xs[b]) for b in range(B) ]
-            _l = torch.cat([ summary.logLikelihood(g) for summary,g in zip(summaries, gs) ])
-            assert torch.all((ll - _l).abs() < 0.0001)
-        return ll
+    def batchedLogLikelihoods(self, xs, summaries, rows=None):
+        """Takes as input BxinputDimensionality vector & B likelihood summaries;
+        returns B-dimensional vector containing log likelihood of each summary.
+        rows: a SummaryRows for this network, which remembers the summaries it has seen"""
+        assert xs.size(0) == len(summaries)
+        if rows is None: rows = self.summaryRows()
+        return rows.logLikelihoods(self.transitionMatrix(xs), summaries)
         
                 
 
@@ -530,95 +596,20 @@ class ContextualGrammarNetwork(nn.Module):
                 {prim: [self.grammarFromVector(allVars[j]) for j in js]
                  for prim, js in self.library.items()} )
 
-    def batchedLogLikelihoods(self, xs, summaries):
-        use_cuda = xs.device.type == 'cuda'
-        """Takes as input BxinputDimensionality vector & B likelihood summaries;
-        returns B-dimensional vector containing log likelihood of each summary"""
+    def summaryRows(self):
+        return SummaryRows(self.grammar, self.library)
 
-        B = xs.shape[0]
-        G = len(self.grammar) + 1
-        assert len(summaries) == B
+    def batchedLogProductions(self, xs):
+        """BxinputDimensionality -> Bxn_grammarsx(len(grammar)+1) log productions"""
+        return self.network(xs).view(xs.size(0), self.n_grammars, -1)
 
-        # logProductions: Bx n_grammars x G
-        logProductions = self.network(xs).view(B, self.n_grammars, G)
-        # uses[b][g][p] is # uses of primitive p by summary b for parent g
-        uses = np.zeros((B,self.n_grammars,len(self.grammar)+1))
-        for b,summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for p, production in enumerate(self.grammar.primitives):
-                        uses[b,g,p] = s.uses.get(production, 0.)
-                    uses[b,g,len(self.grammar)] = s.uses.get(Index(0), 0)
-                    
-            # noParent: this is the last network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 1, p] = summary.noParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 1, G - 1] = summary.noParent.uses.get(Index(0), 0.)
-
-            # variableParent: this is the penultimate network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 2, p] = summary.variableParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 2, G - 1] = summary.variableParent.uses.get(Index(0), 0.)
-            
-        numerator = (logProductions*maybe_cuda(torch.tensor(uses).float(),use_cuda)).view(B,-1).sum(1)
-
-        constant = np.zeros(B)
-        for b,summary in enumerate(summaries):
-            constant[b] += summary.noParent.constant + summary.variableParent.constant
-            for ss in summary.library.values():
-                for s in ss:
-                    constant[b] += s.constant
-            
-        numerator += maybe_cuda(torch.tensor(constant).float(),use_cuda)
-
-        # Calculate the god-awful denominator
-        alternativeSet = set()
-        for summary in summaries:
-            for normalizer in summary.noParent.normalizers: alternativeSet.add(normalizer)
-            for normalizer in summary.variableParent.normalizers: alternativeSet.add(normalizer)
-            for ss in summary.library.values():
-                for s in ss:
-                    for normalizer in s.normalizers: alternativeSet.add(normalizer)
-        alternativeSet = list(alternativeSet)
-
-        mask = np.zeros((len(alternativeSet), G))
-        for tau in range(len(alternativeSet)):
-            for p, production in enumerate(self.grammar.primitives):
-                mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-            mask[tau, G - 1] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-        mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-        z = mask.repeat(self.n_grammars,1,1).repeat(B,1,1,1) + \
-            logProductions.repeat(len(alternativeSet),1,1,1).transpose(0,1).transpose(1,2)
-        z = torch.logsumexp(z, 3) # pytorch 1.0 dependency
-
-        N = np.zeros((B, self.n_grammars, len(alternativeSet)))
-        for b, summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for r, alternatives in enumerate(alternativeSet):                
-                        N[b,g,r] = s.normalizers.get(alternatives, 0.)
-            # noParent: this is the last network output
-            for r, alternatives in enumerate(alternativeSet):
-                N[b,self.n_grammars - 1,r] = summary.noParent.normalizers.get(alternatives, 0.)
-            # variableParent: this is the penultimate network output
-            for r, alternatives in enumerate(alternativeSet):
-                N[b,self.n_grammars - 2,r] = summary.variableParent.normalizers.get(alternatives, 0.)
-        N = maybe_cuda(torch.tensor(N).float(), use_cuda)
-        
-
-        
-        denominator = (N*z).sum(1).sum(1)
-        ll = numerator - denominator
-
-        if False: # verifying that batching works correctly
-            gs = [ self(xs[b]) for b in range(B) ]
-            _l = torch.cat([ summary.logLikelihood(g) for summary,g in zip(summaries, gs) ])
-            assert torch.all((ll - _l).abs() < 0.0001)
-
-        return ll
+    def batchedLogLikelihoods(self, xs, summaries, rows=None):
+        """Takes as input BxinputDimensionality vector & B likelihood summaries;
+        returns B-dimensional vector containing log likelihood of each summary.
+        rows: a SummaryRows for this network, which remembers the summaries it has seen"""
+        assert xs.size(0) == len(summaries)
+        if rows is None: rows = self.summaryRows()
+        return rows.logLikelihoods(self.network(xs), summaries)
         
 
 class RecognitionModel(nn.Module):
@@ -686,7 +677,13 @@ class RecognitionModel(nn.Module):
             self.featureExtractor.load_state_dict(previousRecognitionModel.featureExtractor.state_dict())
             
     def auxiliaryLoss(self, frontier, features):
-        # Compute a vector of uses
+        u = self.auxiliaryTarget(frontier)
+        if self.use_cuda: u = u.cuda()
+        al = self._auxiliaryLoss(self._auxiliaryPrediction(features), u)
+        return al
+
+    def auxiliaryTarget(self, frontier):
+        """Which primitives the best program of the frontier uses, as a 0/1 vector"""
         ls = frontier.bestPosterior.program
         def uses(summary):
             if hasattr(summary, 'uses'): 
@@ -700,12 +697,18 @@ class RecognitionModel(nn.Module):
             return u
         u = uses(ls)
         u[u > 1.] = 1.
-        if self.use_cuda: u = u.cuda()
-        al = self._auxiliaryLoss(self._auxiliaryPrediction(features), u)
-        return al
+        return u
             
+    def frozenFeaturesOfTask(self, task):
+        """featuresOfTask, without gradients, remembered until the model is next
+        trained: the task metrics ask for the same tasks over and over"""
+        def features(task):
+            with torch.no_grad():
+                return self.featureExtractor.featuresOfTask(task)
+        return TaskCache.of(self, "_frozenFeatures").get(task, features)
+
     def taskEmbeddings(self, tasks):
-        return {task: self.featureExtractor.featuresOfTask(task).data.cpu().numpy()
+        return {task: self.frozenFeaturesOfTask(task).data.cpu().numpy()
                 for task in tasks}
 
     def forward(self, features):
@@ -721,14 +724,45 @@ class RecognitionModel(nn.Module):
         return primitivesDict
 
     def grammarOfTask(self, task):
-        features = self.featureExtractor.featuresOfTask(task)
+        features = self.frozenFeaturesOfTask(task)
         if features is None: return None
         return self(features)
 
+    def grammarsOfTasks(self, tasks, quantum=None):
+        """{task: grammarOfTask(task).untorch()} for the tasks that have features,
+        from one forward pass over all of them. Tasks whose log productions
+        round to the same multiples of quantum share a single grammar (that of
+        the first of them), which multicoreEnumeration then enumerates once for
+        all of them; quantum=None only merges exact duplicates."""
+        cache = TaskCache.of(self, "_frozenFeatures")
+        fresh = list({id(task): task for task in tasks if id(task) not in cache.table}.values())
+        if fresh and hasattr(self.featureExtractor, 'featuresOfTasks'):
+            with torch.no_grad():
+                xs = self.featureExtractor.featuresOfTasks(fresh)
+            if xs is not None:
+                for task, x in zip(fresh, xs): cache.get(task, lambda _: x)
+        features = [(task, self.frozenFeaturesOfTask(task)) for task in tasks]
+        features = [(task, x) for task, x in features if x is not None]
+        if not features: return {}
+
+        with torch.no_grad():
+            xs = self._MLP(torch.stack([x for _, x in features]))
+            logProductions = self.grammarBuilder.batchedLogProductions(xs).cpu().numpy()
+
+        library = getattr(self.grammarBuilder, 'library', None)
+        grammars, shared = {}, {}
+        for (task, _), row in zip(features, logProductions):
+            key = row if quantum is None else np.round(row/quantum).astype(np.int64)
+            key = key.tobytes()
+            if key not in shared:
+                shared[key] = grammarOfLogProductions(self.grammarBuilder.grammar, row, library)
+            grammars[task] = shared[key]
+        return grammars
+
     def grammarLogProductionsOfTask(self, task):
         """Returns the grammar logits from non-contextual models."""
 
-        features = self.featureExtractor.featuresOfTask(task)
+        features = self.frozenFeaturesOfTask(task)
         if features is None: return None
 
         if hasattr(self, 'hiddenLayers'):
@@ -780,7 +814,7 @@ class RecognitionModel(nn.Module):
             return e(grammarLogProductionsOfTask)
 
     def taskAuxiliaryLossLayer(self, tasks):
-        return {task: self._auxiliaryPrediction(self.featureExtractor.featuresOfTask(task)).view(-1).data.cpu().numpy()
+        return {task: self._auxiliaryPrediction(self.frozenFeaturesOfTask(task)).view(-1).data.cpu().numpy()
                 for task in tasks}
                 
     def taskGrammarFeatureLogProductions(self, tasks):
@@ -797,14 +831,14 @@ class RecognitionModel(nn.Module):
                 for g in [self.grammarOfTask(task).untorch().noParent] }
 
     def taskHiddenStates(self, tasks):
-        return {task: self._MLP(self.featureExtractor.featuresOfTask(task)).view(-1).data.cpu().numpy()
+        return {task: self._MLP(self.frozenFeaturesOfTask(task)).view(-1).data.cpu().numpy()
                 for task in tasks}
 
     def taskGrammarEntropies(self, tasks):
         return {task: self.grammarEntropyOfTask(task).data.cpu().numpy()
                 for task in tasks}
 
-    def frontierKL(self, frontier, auxiliary=False, vectorized=True):
+    def frontierKL(self, frontier, auxiliary=False, vectorized=True, rows=None):
         features = self.featureExtractor.featuresOfTask(frontier.task)
         if features is None:
             return None, None
@@ -819,11 +853,11 @@ class RecognitionModel(nn.Module):
         else:
             features = self._MLP(features).unsqueeze(0)
             
-            ll = self.grammarBuilder.batchedLogLikelihoods(features, [entry.program]).view(-1)
+            ll = self.grammarBuilder.batchedLogLikelihoods(features, [entry.program], rows=rows).view(-1)
             return -ll, al
             
 
-    def frontierBiasOptimal(self, frontier, auxiliary=False, vectorized=True):
+    def frontierBiasOptimal(self, frontier, auxiliary=False, vectorized=True, rows=None):
         if not vectorized:
             features = self.featureExtractor.featuresOfTask(frontier.task)
             if features is None: return None, None
@@ -841,16 +875,65 @@ class RecognitionModel(nn.Module):
         al = self.auxiliaryLoss(frontier, features if auxiliary else features.detach())
         features = self._MLP(features)
         features = features.expand(batchSize, features.size(-1))  # TODO
-        lls = self.grammarBuilder.batchedLogLikelihoods(features, [entry.program for entry in frontier])
+        lls = self.grammarBuilder.batchedLogLikelihoods(features, [entry.program for entry in frontier], rows=rows)
         actual_ll = torch.Tensor([ entry.logLikelihood for entry in frontier])
         lls = lls + (actual_ll.cuda() if self.use_cuda else actual_ll)
         ml = -lls.max() #Beware that inputs to max change output type
         return ml, al
 
-    def replaceProgramsWithLikelihoodSummaries(self, frontier):
+    def minibatchLoss(self, frontiers, biasOptimal, auxiliary=False, rows=None, targets={}):
+        """Losses on a minibatch of frontiers whose programs are likelihood
+        summaries: their task features are stacked and go through the network
+        together. Frontiers whose features cannot be
+        extracted are dropped. rows: a SummaryRows from grammarBuilder.summaryRows().
+        targets: precomputed auxiliary targets, keyed by id of the frontier.
+        Returns (loss on each frontier used, classification loss, frontiers used)"""
+        features, kept = None, list(frontiers)
+        if hasattr(self.featureExtractor, 'featuresOfTasks'):
+            features = self.featureExtractor.featuresOfTasks([frontier.task for frontier in frontiers])
+        if features is None:
+            features, kept = [], []
+            for frontier in frontiers:
+                x = self.featureExtractor.featuresOfTask(frontier.task)
+                if x is None: continue
+                features.append(x)
+                kept.append(frontier)
+            if not kept: return None, None, []
+            features = torch.stack(features)
+
+        targets = torch.stack([targets[id(frontier)] if id(frontier) in targets
+                               else self.auxiliaryTarget(frontier)
+                               for frontier in kept])
+        if self.use_cuda: targets = targets.cuda()
+        al = self._auxiliaryLoss(self._auxiliaryPrediction(features if auxiliary else features.detach()),
+                                 targets)
+
+        # KL: a program sampled from each frontier; bias optimal: every program
+        if biasOptimal:
+            entries = [(b, k, entry) for b, frontier in enumerate(kept) for k, entry in enumerate(frontier)]
+        else:
+            entries = [(b, 0, frontier.sample()) for b, frontier in enumerate(kept)]
+        index = maybe_cuda(torch.tensor([b for b, _, _ in entries]), self.use_cuda)
+        xs = self._MLP(features).index_select(0, index)
+        summaries = [entry.program for _, _, entry in entries]
+        lls = self.grammarBuilder.batchedLogLikelihoods(xs, summaries, rows=rows)
+        if not biasOptimal:
+            return -lls, al, kept
+
+        lls = lls + maybe_cuda(torch.tensor([entry.logLikelihood for _, _, entry in entries]).float(),
+                               self.use_cuda)
+        # pad the frontiers to the same size, then take the best program of each
+        padded = maybe_cuda(torch.full((len(kept), max(len(f) for f in kept)), NEGATIVEINFINITY),
+                            self.use_cuda)
+        padded[index, maybe_cuda(torch.tensor([k for _, k, _ in entries]), self.use_cuda)] = lls
+        return -padded.max(1)[0], al, kept
+
+    def replaceProgramsWithLikelihoodSummaries(self, frontier, rows=None):
+        """rows: a SummaryRows that remembers the summaries"""
         return Frontier(
             [FrontierEntry(
-                program=self.grammar.closedLikelihoodSummary(frontier.task.request, e.program),
+                program=self.grammar.closedLikelihoodSummary(frontier.task.request, e.program) if rows is None
+                        else rows.summary(self.grammar, frontier.task.request, e.program),
                 logLikelihood=e.logLikelihood,
                 logPrior=e.logPrior) for e in frontier],
             task=frontier.task)
@@ -858,16 +941,24 @@ class RecognitionModel(nn.Module):
     def train(self, frontiers, _=None, steps=None, lr=0.001, topK=5, CPUs=1,
               timeout=None, evaluationTimeout=0.001,
               helmholtzFrontiers=[], helmholtzRatio=0., helmholtzBatch=500,
-              biasOptimal=None, defaultRequest=None, auxLoss=False, vectorized=True):
+              biasOptimal=None, defaultRequest=None, auxLoss=False, vectorized=True,
+              batchSize=1, rows=None):
         """
         helmholtzRatio: What fraction of the training data should be forward samples from the generative model?
         helmholtzFrontiers: Frontiers from programs enumerated from generative model (optional)
         If helmholtzFrontiers is not provided then we will sample programs during training
+        batchSize: How many frontiers go into each optimizer step. Steps are still
+        counted in frontiers, so `steps` bounds the amount of training data either way.
+        rows: the SummaryRows to train with, from grammarBuilder.summaryRows(), if
+        it has already seen the frontiers
         """
         assert (steps is not None) or (timeout is not None), \
             "Cannot train recognition model without either a bound on the number of gradient steps or bound on the training time"
         if steps is None: steps = 9999999
         if biasOptimal is None: biasOptimal = len(helmholtzFrontiers) > 0
+        TaskCache.of(self, "_frozenFeatures").clear()
+        # The summaries are turned into tensor rows once
+        if rows is None: rows = self.grammarBuilder.summaryRows()
         
         requests = [frontier.task.request for frontier in frontiers]
         if len(requests) == 0 and helmholtzRatio > 0 and len(helmholtzFrontiers) == 0:
@@ -887,7 +978,7 @@ class RecognitionModel(nn.Module):
                 self.request = frontier.task.request
                 self.task = None
                 self.programs = [e.program for e in frontier]
-                self.frontier = Thunk(lambda: owner.replaceProgramsWithLikelihoodSummaries(frontier))
+                self.frontier = Thunk(lambda: owner.replaceProgramsWithLikelihoodSummaries(frontier, rows))
                 self.owner = owner
 
             def clear(self): self.task = None
@@ -1000,8 +1091,11 @@ class RecognitionModel(nn.Module):
         # We replace each program in the frontier with its likelihoodSummary
         # This is because calculating likelihood summaries requires juggling types
         # And type stuff is expensive!
-        frontiers = [self.replaceProgramsWithLikelihoodSummaries(f).normalize()
+        frontiers = [self.replaceProgramsWithLikelihoodSummaries(f, rows).normalize()
                      for f in frontiers]
+        for f in frontiers:
+            for e in f: rows.row(e.program)
+        targets = {id(f): self.auxiliaryTarget(f) for f in frontiers} if batchSize > 1 else {}
 
         eprint("(ID=%d): Training a recognition model from %d frontiers, %d%% Helmholtz, feature extractor %s." % (
             self.id, len(frontiers), int(helmholtzRatio * 100), self.featureExtractor.__class__.__name__))
@@ -1011,15 +1105,53 @@ class RecognitionModel(nn.Module):
         eprint("(ID=%d): Bias optimal? %s" % (self.id, str(biasOptimal)))
         eprint(f"(ID={self.id}): Aux loss? {auxLoss} (n.b. we train a 'auxiliary' classifier anyway - this controls if gradients propagate back to the future extractor)")
 
-        # The number of Helmholtz samples that we generate at once
-        # Should only affect performance and shouldn't affect anything else
-        helmholtzSamples = []
+        # With CPUs to spare, dreams are made in the background while we train. On
+        # a single core the workers would only compete with the optimizer.
+        def produceDreams(k, workers):
+            if randomHelmholtz:
+                while True:
+                    f = self.sampleHelmholtz(requests)
+                    if f is not None: yield f
+            while True:
+                shard = list(range(k, len(helmholtzFrontiers), workers))
+                random.shuffle(shard)
+                for j in shard: yield j, helmholtzFrontiers[j].calculateTask()
+                if not self.featureExtractor.recomputeTasks: return
+
+        dreamer = [None]
+        dreamers = min(CPUs, numberOfCPUs()) - 1
+        if dreamers > 0 and helmholtzRatio > 0 and HelmholtzDreamer.possible():
+            eprint("(ID=%d): Dreaming on %d background CPUs" % (self.id, dreamers))
+            dreamer[0] = HelmholtzDreamer(produceDreams, dreamers)
+        dreamCount = [0]
+        def getDream():
+            dreamCount[0] += 1
+            while dreamer[0] is not None:
+                x = dreamer[0].get()
+                if x is None:
+                    # The workers are done, which means that every enumerated
+                    # frontier has its task; carry on without them
+                    dreamer[0].close()
+                    dreamer[0] = None
+                    if not randomHelmholtz and not self.featureExtractor.recomputeTasks:
+                        helmholtzFrontiers[:] = [f for f in helmholtzFrontiers if f.task is not None]
+                    break
+                if randomHelmholtz:
+                    e = HelmholtzEntry(x, self)
+                    e.task = x.task
+                    return e.makeFrontier()
+                j, task = x
+                if task is None: continue
+                helmholtzFrontiers[j].task = task
+                return helmholtzFrontiers[j].makeFrontier()
+            return getHelmholtz()
 
         optimizer = torch.optim.Adam(self.parameters(), lr=lr, eps=1e-3, amsgrad=True)
         start = time.time()
         losses, descriptionLengths, realLosses, dreamLosses, realMDL, dreamMDL = [], [], [], [], [], []
         classificationLosses = []
         totalGradientSteps = 0
+        minibatches = 0
         epochs = 9999999
         for i in range(1, epochs + 1):
             if timeout and time.time() - start > timeout:
@@ -1032,17 +1164,55 @@ class RecognitionModel(nn.Module):
                 permutedFrontiers = list(frontiers)
                 random.shuffle(permutedFrontiers)
             else:
-                permutedFrontiers = [None]
+                permutedFrontiers = [None]*batchSize
 
             finishedSteps = False
-            for frontier in permutedFrontiers:
+            # Minibatch mode: one optimizer step per batchSize frontiers
+            for b in range(0, len(permutedFrontiers) if batchSize > 1 else 0, batchSize):
+                batch = []
+                for frontier in permutedFrontiers[b:b + batchSize]:
+                    # Randomly decide whether to sample from the generative model
+                    dreaming = random.random() < helmholtzRatio
+                    batch.append((getDream(), True) if dreaming else (frontier, False))
+                self.zero_grad()
+                frontierLosses, classificationLoss, kept = \
+                        self.minibatchLoss([frontier for frontier, _ in batch], biasOptimal,
+                                           auxiliary=auxLoss, rows=rows, targets=targets)
+                dreams = {id(frontier) for frontier, dreaming in batch if dreaming}
+                if sum(id(frontier) not in dreams for frontier in kept) < sum(not dreaming for _, dreaming in batch):
+                    eprint("ERROR: Could not extract features during experience replay.")
+                    eprint("Aborting - we need to be able to extract features of every actual task.")
+                    assert False
+                if not kept: continue
+                loss = frontierLosses.mean()
+                if is_torch_invalid(loss):
+                    eprint("Invalid real-data loss!")
+                    continue
+                (loss + classificationLoss).backward()
+                classificationLosses.append(classificationLoss.data.item())
+                optimizer.step()
+                minibatches += 1
+                totalGradientSteps += len(kept)
+                for frontier, l in zip(kept, frontierLosses.data.tolist()):
+                    losses.append(l)
+                    descriptionLengths.append(min(-e.logPrior for e in frontier))
+                    if id(frontier) in dreams:
+                        dreamLosses.append(losses[-1])
+                        dreamMDL.append(descriptionLengths[-1])
+                    else:
+                        realLosses.append(losses[-1])
+                        realMDL.append(descriptionLengths[-1])
+                if totalGradientSteps > steps:
+                    break
+
+            for frontier in (permutedFrontiers if batchSize == 1 else []):
                 # Randomly decide whether to sample from the generative model
                 dreaming = random.random() < helmholtzRatio
-                if dreaming: frontier = getHelmholtz()
+                if dreaming: frontier = getDream()
                 self.zero_grad()
                 loss, classificationLoss = \
-                        self.frontierBiasOptimal(frontier, auxiliary=auxLoss, vectorized=vectorized) if biasOptimal \
-                        else self.frontierKL(frontier, auxiliary=auxLoss, vectorized=vectorized)
+                        self.frontierBiasOptimal(frontier, auxiliary=auxLoss, vectorized=vectorized, rows=rows) if biasOptimal \
+                        else self.frontierKL(frontier, auxiliary=auxLoss, vectorized=vectorized, rows=rows)
                 if loss is None:
                     if not dreaming:
                         eprint("ERROR: Could not extract features during experience replay.")
@@ -1077,12 +1247,15 @@ class RecognitionModel(nn.Module):
                 if realMDL and dreamMDL:
                     eprint("\t\t(real MDL): ", mean(realMDL), "\t(dream MDL):", mean(dreamMDL))
                 eprint("(ID=%d): " % self.id, "\t%d cumulative gradient steps. %f steps/sec"%(totalGradientSteps,
-                                                                       totalGradientSteps/(time.time() - start)))
+                                                                       totalGradientSteps/(time.time() - start)) +
+                       (" (in %d minibatches)"%minibatches if batchSize > 1 else "") +
+                       (". %f dreams/sec"%(dreamCount[0]/(time.time() - start)) if dreamCount[0] else ""))
                 eprint("(ID=%d): " % self.id, "\t%d-way auxiliary classification loss"%len(self.grammar.primitives),sum(classificationLosses)/len(classificationLosses))
                 losses, descriptionLengths, realLosses, dreamLosses, realMDL, dreamMDL = [], [], [], [], [], []
                 classificationLosses = []
                 gc.collect()
         
+        if dreamer[0] is not None: dreamer[0].close()
         eprint("(ID=%d): " % self.id, " Trained recognition model in",time.time() - start,"seconds")
         self.trained=True
         return self
@@ -1147,19 +1320,109 @@ class RecognitionModel(nn.Module):
                            CPUs=1,
                            frontierSize=None,
                            maximumFrontier=None,
-                           evaluationTimeout=None):
+                           evaluationTimeout=None,
+                           solverOptions=None,
+                           quantum=0.001):
         with timing("Evaluated recognition model"):
-            grammars = {task: self.grammarOfTask(task)
-                        for task in tasks}
-            #untorch seperately to make sure you filter out None grammars
-            grammars = {task: grammar.untorch() for task, grammar in grammars.items() if grammar is not None}
+            grammars = self.grammarsOfTasks(tasks, quantum=quantum)
+            eprint("%d distinct grammars for %d tasks" % (len(set(map(id, grammars.values()))), len(grammars)))
 
         return multicoreEnumeration(grammars, tasks,
                                     testing=testing,
                                     solver=solver,
                                     enumerationTimeout=enumerationTimeout,
                                     CPUs=CPUs, maximumFrontier=maximumFrontier,
-                                    evaluationTimeout=evaluationTimeout)
+                                    evaluationTimeout=evaluationTimeout,
+                                    solverOptions=solverOptions)
+
+
+def trainEnsemble(recognizers, frontiers, _=None, CPUs=1, helmholtzFrontiers=[], **keywords):
+    """Trains each of the recognizers like recognizer.train(frontiers, ...),
+    up to CPUs of them at a time. The likelihood summaries of the frontiers and
+    their tensor rows are made once, before forking, and the rows are put in
+    shared memory (SummaryRows.share), so that the workers read them instead
+    of each making its own; workers send back the state_dict of their model
+    rather than the model. Task features are not precomputed: the feature
+    extractor is trained too, so each worker computes them with its own
+    weights. Returns the recognizers."""
+    rows = recognizers[0].grammarBuilder.summaryRows()
+    for frontier in list(frontiers) + list(helmholtzFrontiers):
+        if frontier.empty: continue
+        for e in recognizers[0].replaceProgramsWithLikelihoodSummaries(frontier, rows):
+            rows.row(e.program)
+
+    def train(recognizer):
+        return recognizer.train(frontiers, CPUs=CPUs, helmholtzFrontiers=helmholtzFrontiers,
+                                rows=rows, **keywords)
+
+    workers = min(CPUs, len(recognizers))
+    if workers == 1: return [train(recognizer) for recognizer in recognizers]
+
+    rows.share()
+
+    states = parallelMap(workers, lambda recognizer: train(recognizer).state_dict(),
+                         recognizers, seedRandom=True)
+    for recognizer, state in zip(recognizers, states):
+        recognizer.load_state_dict(state)
+        recognizer.trained = True
+    return recognizers
+
+
+def enumerateEnsemble(recognizers, tasks, _=None, CPUs=1, **keywords):
+    """recognizer.enumerateFrontiers(tasks, ...) for each of the recognizers
+    at the same time, each in a forked process with its share of the CPUs.
+    CUDA does not survive a fork, so models on the GPU enumerate one after the other.
+    Returns a list of (frontiers, search times), one for each recognizer."""
+    if len(recognizers) == 1 or CPUs < len(recognizers) or \
+       any(recognizer.use_cuda for recognizer in recognizers):
+        return [recognizer.enumerateFrontiers(tasks, CPUs=CPUs, **keywords)
+                for recognizer in recognizers]
+
+    from multiprocessing import Process, Queue
+    from queue import Empty
+    import dill
+
+    q = Queue()
+    def work(k, CPUs):
+        try:
+            q.put(dill.dumps((k, recognizers[k].enumerateFrontiers(tasks, CPUs=CPUs, **keywords))))
+        except Exception:
+            eprint("Exception while enumerating from recognizer %d:\n%s" % (k, traceback.format_exc()))
+            q.put(dill.dumps((k, None)))
+
+    n = len(recognizers)
+    processes = [Process(target=work, args=(k, CPUs//n + int(k < CPUs % n)))
+                 for k in range(n)]
+    for p in processes: p.start()
+    results = [None]*n
+    remaining = n
+    # A worker that is killed, say by the OOM killer, never sends anything.
+    # Once one has exited, its message gets one more timeout to come through.
+    lastChance = False
+    while remaining > 0:
+        try:
+            k, result = dill.loads(q.get(timeout=1.))
+        except Empty:
+            dead = [k for k, p in enumerate(processes) if results[k] is None and p.exitcode is not None]
+            if dead and lastChance:
+                for p in processes: p.terminate()
+                assert False, "Enumeration from recognizer %d died with exit code %s" % \
+                    (dead[0], processes[dead[0]].exitcode)
+            lastChance = bool(dead)
+            continue
+        lastChance = False
+        if result is None:
+            for p in processes: p.terminate()
+        assert result is not None, "Enumeration from recognizer %d failed" % k
+        results[k] = result
+        remaining -= 1
+    for p in processes: p.join()
+
+    # the workers send back copies of the tasks
+    canonical = {t: t for t in tasks}
+    return [([Frontier(f.entries, task=canonical[f.task]) for f in frontiers],
+             {canonical[t]: dt for t, dt in times.items()})
+            for frontiers, times in results]
 
 
 class RecurrentFeatureExtractor(nn.Module):
@@ -1255,6 +1518,64 @@ class RecurrentFeatureExtractor(nn.Module):
         return {s: self.encoder(variable([self.symbolToIndex[s]])).squeeze(
             0).data.cpu().numpy() for s in self.lexicon if not (s in self.specialSymbols)}
 
+    def examplesTokens(self, examples):
+        """Token IDs of tokenized examples, as an NxT array padded with ENDING
+        and sorted in decreasing order of length, and the N lengths"""
+        es = []
+        for xs, y in examples:
+            e = [self.startingIndex]
+            for x in xs:
+                for s in x:
+                    e.append(self.symbolToIndex[s])
+                e.append(self.endOfInputIndex)
+            e.append(self.startOfOutputIndex)
+            for s in y:
+                e.append(self.symbolToIndex[s])
+            e.append(self.endingIndex)
+            es.append(e)
+        es.sort(key=len, reverse=True)
+        tokens = np.full((len(es), len(es[0])), self.endingIndex, dtype=np.int64)
+        for j, e in enumerate(es):
+            tokens[j, :len(e)] = e
+        return tokens, np.array([len(e) for e in es])
+
+    def tokensOfTask(self, t):
+        """examplesTokens of the examples (or features) of t, or None if they
+        do not tokenize. Tokenized once per task."""
+        def tokens(t):
+            tokenized = self.tokenize(t.features if hasattr(self, 'useFeatures') else t.examples)
+            if not tokenized: return None
+            return self.examplesTokens(tokenized)
+        return TaskCache.of(self).get(t, tokens)
+
+    def encodeTokens(self, tokensAndLengths):
+        """Takes (tokens, lengths) of B tasks; returns BxH features, the
+        average encoding of the examples of each task. All of the examples
+        go through the recurrent network together."""
+        tokens, lengths, owners = [], [], []
+        for b, (ts, ls) in enumerate(tokensAndLengths):
+            if len(ls) > self.MAXINPUTS:
+                keep = sorted(random.sample(range(len(ls)), self.MAXINPUTS))
+                ts, ls = ts[keep], ls[keep]
+            tokens.extend(ts)
+            lengths.extend(ls)
+            owners.extend([b]*len(ls))
+        order = sorted(range(len(lengths)), key=lambda j: lengths[j], reverse=True)
+        m = lengths[order[0]]
+        x = np.stack([np.pad(tokens[j], (0, m - len(tokens[j])), 'constant',
+                             constant_values=self.endingIndex)
+                      for j in order])
+        x = self.encoder(variable(x, cuda=self.use_cuda))
+        # x: TxBxE
+        x = pack_padded_sequence(x.permute(1, 0, 2), [int(lengths[j]) for j in order])
+        outputs, hidden = self.model(x)
+        e = hidden[0, :, :] + hidden[1, :, :]
+        # average the examples of each task
+        owners = maybe_cuda(torch.tensor([owners[j] for j in order]), self.use_cuda)
+        total = e.new_zeros(len(tokensAndLengths), e.size(1)).index_add(0, owners, e)
+        counts = e.new_zeros(len(tokensAndLengths)).index_add(0, owners, torch.ones_like(owners).float())
+        return total/counts.unsqueeze(1)
+
     def packExamples(self, examples):
         """IMPORTANT! xs must be sorted in decreasing order of size because pytorch is stupid"""
         es = []
@@ -1318,18 +1639,25 @@ class RecurrentFeatureExtractor(nn.Module):
         return e
 
     def featuresOfTask(self, t):
-        if hasattr(self, 'useFeatures'):
-            f = self(t.features)
-        else:
-            # Featurize the examples directly.
-            f = self(t.examples)
-        return f
+        tokens = self.tokensOfTask(t)
+        if tokens is None: return None
+        return self.encodeTokens([tokens])[0]
+
+    def featuresOfTasks(self, ts):
+        """BxH features of the tasks ts, or None if any of them has none"""
+        tokens = [self.tokensOfTask(t) for t in ts]
+        if any(x is None for x in tokens): return None
+        return self.encodeTokens(tokens)
 
     def taskOfProgram(self, p, tp):
         # half of the time we randomly mix together inputs
         # this gives better generalization on held out tasks
         # the other half of the time we train on sets of inputs in the training data
         # this gives better generalization on unsolved training tasks
+        timeout = self.helmholtzEvaluationTimeout
+        def run(xs):
+            return runWithTimeout(lambda: p.runWithArguments(xs, EvaluationBudget.forTimeout(timeout)), timeout)
+
         if random.random() < 0.5:
             def randomInput(t): return random.choice(self.argumentsWithType[t])
             # Loop over the inputs in a random order and pick the first ones that
@@ -1344,7 +1672,7 @@ class RecurrentFeatureExtractor(nn.Module):
                 # Grab some random inputs
                 xs = [randomInput(t) for t in tp.functionArguments()]
                 try:
-                    y = runWithTimeout(lambda: p.runWithArguments(xs), self.helmholtzEvaluationTimeout)
+                    y = run(xs)
                     examples.append((tuple(xs),y))
                     if len(examples) >= random.choice(self.requestToNumberOfExamples[tp]):
                         return Task("Helmholtz", tp, examples)
@@ -1356,7 +1684,7 @@ class RecurrentFeatureExtractor(nn.Module):
             for xss in candidateInputs:
                 ys = []
                 for xs in xss:
-                    try: y = runWithTimeout(lambda: p.runWithArguments(xs), self.helmholtzEvaluationTimeout)
+                    try: y = run(xs)
                     except: break
                     ys.append(y)
                 if len(ys) == len(xss):
@@ -1508,6 +1836,11 @@ class ImageFeatureExtractor(nn.Module):
         if insertBatch: y = y[0,:]
         return y
 
+    def featuresOfTask(self, t):
+        """Features of the image t.features, which is converted once per task"""
+        images = TaskCache.of(self, maximumSize=1000)
+        return self(images.get(t, lambda t: variable(t.features).float()))
+
 class JSONFeatureExtractor(object):
     def __init__(self, tasks, cudaFalse):
         # self.averages, self.deviations = Task.featureMeanAndStandardDeviation(tasks)
@@ -0,0 +1,348 @@
+"""Read-only, lazily loaded views of checkpoints, for analysis scripts.
+
+Views read an index of the checkpoint, a directory holding
+    index.json          scalars, lengths, and where every attribute lives
+    columns/<name>.npy  lists of numbers, like learningCurve or hitsAtEachWake
+    ragged/<name>.*.npy lists of lists of numbers, like searchTimes,
+                        flattened into values and offsets
+    metrics/<name>.npy  numeric per-task metrics in recognitionTaskMetrics,
+                        one row per task, with a state vector saying which
+                        rows are present and which are None
+    pickles/<name>      everything else, one dill pickle per attribute, with
+                        the tasks pickled once in pickles/tasks
+Arrays are opened memory mapped, and pickles are only read when the attribute
+is first used. A checkpoint directory already stores its attributes
+separately, so for those only the recognitionTaskMetrics that are not numbers
+are copied into the index, and the other attributes are read from the
+directory itself.
+
+CheckpointDirectory.export indexes every export, in <directory>/index/<line>.
+Other checkpoints, pickles and directories exported before there were indices,
+are indexed the first time they are opened, into indexCacheDirectory(). Views
+never write next to a checkpoint."""
+
+import hashlib
+import json
+import os
+import shutil
+
+import dill
+import numpy as np
+
+from dreamcoder.checkpoint import CheckpointDirectory, isCheckpointDirectory, \
+    _SegmentPickler, _SegmentUnpickler, TASKS
+from dreamcoder.dreamcoder import ECResult
+
+
+INDEX = "index.json"
+# the indices of a checkpoint directory, one per line of its manifest
+INDEXES = "index"
+METRICS = "recognitionTaskMetrics"
+# states of a row of a per-task metric
+ABSENT, PRESENT, NONE = 0, 1, 2
+
+
+def _numeric(value):
+    """value as a numeric array, or None if it is not made of numbers"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, np.number, np.ndarray, list)):
+        return None
+    try: a = np.asarray(value)
+    except ValueError: return None
+    if a.dtype.kind not in "biuf": return None
+    return a
+
+
+def _ragged(value):
+    """(values, offsets) for a list of lists of numbers, otherwise None"""
+    if not isinstance(value, list) or not all(isinstance(row, list) for row in value):
+        return None
+    rows = [_numeric(row) for row in value]
+    if any(row is None or row.ndim != 1 for row in rows): return None
+    offsets = np.cumsum([0] + [len(row) for row in rows]).astype(np.int64)
+    values = np.concatenate(rows) if any(len(row) for row in rows) else np.zeros(0)
+    return values, offsets
+
+
+class _Index(object):
+    """Writes an index directory"""
+    def __init__(self, path, source):
+        self.path = path
+        self.tasks = {}
+        self.entry = {"source": source, "scalars": {}, "lengths": {},
+                      "columns": [], "ragged": [], "metrics": [], "pickles": []}
+        for d in ["columns", "ragged", "metrics", "pickles"]:
+            os.makedirs(os.path.join(path, d))
+
+    def pickle(self, name, value):
+        with open(os.path.join(self.path, "pickles", name), "wb") as handle:
+            _SegmentPickler(handle, self.tasks).dump(value)
+        self.entry["pickles"].append(name)
+
+    def add(self, name, value, copyObjects=True):
+        """Indexes one attribute. Unless copyObjects, attributes that are not
+        numbers are left where they are."""
+        if hasattr(value, "__len__"): self.entry["lengths"][name] = len(value)
+        if value is None or isinstance(value, (bool, int, float, str)):
+            self.entry["scalars"][name] = value
+            return
+        if name == METRICS and isinstance(value, dict):
+            self.addMetrics(value)
+            return
+        if isinstance(value, list):
+            a = _numeric(value) if value else None
+            if a is not None and a.ndim == 1:
+                np.save(os.path.join(self.path, "columns", name + ".npy"), a)
+                self.entry["columns"].append(name)
+                return
+            r = _ragged(value)
+            if r is not None:
+                np.save(os.path.join(self.path, "ragged", name + ".values.npy"), r[0])
+                np.save(os.path.join(self.path, "ragged", name + ".offsets.npy"), r[1])
+                self.entry["ragged"].append(name)
+                return
+        if copyObjects: self.pickle(name, value)
+
+    def addMetrics(self, metrics):
+        """Numeric metrics become arrays with one row per key of metrics,
+        and the rest stays in a dictionary with the same keys"""
+        keys = list(metrics)
+        columns = {}
+        for row, k in enumerate(keys):
+            for m, v in metrics[k].items():
+                if columns.get(m, True) is None: continue
+                if v is None:
+                    columns.setdefault(m, {})[row] = None
+                    continue
+                a = _numeric(v)
+                rows = columns.setdefault(m, {})
+                shapes = {x.shape for x in rows.values() if x is not None}
+                if a is None or (shapes and shapes != {a.shape}):
+                    columns[m] = None
+                else: rows[row] = a
+        columns = {m: rows for m, rows in columns.items()
+                   if rows is not None and any(x is not None for x in rows.values())}
+
+        for m, rows in columns.items():
+            shape, = {x.shape for x in rows.values() if x is not None}
+            dtype = np.result_type(*[x.dtype for x in rows.values() if x is not None])
+            table = np.zeros((len(keys),) + shape, dtype=dtype)
+            state = np.full(len(keys), ABSENT, dtype=np.int8)
+            for row, x in rows.items():
+                if x is None: state[row] = NONE
+                else:
+                    table[row] = x
+                    state[row] = PRESENT
+            np.save(os.path.join(self.path, "metrics", m + ".npy"), table)
+            np.save(os.path.join(self.path, "metrics", m + ".state.npy"), state)
+            self.entry["metrics"].append(m)
+        self.pickle(METRICS, {k: {m: v for m, v in metrics[k].items() if m not in columns}
+                              for k in keys})
+
+    def finish(self):
+        with open(os.path.join(self.path, "pickles", TASKS), "wb") as handle:
+            dill.dump(self.tasks, handle)
+        with open(os.path.join(self.path, INDEX), "w") as handle:
+            json.dump(self.entry, handle)
+
+
+def indexCacheDirectory():
+    """Where the indices of checkpoints that do not come with one are kept"""
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(root, "dreamcoder", "resultView")
+
+
+def _cachedIndexPath(path, line):
+    key = os.path.realpath(path)
+    if line is not None: key += ":%d" % line
+    return os.path.join(indexCacheDirectory(), hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def sourceOfLine(manifest, chain):
+    """Identifies the exports that a line of a checkpoint directory is made of"""
+    exports = json.dumps([manifest[line] for line in chain], sort_keys=True)
+    return {"line": chain[-1], "exports": hashlib.sha1(exports.encode("utf-8")).hexdigest()}
+
+
+def _upToDate(indexPath, source):
+    if not os.path.exists(os.path.join(indexPath, INDEX)): return False
+    with open(os.path.join(indexPath, INDEX), "r") as handle:
+        return json.load(handle)["source"] == source
+
+
+def writeIndex(indexPath, source, attributes, directory=None):
+    """Indexes attributes, (name, value) pairs, into indexPath, replacing any
+    index there. For a checkpoint directory, directory names every attribute
+    it holds, and only numbers are copied into the index."""
+    temporary = "%s.%d" % (indexPath, os.getpid())
+    if os.path.exists(temporary): shutil.rmtree(temporary)
+    index = _Index(temporary, source)
+    for name, value in attributes:
+        index.add(name, value, copyObjects=directory is None)
+        del value
+    if directory is not None: index.entry["directory"] = sorted(directory)
+    index.finish()
+
+    if os.path.exists(indexPath): shutil.rmtree(indexPath)
+    os.replace(temporary, indexPath)
+
+
+def indexECResult(path, iteration=None):
+    """Returns (an up-to-date index of the checkpoint at path, the line of the
+    checkpoint directory it indexes, or None for a pickle). Checkpoints
+    without an index of their own are indexed into indexCacheDirectory()."""
+    if isCheckpointDirectory(path):
+        checkpoints = CheckpointDirectory(path)
+        manifest, chain = checkpoints.chain(iteration)
+        line = chain[-1]
+        source = sourceOfLine(manifest, chain)
+        indexPath = os.path.join(path, INDEXES, str(line))
+        if _upToDate(indexPath, source): return indexPath, line
+
+        indexPath = _cachedIndexPath(path, line)
+        if not _upToDate(indexPath, source):
+            names = {name for l in chain for name in manifest[l]["segments"]} - {TASKS}
+            writeIndex(indexPath, source,
+                       ((name, getattr(checkpoints.load(iteration=iteration, attributes={name}), name))
+                        for name in sorted(names)),
+                       directory=names)
+        return indexPath, line
+
+    assert iteration is None, "%s is a pickle, which only has its last iteration" % path
+    s = os.stat(path)
+    source = {"size": s.st_size, "mtime": s.st_mtime}
+    indexPath = _cachedIndexPath(path, None)
+    if not _upToDate(indexPath, source):
+        with open(path, "rb") as handle:
+            result = dill.load(handle)
+        writeIndex(indexPath, source, result.__dict__.items())
+        del result
+    return indexPath, None
+
+
+class _RaggedColumn(object):
+    """A list of lists of numbers, stored as flat values and offsets.
+    Rows come out as fresh lists."""
+    def __init__(self, values, offsets):
+        self.values = values
+        self.offsets = offsets
+
+    def __len__(self): return len(self.offsets) - 1
+
+    def row(self, j):
+        return self.values[self.offsets[j]:self.offsets[j + 1]].tolist()
+
+    def __getitem__(self, j):
+        if isinstance(j, slice): return [self.row(i) for i in range(*j.indices(len(self)))]
+        if j < 0: j += len(self)
+        if not (0 <= j < len(self)): raise IndexError(j)
+        return self.row(j)
+
+    def __iter__(self):
+        for j in range(len(self)): yield self.row(j)
+
+
+class _TaskMetrics(object):
+    """The metrics of one task: a row of each numeric metric, and a dictionary for the others"""
+    def __init__(self, view, row, others):
+        self.view = view
+        self.row = row
+        self.others = others
+
+    def state(self, m):
+        if m not in self.view._metrics: return ABSENT
+        return self.view._metric(m)[1][self.row]
+
+    def __contains__(self, m):
+        return m in self.others or self.state(m) != ABSENT
+
+    def __getitem__(self, m):
+        if m in self.others: return self.others[m]
+        s = self.state(m)
+        if s == ABSENT: raise KeyError(m)
+        if s == NONE: return None
+        return self.view._metric(m)[0][self.row]
+
+    def get(self, m, default=None):
+        return self[m] if m in self else default
+
+    def keys(self):
+        return list(self.others) + [m for m in self.view._metrics
+                                    if m not in self.others and self.state(m) != ABSENT]
+
+    def __iter__(self): return iter(self.keys())
+
+    def __len__(self): return len(self.keys())
+
+    def items(self): return [(m, self[m]) for m in self.keys()]
+
+    def values(self): return [self[m] for m in self.keys()]
+
+
+class ECResultView(ECResult):
+    """A read-only ECResult backed by an index of the checkpoint at path
+    (a pickle, or an iteration of a checkpoint directory). Attributes are
+    read the first time they are used. Assigning to an attribute only
+    changes the view, never the checkpoint."""
+
+    def __init__(self, path, iteration=None):
+        self._path = path
+        self._indexPath, self._line = indexECResult(path, iteration)
+        with open(os.path.join(self._indexPath, INDEX), "r") as handle:
+            self._index = json.load(handle)
+        self._metrics = set(self._index["metrics"])
+        self._metricArrays = {}
+        self._tasks = None
+
+    def __repr__(self):
+        return "ECResultView(%s)" % self._path
+
+    def length(self, name):
+        """len(getattr(self, name)), without loading the attribute"""
+        if name in self._index["lengths"]: return self._index["lengths"][name]
+        return len(getattr(self, name))
+
+    def _array(self, *path):
+        return np.load(os.path.join(self._indexPath, *path), mmap_mode="r")
+
+    def _metric(self, m):
+        if m not in self._metricArrays:
+            self._metricArrays[m] = (self._array("metrics", m + ".npy"),
+                                     self._array("metrics", m + ".state.npy"))
+        return self._metricArrays[m]
+
+    def _taskTable(self):
+        if self._tasks is None:
+            with open(os.path.join(self._indexPath, "pickles", TASKS), "rb") as handle:
+                self._tasks = dill.load(handle)
+        return self._tasks
+
+    def _pickle(self, name):
+        with open(os.path.join(self._indexPath, "pickles", name), "rb") as handle:
+            return _SegmentUnpickler(handle, self._taskTable).load()
+
+    def _load(self, name):
+        index = self._index
+        if name in index["scalars"]: return index["scalars"][name]
+        if name in index["columns"]: return self._array("columns", name + ".npy")
+        if name in index["ragged"]:
+            return _RaggedColumn(self._array("ragged", name + ".values.npy"),
+                                 self._array("ragged", name + ".offsets.npy"))
+        if name == METRICS and name in index["pickles"]:
+            others = self._pickle(name)
+            return {k: _TaskMetrics(self, row, ms) for row, (k, ms) in enumerate(others.items())}
+        if name in index["pickles"]: return self._pickle(name)
+        if name in index.get("directory", []):
+            checkpoints = CheckpointDirectory(self._path)
+            iteration = checkpoints.manifest()[self._line]["iteration"]
+            _, chain = checkpoints.chain(iteration)
+            assert chain[-1] == self._line, \
+                "%s was branched after it was indexed; open it again" % self._path
+            return getattr(checkpoints.load(iteration=iteration, attributes={name}), name)
+        raise AttributeError(name)
+
+    def __getattr__(self, name):
+        # only called for attributes that have not been loaded yet
+        if name.startswith("_"): raise AttributeError(name)
+        value = self._load(name)
+        setattr(self, name, value)
+        return value
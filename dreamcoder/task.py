@@ -1,14 +1,113 @@
 from dreamcoder.program import *
 from dreamcoder.differentiation import *
 
-import signal
+import hashlib
+import os
+from collections import OrderedDict
 
 
 class EvaluationTimeout(Exception):
     pass
 
 
-EVALUATIONTABLE = {}
+class EvaluationCache(object):
+    """Bounded cache from (program, input) to output, shared by every task.
+    Keys are content addressed, digests of the program's text and of the pickled
+    input, so tasks with the same inputs share entries and keys mean the same
+    thing in every process. The least recently used entries are evicted beyond
+    maximumSize. Given a path, entries are also kept in an sqlite database there,
+    which every enumeration worker of a run reads and writes. Hits and misses are
+    counted in each process; workers send theirs back with their results (see
+    wrapInThread)."""
+    MISSING = object()
+
+    def __init__(self, maximumSize=100000, path=None):
+        self.maximumSize = maximumSize
+        self.path = path
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # sqlite connections must not be shared across a fork
+        self._connection = None
+        self._connectionPID = None
+
+    @staticmethod
+    def digest(x):
+        """Programs are digested by their text, which names them uniquely. Other
+        values are pickled, because str prints different values the same way (numpy
+        elides long arrays, for instance). Values that cannot be pickled have no
+        digest, and None is returned."""
+        if isinstance(x, Program):
+            data = str(x).encode("utf-8")
+        else:
+            try:
+                data = pickle.dumps(x, protocol=4)
+            except Exception:
+                return None
+        return hashlib.md5(data).digest()
+
+    @property
+    def connection(self):
+        if self.path is None: return None
+        if self._connectionPID != os.getpid():
+            import sqlite3
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=OFF")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS evaluations (key BLOB PRIMARY KEY, value BLOB)")
+            self._connectionPID = os.getpid()
+        return self._connection
+
+    def lookup(self, key):
+        """Returns the cached output, or EvaluationCache.MISSING"""
+        value = self.table.get(key, EvaluationCache.MISSING)
+        if value is not EvaluationCache.MISSING:
+            self.table.move_to_end(key)
+        elif self.path is not None:
+            row = self.connection.execute("SELECT value FROM evaluations WHERE key = ?",
+                                          (key,)).fetchone()
+            if row is not None:
+                value = pickle.loads(row[0])
+                self._remember(key, value)
+        if value is EvaluationCache.MISSING: self.misses += 1
+        else: self.hits += 1
+        return value
+
+    def _remember(self, key, value):
+        self.table[key] = value
+        if len(self.table) > self.maximumSize:
+            self.table.popitem(last=False)
+
+    def record(self, key, value):
+        self._remember(key, value)
+        if self.path is not None:
+            try:
+                value = pickle.dumps(value)
+            except Exception:
+                # eg functions
+                return
+            self.connection.execute("INSERT OR REPLACE INTO evaluations VALUES (?, ?)",
+                                    (key, value))
+
+    def statistics(self):
+        """(hits, misses) so far in this process"""
+        return self.hits, self.misses
+
+    def clear(self):
+        self.table.clear()
+        if self.path is not None:
+            self.connection.execute("DELETE FROM evaluations")
+
+
+EVALUATIONTABLE = EvaluationCache()
+
+
+def configureEvaluationCache(maximumSize=100000, path=None):
+    """Replaces the cache used by tasks built with cache=True. Call it before
+    enumerating, so that the workers inherit it."""
+    global EVALUATIONTABLE
+    EVALUATIONTABLE = EvaluationCache(maximumSize=maximumSize, path=path)
+    return EVALUATIONTABLE
 
 
 class Task(object):
@@ -57,20 +156,25 @@ class Task(object):
             f = f(a)
         return f
 
+    @property
+    def inputDigests(self):
+        if getattr(self, "_inputDigests", None) is None:
+            self._inputDigests = [EvaluationCache.digest(x) for x, _ in self.examples]
+        return self._inputDigests
+
     @property
     def supervision(self):
         if not hasattr(self, 'supervisedSolution'): return None
         return self.supervisedSolution
 
     def check(self, e, timeout=None):
-        if timeout is not None:
-            def timeoutCallBack(_1, _2): raise EvaluationTimeout()
+        # Programs stop themselves when they run out of fuel; the backstop only
+        # catches primitives that run away without calling back into the program
+        budget = EvaluationBudget.forTimeout(timeout)
+        Backstop.arm(timeout, EvaluationTimeout)
         try:
-            signal.signal(signal.SIGVTALRM, timeoutCallBack)
-            signal.setitimer(signal.ITIMER_VIRTUAL, timeout)
-
             try:
-                f = e.evaluate([])
+                f = e.compile(budget)(())
             except IndexError:
                 # free variable
                 return False
@@ -78,33 +182,38 @@ class Task(object):
                 eprint("Exception during evaluation:", e)
                 return False
 
-            for x, y in self.examples:
-                if self.cache and (x, e) in EVALUATIONTABLE:
-                    p = EVALUATIONTABLE[(x, e)]
-                else:
+            if self.cache:
+                programKey = EvaluationCache.digest(e)
+                inputKeys = self.inputDigests
+            for n, (x, y) in enumerate(self.examples):
+                p = EvaluationCache.MISSING
+                key = None
+                if self.cache and inputKeys[n] is not None:
+                    key = programKey + inputKeys[n]
+                    p = EVALUATIONTABLE.lookup(key)
+                if p is EvaluationCache.MISSING:
+                    # Only evaluations that ran to completion are cached. Running out
+                    # of time or fuel says nothing about a run with another budget.
                     try:
                         p = self.predict(f, x)
-                    except BaseException:
+                    except (EvaluationTimeout, OutOfFuel):
+                        raise
+                    except Exception:
                         p = None
-                    if self.cache:
-                        EVALUATIONTABLE[(x, e)] = p
+                    if key is not None:
+                        EVALUATIONTABLE.record(key, p)
                 if p != y:
-                    if timeout is not None:
-                        signal.signal(signal.SIGVTALRM, lambda *_: None)
-                        signal.setitimer(signal.ITIMER_VIRTUAL, 0)
                     return False
 
             return True
         # except e:
             # eprint(e)
             # assert(False)
-        except EvaluationTimeout:
+        except (EvaluationTimeout, OutOfFuel):
             eprint("Timed out while evaluating", e)
             return False
         finally:
-            if timeout is not None:
-                signal.signal(signal.SIGVTALRM, lambda *_: None)
-                signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+            Backstop.disarm()
 
     def logLikelihood(self, e, timeout=None):
         if self.check(e, timeout):
@@ -180,7 +289,7 @@ class DifferentiableTask(Task):
         if self.actualParameters is not None and len(
                 parameters) > self.actualParameters:
             return NEGATIVEINFINITY
-        f = e.evaluate([])
+        f = e.compile()(())
 
         loss = sum(self.loss(self.predict(f, xs), y)
                    for xs, y in self.examples) / float(len(self.examples))
@@ -1,3 +1,6 @@
+import threading
+
+
 class UnificationFailure(Exception):
     pass
 
@@ -97,6 +100,12 @@ class TypeConstructor(Type):
         return TypeConstructor(self.name,
                                [a.negateVariables() for a in self.arguments])
 
+    def shiftVariables(self, n):
+        if not self.isPolymorphic or n == 0:
+            return self
+        return TypeConstructor(self.name,
+                               [a.shiftVariables(n) for a in self.arguments])
+
     def instantiate(self, context, bindings=None):
         if not self.isPolymorphic:
             return context, self
@@ -186,6 +195,31 @@ class TypeVariable(Type):
         context = Context(context.nextVariable + 1, context.substitution)
         return (context, new)
 
+    # The same, going through the context's lookup, compress and makeVariable,
+    # so that they also work on the persistent contexts.
+    # PersistentContext.enable() puts them in place of the ones above.
+    def applyLookup(self, context):
+        t = context.lookup(self.v)
+        if t is None:
+            return self
+        return t.apply(context)
+
+    def applyMutableLookup(self, context):
+        s = context.lookup(self.v)
+        if s is None: return self
+        new = s.applyMutable(context)
+        if new is not s: context.compress(self.v, new)
+        return new
+
+    def instantiateLookup(self, context, bindings=None):
+        if bindings is None:
+            bindings = {}
+        if self.v in bindings:
+            return (context, bindings[self.v])
+        context, new = context.makeVariable()
+        bindings[self.v] = new
+        return (context, new)
+
     def instantiateMutable(self, context, bindings=None):
         if bindings is None: bindings = {}
         if self.v in bindings: return bindings[self.v]
@@ -205,15 +239,34 @@ class TypeVariable(Type):
     def negateVariables(self):
         return TypeVariable(-1 - self.v)
 
+    def shiftVariables(self, n):
+        if n == 0:
+            return self
+        return TypeVariable(self.v + n)
+
 
 class Context(object):
+    """An immutable type substitution: a list of (variable, type), most recent first,
+    plus the next free variable. PersistentContext has the same interface."""
     def __init__(self, nextVariable=0, substitution=[]):
         self.nextVariable = nextVariable
         self.substitution = substitution
 
+    def lookup(self, j):
+        for v, t in self.substitution:
+            if v == j:
+                return t
+        return None
+
     def extend(self, j, t):
         return Context(self.nextVariable, [(j, t)] + self.substitution)
 
+    def extendMany(self, nextVariable, substitution):
+        """The context that has nextVariable as its next variable, and the extra bindings in substitution"""
+        if not substitution and nextVariable == self.nextVariable:
+            return self
+        return Context(nextVariable, list(substitution) + self.substitution)
+
     def makeVariable(self):
         return (Context(self.nextVariable + 1, self.substitution),
                 TypeVariable(self.nextVariable))
@@ -252,10 +305,20 @@ class MutableContext(object):
     def __init__(self):
         self.substitution = []
 
+    @property
+    def nextVariable(self): return len(self.substitution)
+
+    def lookup(self, i):
+        return self.substitution[i]
+
     def extend(self,i,t):
         assert self.substitution[i] is None
         self.substitution[i] = t
 
+    def compress(self, i, t):
+        """Path compression: i is bound to something that resolves to t"""
+        self.substitution[i] = t
+
     def makeVariable(self):
         self.substitution.append(None)
         return TypeVariable(len(self.substitution) - 1)
@@ -287,7 +350,243 @@ class MutableContext(object):
             self.unify(x, y)
 
 
+class PersistentArray(object):
+    """A persistent array, in the style of Baker's trick and Conchon & Filliatre's
+    persistent union-find. Every version behaves as an immutable value, but only
+    one of them holds the underlying list; the others are chains of diffs that lead
+    to it. Touching a version "reroots" the list to it, which is cheap when versions
+    are used the way a backtracking search uses them (mostly the newest one, with
+    an occasional step back). Entries that were never written read as None.
+    All versions of one array share the list, so they also share a lock, which
+    anything that reads or writes the list has to hold."""
+    __slots__ = ["data", "lock"]
+
+    def __init__(self, data=None, lock=None):
+        # either a list (this version holds the array), or (changes, next version)
+        self.data = [] if data is None else data
+        self.lock = threading.Lock() if lock is None else lock
+
+    def _reroot(self):
+        path = []
+        node = self
+        while node.data.__class__ is not list:
+            path.append(node)
+            node = node.data[1]
+        for child in reversed(path):
+            changes, _ = child.data
+            data = node.data
+            inverse = []
+            for i, v in changes:
+                if i >= len(data): data.extend([None]*(i + 1 - len(data)))
+                inverse.append((i, data[i]))
+                data[i] = v
+            inverse.reverse()
+            child.data = data
+            node.data = (inverse, child)
+            node = child
+        return self.data
+
+    def toList(self):
+        with self.lock:
+            return list(self._reroot())
+
+    def get(self, i):
+        with self.lock:
+            data = self._reroot()
+            return data[i] if i < len(data) else None
+
+    def update(self, changes):
+        """Returns a new version with the (index, value) pairs in changes written"""
+        with self.lock:
+            data = self._reroot()
+            inverse = []
+            for i, v in changes:
+                if i >= len(data): data.extend([None]*(i + 1 - len(data)))
+                inverse.append((i, data[i]))
+                data[i] = v
+            inverse.reverse()
+            new = PersistentArray(data, self.lock)
+            self.data = (inverse, new)
+            return new
+
+
+def _applyInPlace(t, data):
+    """t.apply(context), where data is the array holding the context's bindings"""
+    if t.__class__ is TypeVariable:
+        if t.v < len(data):
+            b = data[t.v]
+            if b is not None: return _applyInPlace(b, data)
+        return t
+    if not t.isPolymorphic:
+        return t
+    return TypeConstructor(t.name, [_applyInPlace(x, data) for x in t.arguments])
+
+
+def _unifyInPlace(t1, t2, data, trail):
+    t1 = _applyInPlace(t1, data)
+    t2 = _applyInPlace(t2, data)
+    if t1 == t2:
+        return
+    # t1&t2 are not equal
+    if not t1.isPolymorphic and not t2.isPolymorphic:
+        raise UnificationFailure(t1, t2)
+
+    if isinstance(t1, TypeVariable):
+        if t2.occurs(t1.v):
+            raise Occurs()
+        j, t = t1.v, t2
+    elif isinstance(t2, TypeVariable):
+        if t1.occurs(t2.v):
+            raise Occurs()
+        j, t = t2.v, t1
+    else:
+        if t1.name != t2.name:
+            raise UnificationFailure(t1, t2)
+        for x, y in zip(t2.arguments, t1.arguments):
+            _unifyInPlace(x, y, data, trail)
+        return
+    if j >= len(data): data.extend([None]*(j + 1 - len(data)))
+    trail.append((j, data[j]))
+    data[j] = t
+
+
+class PersistentContext(object):
+    """Context, with the substitution kept in a PersistentArray indexed by variable
+    instead of a list of bindings: looking a variable up is an index, and extending
+    the context does not copy anything. It pays for the rerooting, and loses to the
+    list on small contexts (see bin/benchmarkContexts.py), so it is opt-in:
+    PersistentContext.enable() makes emptyContext() return PersistentContext.EMPTY,
+    and MutableContext() build a PersistentMutableContext."""
+    enabled = False
+
+    @staticmethod
+    def enable():
+        # TypeVariable only goes through lookup and makeVariable once this has
+        # been called, so that substitution lists cost nothing extra otherwise
+        PersistentContext.enabled = True
+        TypeVariable.apply = TypeVariable.applyLookup
+        TypeVariable.applyMutable = TypeVariable.applyMutableLookup
+        TypeVariable.instantiate = TypeVariable.instantiateLookup
+        MutableContext.__new__ = staticmethod(_newMutableContext)
+
+    @staticmethod
+    def disable():
+        PersistentContext.enabled = False
+        TypeVariable.apply, TypeVariable.applyMutable, TypeVariable.instantiate = _SUBSTITUTIONLISTMETHODS
+        if "__new__" in MutableContext.__dict__: del MutableContext.__new__
+
+    def __init__(self, nextVariable=0, substitution=[]):
+        self.nextVariable = nextVariable
+        self.bindings = PersistentArray()
+        if substitution:
+            self.bindings = self.bindings.update(reversed(substitution))
+
+    @staticmethod
+    def _make(nextVariable, bindings):
+        context = PersistentContext.__new__(PersistentContext)
+        context.nextVariable = nextVariable
+        context.bindings = bindings
+        return context
+
+    @property
+    def substitution(self):
+        """[(variable, type)], most recent variable first"""
+        data = self.bindings.toList()
+        return [(j, data[j]) for j in reversed(range(len(data))) if data[j] is not None]
+
+    def lookup(self, j):
+        return self.bindings.get(j)
+
+    def extend(self, j, t):
+        return PersistentContext._make(self.nextVariable, self.bindings.update([(j, t)]))
+
+    def extendMany(self, nextVariable, substitution):
+        """The context that has nextVariable as its next variable, and the extra bindings in substitution"""
+        if not substitution:
+            if nextVariable == self.nextVariable: return self
+            return PersistentContext._make(nextVariable, self.bindings)
+        return PersistentContext._make(nextVariable, self.bindings.update(substitution))
+
+    def makeVariable(self):
+        return (PersistentContext._make(self.nextVariable + 1, self.bindings),
+                TypeVariable(self.nextVariable))
+
+    def unify(self, t1, t2):
+        """Unification is done in place on the array, keeping a trail of what it
+        overwrote, and the trail is then undone: this context keeps the array, and
+        the result is a diff on top of it. Unifying many types against one context
+        (which is what building candidates does) so never has to reroot."""
+        bindings = self.bindings
+        with bindings.lock:
+            data = bindings._reroot()
+            trail = []
+            try:
+                _unifyInPlace(t1, t2, data, trail)
+            finally:
+                changes = [(i, data[i]) for i, _ in trail]
+                for i, old in reversed(trail): data[i] = old
+        if not changes:
+            return self
+        return PersistentContext._make(self.nextVariable,
+                                       PersistentArray((changes, bindings), bindings.lock))
+
+    def __str__(self):
+        return "Context(next = %d, {%s})" % (self.nextVariable, ", ".join(
+            "t%d ||> %s" % (k, v.apply(self)) for k, v in self.substitution))
+
+    def __repr__(self): return str(self)
+
+class PersistentMutableContext(MutableContext):
+    """MutableContext on the PersistentArray engine.
+    snapshot() and rollback() undo everything that was unified in between."""
+    def __init__(self):
+        self._nextVariable = 0
+        self.bindings = PersistentArray()
+
+    @property
+    def nextVariable(self): return self._nextVariable
+
+    @property
+    def substitution(self):
+        return [self.bindings.get(j) for j in range(self._nextVariable)]
+
+    def lookup(self, i):
+        return self.bindings.get(i)
+
+    def extend(self,i,t):
+        assert self.bindings.get(i) is None
+        self.bindings = self.bindings.update([(i, t)])
+
+    def compress(self, i, t):
+        """Path compression: i is bound to something that resolves to t"""
+        self.bindings = self.bindings.update([(i, t)])
+
+    def makeVariable(self):
+        self._nextVariable += 1
+        return TypeVariable(self._nextVariable - 1)
+
+    def snapshot(self):
+        return self._nextVariable, self.bindings
+
+    def rollback(self, snapshot):
+        self._nextVariable, self.bindings = snapshot
+
+
+def _newMutableContext(cls):
+    if cls is MutableContext and PersistentContext.enabled:
+        cls = PersistentMutableContext
+    return object.__new__(cls)
+
+
+_SUBSTITUTIONLISTMETHODS = (TypeVariable.apply, TypeVariable.applyMutable, TypeVariable.instantiate)
+
 Context.EMPTY = Context(0, [])
+PersistentContext.EMPTY = PersistentContext(0, [])
+
+
+def emptyContext():
+    """The context that enumeration, likelihoods and type inference start from"""
+    return PersistentContext.EMPTY if PersistentContext.enabled else Context.EMPTY
 
 
 def canonicalTypes(ts):
@@ -341,7 +640,7 @@ def arrow(*arguments):
 
 
 def inferArg(tp, tcaller):
-    ctx, tp = tp.instantiate(Context.EMPTY)
+    ctx, tp = tp.instantiate(emptyContext())
     ctx, tcaller = tcaller.instantiate(ctx)
     ctx, targ = ctx.makeVariable()
     ctx = ctx.unify(tcaller, arrow(targ, tp))
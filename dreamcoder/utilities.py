@@ -1,3 +1,4 @@
+import atexit
 import inspect
 import signal
 import random
@@ -6,7 +7,9 @@ import traceback
 import sys
 import os
 import subprocess
+import threading
 import math
+import gc
 import pickle as pickle
 from itertools import chain
 import heapq
@@ -196,10 +199,16 @@ def parallelMap(numberOfCPUs, f, *xs, chunksize=None, maxtasksperchild=None, mem
     # Batch size of jobs as they are sent to processes
     if chunksize is None:
         chunksize = max(1, n // (numberOfCPUs * 2))
-    pool = Pool(numberOfCPUs, maxtasksperchild=maxtasksperchild)
-    ys = pool.map(parallelMapCallBack, permutation,
-                  chunksize=chunksize)
-    pool.terminate()
+    # Keep the garbage collector of the workers from walking, and so
+    # copying, everything they inherit from us
+    if hasattr(gc, "freeze"): gc.freeze()
+    try:
+        pool = Pool(numberOfCPUs, maxtasksperchild=maxtasksperchild)
+        ys = pool.map(parallelMapCallBack, permutation,
+                      chunksize=chunksize)
+        pool.terminate()
+    finally:
+        if hasattr(gc, "unfreeze"): gc.unfreeze()
 
     PARALLELMAPDATA = None
     PARALLELBASESEED = None
@@ -340,11 +349,20 @@ def _launchParallelProcess():
         raise e
 
 
-def jsonBinaryInvoke(binary, message):
+def jsonBinaryInvoke(binary, message, _=None, binaryProtocol=False):
+    """Sends message to binary on stdin and parses its reply.
+    binaryProtocol: use msgpack frames (binary is invoked with --msgpack) instead of json."""
     import json
     import subprocess
     import os
 
+    if binaryProtocol and binaryProtocolAvailable():
+        process = subprocess.Popen([binary, "--msgpack"],
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        response, error = process.communicate(frameMessage(message))
+        return unframeMessage(response)
+
     message = json.dumps(message)
     try:
         process = subprocess.Popen(binary,
@@ -364,6 +382,100 @@ def jsonBinaryInvoke(binary, message):
         raise e
     return response
 
+
+# Binary framed messages for the ocaml binaries: a 4-byte big-endian length,
+# followed by the msgpack encoding of what would otherwise have been json.
+def binaryProtocolAvailable():
+    try:
+        import msgpack
+        return True
+    except ImportError:
+        return False
+
+
+# binary path -> (modification time, capabilities)
+BINARYCAPABILITIES = {}
+
+def binaryCapabilities(binary):
+    """The protocol features that an ocaml binary says it has, as a frozenset:
+    "server", "msgpack" and "stream" for the solver, "msgpack" for helmholtz.
+    A binary that is missing, or that was built before --capabilities existed,
+    has none of them, so that callers can fall back to one-shot json.
+    Asked again whenever the binary is rebuilt."""
+    try:
+        modified = os.path.getmtime(binary)
+    except OSError:
+        return frozenset()
+    if binary in BINARYCAPABILITIES and BINARYCAPABILITIES[binary][0] == modified:
+        return BINARYCAPABILITIES[binary][1]
+    import json
+    try:
+        # older binaries read a job from stdin instead, and find it empty
+        process = subprocess.run([binary, "--capabilities"],
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL, timeout=10)
+        capabilities = frozenset(json.loads(process.stdout.decode("utf-8")))
+    except Exception:
+        capabilities = frozenset()
+    BINARYCAPABILITIES[binary] = (modified, capabilities)
+    return capabilities
+
+
+class Prepacked(object):
+    """A value that has already been msgpack-encoded.
+    packMessage copies it into the output as is, so that things which never
+    change over a run (like task examples) only get encoded once."""
+    def __init__(self, value):
+        import msgpack
+        self.data = msgpack.packb(value, use_bin_type=False)
+
+
+def packMessage(message):
+    import msgpack
+    packer = msgpack.Packer(use_bin_type=False)
+    chunks = []
+
+    def pack(x):
+        if isinstance(x, Prepacked):
+            chunks.append(x.data)
+        elif isinstance(x, dict):
+            chunks.append(packer.pack_map_header(len(x)))
+            for k, v in x.items():
+                chunks.append(packer.pack(k))
+                pack(v)
+        elif isinstance(x, (list, tuple)) and any(isinstance(v, (Prepacked, dict)) for v in x):
+            chunks.append(packer.pack_array_header(len(x)))
+            for v in x: pack(v)
+        else:
+            chunks.append(packer.pack(x))
+
+    pack(message)
+    return b"".join(chunks)
+
+
+def frameMessage(message):
+    import struct
+    payload = packMessage(message)
+    return struct.pack(">I", len(payload)) + payload
+
+
+def unframeMessage(data):
+    import msgpack
+    import struct
+    assert len(data) >= 4, "Binary response is missing its frame header"
+    n, = struct.unpack(">I", data[:4])
+    assert len(data) >= 4 + n, "Binary response is truncated"
+    return msgpack.unpackb(data[4:4 + n], raw=False)
+
+
+def readFrame(stream):
+    """Reads one frame from a file-like object. Returns None at end of file."""
+    import struct
+    header = stream.read(4)
+    if len(header) < 4: return None
+    n, = struct.unpack(">I", header)
+    return unframeMessage(header + stream.read(n))
+
     
 class CompiledTimeout(Exception):
     pass
@@ -695,26 +807,64 @@ class RunWithTimeout(Exception):
     pass
 
 
+class Backstop(object):
+    """Coarse timeout for code that should normally stop itself.
+    Arming pushes a deadline and disarming pops it, so backstops nest; when a
+    deadline passes, the exception it was armed with is raised, once. One
+    periodic profiling timer per process checks the deadlines: it is started
+    the first time a deadline is armed and left running, so that arming and
+    disarming make no system calls. Signals are only delivered to the main
+    thread, so elsewhere arming and disarming do nothing."""
+    interval = 0.05
+    # [deadline, exception], innermost last. The deadline is None once it has
+    # fired, or if the backstop was armed without a timeout.
+    deadlines = []
+    process = None
+
+    @staticmethod
+    def callBack(_1, _2):
+        if not Backstop.deadlines: return
+        now = time.monotonic()
+        for entry in Backstop.deadlines:
+            if entry[0] is not None and now > entry[0]:
+                entry[0] = None
+                raise entry[1]()
+
+    @staticmethod
+    def start():
+        # a forked child has no timer, and none of its parent's backstops
+        signal.signal(signal.SIGPROF, Backstop.callBack)
+        signal.setitimer(signal.ITIMER_PROF, Backstop.interval, Backstop.interval)
+        # the interpreter restores the default action, termination, as it exits
+        atexit.register(signal.setitimer, signal.ITIMER_PROF, 0)
+        Backstop.deadlines = []
+        Backstop.process = os.getpid()
+
+    @staticmethod
+    def arm(timeout, exception):
+        """Every call on the main thread has to be matched by a call to disarm"""
+        if threading.current_thread() is not threading.main_thread(): return False
+        if Backstop.process != os.getpid():
+            if timeout is None: return False
+            Backstop.start()
+        Backstop.deadlines.append([None if timeout is None else time.monotonic() + timeout,
+                                   exception])
+        return timeout is not None
+
+    @staticmethod
+    def disarm():
+        if threading.current_thread() is not threading.main_thread(): return
+        if Backstop.process != os.getpid() or not Backstop.deadlines: return
+        Backstop.deadlines.pop()
+
+
 def runWithTimeout(k, timeout):
     if timeout is None: return k()
-    def timeoutCallBack(_1,_2):
-        raise RunWithTimeout()
-    signal.signal(signal.SIGPROF, timeoutCallBack)
-    signal.setitimer(signal.ITIMER_PROF, timeout)
-    
+    Backstop.arm(timeout, RunWithTimeout)
     try:
-        result = k()
-        signal.signal(signal.SIGPROF, lambda *_:None)
-        signal.setitimer(signal.ITIMER_PROF, 0)
-        return result
-    except RunWithTimeout:
-        signal.signal(signal.SIGPROF, lambda *_:None)
-        signal.setitimer(signal.ITIMER_PROF, 0)
-        raise RunWithTimeout()
-    except:
-        signal.signal(signal.SIGPROF, lambda *_:None)
-        signal.setitimer(signal.ITIMER_PROF, 0)
-        raise
+        return k()
+    finally:
+        Backstop.disarm()
 
 
 def crossProduct(a, b):
@@ -1,5 +1,8 @@
 from dreamcoder.grammar import *
 
+from array import array
+from collections import OrderedDict
+
 epsilon = 0.001
 
 
@@ -12,7 +15,7 @@ def instantiate(context, environment, tp):
     return context, newEnvironment, tp
 
 def unify(*environmentsAndTypes):
-    k = Context.EMPTY
+    k = emptyContext()
     e = {}
     k,t = k.makeVariable()
     for e_,t_ in environmentsAndTypes:
@@ -40,35 +43,37 @@ class Union(Program):
     def __repr__(self): return str(self)
     def __iter__(self): return iter(self.elements)
 
-class VersionTable():
-    def __init__(self, typed=True, identity=True, factored=False):
-        self.factored = factored
-        self.identity = identity
-        self.typed = typed
-        self.debug = False
-        if self.debug:
-            print("WARNING: running version spaces in debug mode. Will be substantially slower.")
-        
-        self.expressions = []
-        self.recursiveTable = []
-        self.substitutionTable = {}
-        self.expression2index = {}
-        self.maximumShift = []
-        # Table containing (minimum cost, set of minimum cost programs)
-        self.inhabitantTable = []
-        # Table containing (minimum cost, set of minimum cost programs NOT starting w/ abstraction)
-        self.functionInhabitantTable = []
-        self.superCache = {}
-
-        self.overlapTable = {}
-        
-        self.universe = self.incorporate(Primitive("U",t0,None))
-        self.empty = self.incorporate(Union([], canBeEmpty=True))
-
-    def __len__(self): return len(self.expressions)
-
-    def clearOverlapTable(self):
-        self.overlapTable = {}
+class VersionColumns():
+    """Version spaces stored as columns: an opcode for each version space,
+    and two integers whose meaning depends on the opcode
+        INDEX         first: the de Bruijn index
+        LEAF          first: where the primitive or invention is in self.leaves
+        ABSTRACTION   first: the body
+        APPLICATION   first, second: the function and the argument
+        UNION         first, second: where its members start in self.elements,
+                      and how many there are
+    Subclasses provide the columns and self.leaves, self.universe,
+    self.empty and self.overlapTable; this is everything that only reads them."""
+    INDEX, LEAF, ABSTRACTION, APPLICATION, UNION = range(5)
+
+    def __len__(self): return len(self.opcodes)
+
+    def members(self, j):
+        """the version spaces in the union j"""
+        start = self.first[j]
+        return self.elements[start:start + self.second[j]]
+
+    def leaf(self, j):
+        if self.opcodes[j] == self.INDEX: return Index(self.first[j])
+        return self.leaves[self.first[j]]
+
+    def expression(self, j):
+        """j as a Program whose children are the indices of version spaces"""
+        o = self.opcodes[j]
+        if o == self.ABSTRACTION: return Abstraction(self.first[j])
+        if o == self.APPLICATION: return Application(self.first[j], self.second[j])
+        if o == self.UNION: return Union(self.members(j), canBeEmpty=True)
+        return self.leaf(j)
 
     def visualize(self, j):
         from graphviz import Digraph
@@ -78,53 +83,49 @@ class VersionTable():
         def walk(i):
             if i in visited: return
 
+            o = self.opcodes[i]
             if i == self.universe:
                 g.node(str(i), 'universe')
             elif i == self.empty:
                 g.node(str(i), 'nil')
+            elif o == self.ABSTRACTION:
+                g.node(str(i), "lambda")
+                walk(self.first[i])
+                g.edge(str(i), str(self.first[i]))
+            elif o == self.APPLICATION:
+                g.node(str(i), "@")
+                walk(self.first[i])
+                walk(self.second[i])
+                g.edge(str(i), str(self.first[i]), label='f')
+                g.edge(str(i), str(self.second[i]), label='x')
+            elif o == self.UNION:
+                g.node(str(i), "U")
+                for c in self.members(i):
+                    walk(c)
+                    g.edge(str(i), str(c))
             else:
-                l = self.expressions[i]
-                if l.isIndex or l.isPrimitive or l.isInvented:
-                    g.node(str(i), str(l))
-                elif l.isAbstraction:
-                    g.node(str(i), "lambda")
-                    walk(l.body)
-                    g.edge(str(i), str(l.body))
-                elif l.isApplication:
-                    g.node(str(i), "@")
-                    walk(l.f)
-                    walk(l.x)
-                    g.edge(str(i), str(l.f), label='f')
-                    g.edge(str(i), str(l.x), label='x')
-                elif l.isUnion:
-                    g.node(str(i), "U")
-                    for c in l:
-                        walk(c)
-                        g.edge(str(i), str(c))
-                else:
-                    assert False
+                g.node(str(i), str(self.leaf(i)))
             visited.add(i)
         walk(j)
         g.render(view=True)
 
     def branchingFactor(self,j):
-        l = self.expressions[j]
-        if l.isApplication: return max(self.branchingFactor(l.f),
-                                       self.branchingFactor(l.x))
-        if l.isUnion: return max([len(l.elements)] + [self.branchingFactor(e) for e in l ])
-        if l.isAbstraction: return self.branchingFactor(l.body)
+        o = self.opcodes[j]
+        if o == self.APPLICATION: return max(self.branchingFactor(self.first[j]),
+                                             self.branchingFactor(self.second[j]))
+        if o == self.UNION: return max([self.second[j]] + [self.branchingFactor(e) for e in self.members(j) ])
+        if o == self.ABSTRACTION: return self.branchingFactor(self.first[j])
         return 0
-            
-        
+
+
     def intention(self,j, isFunction=False):
-        l = self.expressions[j]
-        if l.isIndex or l.isPrimitive or l.isInvented: return l
-        if l.isAbstraction: return Abstraction(self.intention(l.body))
-        if l.isApplication: return Application(self.intention(l.f),
-                                               self.intention(l.x))
-        if l.isUnion: return Union(self.intention(e)
-                                   for e in l )
-        assert False
+        o = self.opcodes[j]
+        if o == self.ABSTRACTION: return Abstraction(self.intention(self.first[j]))
+        if o == self.APPLICATION: return Application(self.intention(self.first[j]),
+                                                     self.intention(self.second[j]))
+        if o == self.UNION: return Union(self.intention(e)
+                                         for e in self.members(j) )
+        return self.leaf(j)
 
     def walk(self,j):
         """yields every subversion space of j"""
@@ -132,64 +133,32 @@ class VersionTable():
         def r(n):
             if n in visited: return
             visited.add(n)
-            l = self.expressions[n]
-            yield l
-            if l.isApplication:
-                yield from r(l.f)
-                yield from r(l.x)
-            if l.isAbstraction:
-                yield from r(l.body)
-            if l.isUnion:
-                for e in l:
+            yield self.expression(n)
+            o = self.opcodes[n]
+            if o == self.APPLICATION:
+                yield from r(self.first[n])
+                yield from r(self.second[n])
+            if o == self.ABSTRACTION:
+                yield from r(self.first[n])
+            if o == self.UNION:
+                for e in self.members(n):
                     yield from r(e)
         yield from r(j)
 
-                
-    def incorporate(self,p):
-        #assert isinstance(p,Union)# or p.wellTyped()
-        if p.isIndex or p.isPrimitive or p.isInvented:
-            pass
-        elif p.isAbstraction:
-            p = Abstraction(self.incorporate(p.body))
-        elif p.isApplication:
-            p = Application(self.incorporate(p.f),
-                            self.incorporate(p.x))
-        elif p.isUnion:
-            if len(p.elements) > 0:
-                p = Union([self.incorporate(e) for e in p ])
-        else: assert False
-
-        j = self._incorporate(p)
-        return j
-
-    def _incorporate(self,p):
-        if p in self.expression2index: return self.expression2index[p]
-
-        j = len(self.expressions)
-        
-        self.expressions.append(p)
-        self.expression2index[p] = j
-        self.recursiveTable.append(None)
-        self.inhabitantTable.append(None)
-        self.functionInhabitantTable.append(None)
-        
-        return j
-
     def extract(self,j):
-        l = self.expressions[j]
-        if l.isAbstraction:
-            for b in self.extract(l.body):
+        o = self.opcodes[j]
+        if o == self.ABSTRACTION:
+            for b in self.extract(self.first[j]):
                 yield Abstraction(b)
-        elif l.isApplication:
-            for f in self.extract(l.f):
-                for x in self.extract(l.x):
+        elif o == self.APPLICATION:
+            for f in self.extract(self.first[j]):
+                for x in self.extract(self.second[j]):
                     yield Application(f,x)
-        elif l.isIndex or l.isPrimitive or l.isInvented:
-            yield l
-        elif l.isUnion:
-            for e in l:
+        elif o == self.UNION:
+            for e in self.members(j):
                 yield from self.extract(e)
-        else: assert False
+        else:
+            yield self.leaf(j)
 
     def reachable(self, heads):
         visited = set()
@@ -197,55 +166,177 @@ class VersionTable():
             if j in visited: return
             visited.add(j)
 
-            l = self.expressions[j]
-            if l.isUnion:
-                for e in l:
+            o = self.opcodes[j]
+            if o == self.UNION:
+                for e in self.members(j):
                     visit(e)
-            elif l.isAbstraction: visit(l.body)
-            elif l.isApplication:
-                visit(l.f)
-                visit(l.x)
+            elif o == self.ABSTRACTION: visit(self.first[j])
+            elif o == self.APPLICATION:
+                visit(self.first[j])
+                visit(self.second[j])
 
         for h in heads:
             visit(h)
         return visited
 
     def size(self,j):
-        l = self.expressions[j]
-        if l.isApplication:
-            return self.size(l.f) + self.size(l.x)
-        elif l.isAbstraction:
-            return self.size(l.body)
-        elif l.isUnion:
-            return sum(self.size(e) for e in l )
+        o = self.opcodes[j]
+        if o == self.APPLICATION:
+            return self.size(self.first[j]) + self.size(self.second[j])
+        elif o == self.ABSTRACTION:
+            return self.size(self.first[j])
+        elif o == self.UNION:
+            return sum(self.size(e) for e in self.members(j) )
         else:
             return 1
-            
+
+    def clearOverlapTable(self):
+        self.overlapTable = {}
+
+    def haveOverlap(self,a,b):
+        if a == self.empty or b == self.empty: return False
+        if a == self.universe: return True
+        if b == self.universe: return True
+        if a == b: return True
+
+        if a in self.overlapTable:
+            if b in self.overlapTable[a]:
+                return self.overlapTable[a][b]
+        else: self.overlapTable[a] = {}
+
+        x = self.opcodes[a]
+        y = self.opcodes[b]
+
+        if x == self.ABSTRACTION and y == self.ABSTRACTION:
+            overlap = self.haveOverlap(self.first[a], self.first[b])
+        elif x == self.APPLICATION and y == self.APPLICATION:
+            overlap = self.haveOverlap(self.first[a], self.first[b]) and \
+                self.haveOverlap(self.second[a], self.second[b])
+        elif x == self.UNION:
+            overlap = any( self.haveOverlap(x_, b)
+                           for x_ in self.members(a) )
+        elif y == self.UNION:
+            overlap = any( self.haveOverlap(a, y_)
+                           for y_ in self.members(b) )
+        else:
+            overlap = False
+        self.overlapTable[a][b] = overlap
+        return overlap
+
+
+class VersionTable(VersionColumns):
+    def __init__(self, typed=True, identity=True, factored=False):
+        self.factored = factored
+        self.identity = identity
+        self.typed = typed
+        self.debug = False
+        if self.debug:
+            print("WARNING: running version spaces in debug mode. Will be substantially slower.")
+
+        self.opcodes = array('b')
+        self.first = array('i')
+        self.second = array('i')
+        self.elements = array('i')
+        self.leaves = []
+        # (opcode, first, second), or (UNION, sorted members...) -> version space
+        self.expression2index = {}
+        # primitive or invention -> where it is in self.leaves
+        self.leaf2index = {}
+
+        # -1 until the recursive inversion is calculated
+        self.recursiveTable = array('i')
+        self.substitutionTable = {}
+        # Minimum cost, and set of minimum cost programs (None until calculated)
+        self.inhabitantCost = array('d')
+        self.inhabitants = []
+        # Minimum cost, and set of minimum cost programs NOT starting w/ abstraction
+        self.functionInhabitantCost = array('d')
+        self.functionInhabitants = []
+        self.superCache = {}
+
+        self.overlapTable = {}
+
+        self.universe = self.incorporate(Primitive("U",t0,None))
+        self.empty = self._incorporateUnion(frozenset())
+
+    def clearCaches(self):
+        """Forgets the inversions, inhabitants and substitutions calculated so far"""
+        n = len(self)
+        self.recursiveTable = array('i', [-1])*n
+        self.inhabitantCost = array('d', [0.])*n
+        self.inhabitants = [None]*n
+        self.functionInhabitantCost = array('d', [0.])*n
+        self.functionInhabitants = [None]*n
+        self.substitutionTable = {}
+
+    def incorporate(self,p):
+        #assert isinstance(p,Union)# or p.wellTyped()
+        if p.isIndex:
+            return self.index(p.i)
+        if p.isPrimitive or p.isInvented:
+            if p not in self.leaf2index:
+                self.leaf2index[p] = len(self.leaves)
+                self.leaves.append(p)
+            return self._incorporate(self.LEAF, self.leaf2index[p])
+        if p.isAbstraction:
+            return self._incorporate(self.ABSTRACTION, self.incorporate(p.body))
+        if p.isApplication:
+            return self._incorporate(self.APPLICATION,
+                                     self.incorporate(p.f), self.incorporate(p.x))
+        if p.isUnion:
+            return self._incorporateUnion(frozenset(self.incorporate(e) for e in p ))
+        assert False
+
+    def _incorporate(self, opcode, first, second=-1):
+        key = (opcode, first, second)
+        j = self.expression2index.get(key)
+        if j is not None: return j
+        return self._append(key, opcode, first, second)
+
+    def _incorporateUnion(self, elements):
+        key = (self.UNION,) + tuple(sorted(elements))
+        j = self.expression2index.get(key)
+        if j is not None: return j
+        start = len(self.elements)
+        self.elements.extend(elements)
+        return self._append(key, self.UNION, start, len(elements))
+
+    def _append(self, key, opcode, first, second):
+        j = len(self.opcodes)
+        self.opcodes.append(opcode)
+        self.first.append(first)
+        self.second.append(second)
+        self.expression2index[key] = j
+        self.recursiveTable.append(-1)
+        self.inhabitantCost.append(0.)
+        self.inhabitants.append(None)
+        self.functionInhabitantCost.append(0.)
+        self.functionInhabitants.append(None)
+        return j
 
     def union(self,elements):
         if self.universe in elements: return self.universe
-        
+
         _e = []
         for e in elements:
-            if self.expressions[e].isUnion:
-                for j in self.expressions[e]:
-                    _e.append(j)
+            if self.opcodes[e] == self.UNION:
+                _e.extend(self.members(e))
             elif e != self.empty:
                 _e.append(e)
 
         elements = frozenset(_e)
         if len(elements) == 0: return self.empty
         if len(elements) == 1: return next(iter(elements))
-        return self._incorporate(Union(elements))
+        return self._incorporateUnion(elements)
     def apply(self,f,x):
         if f == self.empty: return f
         if x == self.empty: return x
-        return self._incorporate(Application(f,x))
+        return self._incorporate(self.APPLICATION, f, x)
     def abstract(self,b):
         if b == self.empty: return self.empty
-        return self._incorporate(Abstraction(b))
+        return self._incorporate(self.ABSTRACTION, b)
     def index(self,i):
-        return self._incorporate(Index(i))
+        return self._incorporate(self.INDEX, i)
 
     def intersection(self,a,b):
         if a == self.empty or b == self.empty: return self.empty
@@ -253,85 +344,50 @@ class VersionTable():
         if b == self.universe: return a
         if a == b: return a
 
-        x = self.expressions[a]
-        y = self.expressions[b]
+        x = self.opcodes[a]
+        y = self.opcodes[b]
 
-        if x.isAbstraction and y.isAbstraction:
-            return self.abstract(self.intersection(x.body,y.body))
-        if x.isApplication and y.isApplication:
-            return self.apply(self.intersection(x.f,y.f),
-                              self.intersection(x.x,y.x))
-        if x.isUnion:
-            if y.isUnion:
+        if x == self.ABSTRACTION and y == self.ABSTRACTION:
+            return self.abstract(self.intersection(self.first[a],self.first[b]))
+        if x == self.APPLICATION and y == self.APPLICATION:
+            return self.apply(self.intersection(self.first[a],self.first[b]),
+                              self.intersection(self.second[a],self.second[b]))
+        if x == self.UNION:
+            if y == self.UNION:
                 return self.union([ self.intersection(x_,y_)
-                                    for x_ in x
-                                    for y_ in y ])
+                                    for x_ in self.members(a)
+                                    for y_ in self.members(b) ])
             return self.union([ self.intersection(x_, b)
-                                for x_ in x ])
-        if y.isUnion:
+                                for x_ in self.members(a) ])
+        if y == self.UNION:
             return self.union([ self.intersection(a, y_)
-                                for y_ in y ])
+                                for y_ in self.members(b) ])
         return self.empty
 
-    def haveOverlap(self,a,b):
-        if a == self.empty or b == self.empty: return False
-        if a == self.universe: return True
-        if b == self.universe: return True
-        if a == b: return True
-
-        if a in self.overlapTable:
-            if b in self.overlapTable[a]:
-                return self.overlapTable[a][b]
-        else: self.overlapTable[a] = {}
-
-        x = self.expressions[a]
-        y = self.expressions[b]
-
-        if x.isAbstraction and y.isAbstraction:
-            overlap = self.haveOverlap(x.body,y.body)
-        elif x.isApplication and y.isApplication:
-            overlap = self.haveOverlap(x.f,y.f) and \
-                self.haveOverlap(x.x,y.x)
-        elif x.isUnion:
-            if y.isUnion:
-                overlap = any( self.haveOverlap(x_,y_)
-                            for x_ in x
-                            for y_ in y )
-            overlap = any( self.haveOverlap(x_, b)
-                        for x_ in x )
-        elif y.isUnion:
-            overlap = any( self.haveOverlap(a, y_)
-                        for y_ in y )
-        else:
-            overlap = False
-        self.overlapTable[a][b] = overlap
-        return overlap
-
     def minimalInhabitants(self,j):
         """Returns (minimal size, set of singleton version spaces)"""
         assert isinstance(j,int)
-        if self.inhabitantTable[j] is not None: return self.inhabitantTable[j]
-        e = self.expressions[j]
-        if e.isAbstraction:
-            cost, members = self.minimalInhabitants(e.body)
+        if self.inhabitants[j] is not None: return self.inhabitantCost[j], self.inhabitants[j]
+        o = self.opcodes[j]
+        if o == self.ABSTRACTION:
+            cost, members = self.minimalInhabitants(self.first[j])
             cost = cost + epsilon
             members = {self.abstract(m) for m in members}
-        elif e.isApplication:
-            fc, fm = self.minimalFunctionInhabitants(e.f)
-            xc, xm = self.minimalInhabitants(e.x)
+        elif o == self.APPLICATION:
+            fc, fm = self.minimalFunctionInhabitants(self.first[j])
+            xc, xm = self.minimalInhabitants(self.second[j])
             cost = fc + xc + epsilon
             members = {self.apply(f_,x_)
                        for f_ in fm for x_ in xm }
-        elif e.isUnion:
+        elif o == self.UNION:
             children = [self.minimalInhabitants(z)
-                        for z in e ]
+                        for z in self.members(j) ]
             cost = min(c for c,_ in children)
             members = {zp
                        for c,z in children
                        if c == cost
                        for zp in z }
         else:
-            assert e.isIndex or e.isInvented or e.isPrimitive
             cost = 1
             members = {j}
 
@@ -339,60 +395,63 @@ class VersionTable():
         # if len(members) > 1:
         #     for m in members: break
         #     members = {m}
-        self.inhabitantTable[j] = (cost, members)
-        
+        self.inhabitantCost[j] = cost
+        self.inhabitants[j] = members
+
         return cost, members
 
     def minimalFunctionInhabitants(self,j):
         """Returns (minimal size, set of singleton version spaces)"""
         assert isinstance(j,int)
-        if self.functionInhabitantTable[j] is not None: return self.functionInhabitantTable[j]
-        e = self.expressions[j]
-        if e.isAbstraction:
+        if self.functionInhabitants[j] is not None:
+            return self.functionInhabitantCost[j], self.functionInhabitants[j]
+        o = self.opcodes[j]
+        if o == self.ABSTRACTION:
             cost = POSITIVEINFINITY
             members = set()
-        elif e.isApplication:
-            fc, fm = self.minimalFunctionInhabitants(e.f)
-            xc, xm = self.minimalInhabitants(e.x)
+        elif o == self.APPLICATION:
+            fc, fm = self.minimalFunctionInhabitants(self.first[j])
+            xc, xm = self.minimalInhabitants(self.second[j])
             cost = fc + xc + epsilon
             members = {self.apply(f_,x_)
                        for f_ in fm for x_ in xm }
-        elif e.isUnion:
+        elif o == self.UNION:
             children = [self.minimalFunctionInhabitants(z)
-                        for z in e ]
+                        for z in self.members(j) ]
             cost = min(c for c,_ in children)
             members = {zp
                        for c,z in children
                        if c == cost
                        for zp in z }
         else:
-            assert e.isIndex or e.isInvented or e.isPrimitive
             cost = 1
             members = {j}
 
         # if len(members) > 1:
         #     for m in members: break
         #     members = {m}
-            
-        self.functionInhabitantTable[j] = (cost, members)
+
+        self.functionInhabitantCost[j] = cost
+        self.functionInhabitants[j] = members
         return cost, members
 
     def shiftFree(self,j,n,c=0):
         if n == 0: return j
-        l = self.expressions[j]
-        if l.isUnion:
+        o = self.opcodes[j]
+        if o == self.UNION:
             return self.union([ self.shiftFree(e,n,c)
-                                for e in l ])
-        if l.isApplication:
-            return self.apply(self.shiftFree(l.f,n,c),
-                              self.shiftFree(l.x,n,c))
-        if l.isAbstraction:
-            return self.abstract(self.shiftFree(l.body,n,c+1))
-        if l.isIndex:
-            if l.i < c: return j
-            if l.i >= n + c: return self.index(l.i - n)
+                                for e in self.members(j) ])
+        if o == self.APPLICATION:
+            return self.apply(self.shiftFree(self.first[j],n,c),
+                              self.shiftFree(self.second[j],n,c))
+        if o == self.ABSTRACTION:
+            return self.abstract(self.shiftFree(self.first[j],n,c+1))
+        if o == self.INDEX:
+            i = self.first[j]
+            if i < c: return j
+            if i >= n + c: return self.index(i - n)
             return self.empty
-        assert l.isPrimitive or l.isInvented
+        assert o == self.LEAF
         return j
 
     def substitutions(self,j):
@@ -404,8 +463,8 @@ class VersionTable():
 
     def _substitutions(self,j,n):
         if (j,n) in self.substitutionTable: return self.substitutionTable[(j,n)]
-        
-        
+
+
         s = self.shiftFree(j,n)
         if self.debug:
             assert set(self.extract(s)) == set( e.shift(-n)
@@ -425,19 +484,19 @@ class VersionTable():
             else:
                 m = {s: self.index(n)}
 
-        l = self.expressions[j]
-        if l.isPrimitive or l.isInvented:
+        o = self.opcodes[j]
+        if o == self.LEAF:
             m[(self.universe,t0) if self.typed else self.universe] = j
-        elif l.isIndex:
+        elif o == self.INDEX:
             m[(self.universe,t0) if self.typed else self.universe] = \
-                    j if l.i < n else self.index(l.i + 1)
-        elif l.isAbstraction:
-            for v,b in self._substitutions(l.body, n + 1).items():
+                    j if self.first[j] < n else self.index(self.first[j] + 1)
+        elif o == self.ABSTRACTION:
+            for v,b in self._substitutions(self.first[j], n + 1).items():
                 m[v] = self.abstract(b)
-        elif l.isApplication and not self.factored:
+        elif o == self.APPLICATION and not self.factored:
             newMapping = {}
-            fm = self._substitutions(l.f,n)
-            xm = self._substitutions(l.x,n)
+            fm = self._substitutions(self.first[j],n)
+            xm = self._substitutions(self.second[j],n)
             for v1,f in fm.items():
                 if self.typed: v1,nType1 = v1
                 for v2,x in xm.items():
@@ -452,13 +511,13 @@ class VersionTable():
                                                          self.infer(a)[0].get(n,t0))
                         except UnificationFailure:
                             continue
-                        
+
                     v = self.intersection(v1,v2)
                     if v == self.empty: continue
                     if self.typed and self.infer(v) == self.bottom: continue
 
-                    key = (v,nType) if self.typed else v                        
-                        
+                    key = (v,nType) if self.typed else v
+
                     if key in newMapping:
                         newMapping[key].append(a)
                     else:
@@ -468,10 +527,10 @@ class VersionTable():
             newMapping.update(m)
             m = newMapping
             # print(f"substitutions: |{len(fm)}|x|{len(xm)}| = {len(m)}\t{len(m) <= len(fm)+len(xm)}")
-        elif l.isApplication and self.factored:
+        elif o == self.APPLICATION and self.factored:
             newMapping = {}
-            fm = self._substitutions(l.f,n)
-            xm = self._substitutions(l.x,n)
+            fm = self._substitutions(self.first[j],n)
+            xm = self._substitutions(self.second[j],n)
             for v1,f in fm.items():
                 if self.typed: v1,nType1 = v1
                 for v2,x in xm.items():
@@ -488,9 +547,9 @@ class VersionTable():
                 xs = self.union(list(xs))
                 m[v] = self.apply(fs,xs)
             # print(f"substitutions: |{len(fm)}|x|{len(xm)}| = {len(m)}\t{len(m) <= len(fm)+len(xm)}")
-        elif l.isUnion:
+        elif o == self.UNION:
             newMapping = {}
-            for e in l:
+            for e in self.members(j):
                 for v,b in self._substitutions(e,n).items():
                     if v in newMapping:
                         newMapping[v].append(b)
@@ -533,12 +592,12 @@ class VersionTable():
 
 
     def recursiveInversion(self,j):
-        if self.recursiveTable[j] is not None: return self.recursiveTable[j]
-        
-        l = self.expressions[j]
-        if l.isUnion:
-            return self.union([self.recursiveInversion(e) for e in l ])
-        
+        if self.recursiveTable[j] != -1: return self.recursiveTable[j]
+
+        o = self.opcodes[j]
+        if o == self.UNION:
+            return self.union([self.recursiveInversion(e) for e in self.members(j) ])
+
         t = [self.apply(self.abstract(b),v)
              for v,b in self.substitutions(j)
              if v != self.universe and (self.identity or b != self.index(0))]
@@ -563,13 +622,14 @@ class VersionTable():
             assert self.infer(ru) == self.infer(j)
 
 
-        if l.isApplication:
-            t.append(self.apply(self.recursiveInversion(l.f),l.x))
-            t.append(self.apply(l.f,self.recursiveInversion(l.x)))
-        elif l.isAbstraction:
-            t.append(self.abstract(self.recursiveInversion(l.body)))
+        if o == self.APPLICATION:
+            f, x = self.first[j], self.second[j]
+            t.append(self.apply(self.recursiveInversion(f),x))
+            t.append(self.apply(f,self.recursiveInversion(x)))
+        elif o == self.ABSTRACTION:
+            t.append(self.abstract(self.recursiveInversion(self.first[j])))
 
-        ru = self.union(t)        
+        ru = self.union(t)
         self.recursiveTable[j] = ru
         return ru
 
@@ -578,7 +638,7 @@ class VersionTable():
         for _ in range(n):
             spaces.append(self.recursiveInversion(spaces[-1]))
         return spaces
-            
+
     def rewriteReachable(self,heads,n):
         vertices = self.reachable(heads)
         spaces = {v: self.repeatedExpansion(v,n)
@@ -594,43 +654,40 @@ class VersionTable():
         spaces = self.rewriteReachable({j}, n)
         def superSpace(i):
             assert i in spaces
-            e = self.expressions[i]
+            o = self.opcodes[i]
             components = [i] + spaces[i]
-            if e.isIndex or e.isPrimitive or e.isInvented:
-                pass
-            elif e.isAbstraction:
-                components.append(self.abstract(superSpace(e.body)))
-            elif e.isApplication:
-                components.append(self.apply(superSpace(e.f), superSpace(e.x)))
-            elif e.isUnion: assert False
-            else: assert False
-            
+            if o == self.ABSTRACTION:
+                components.append(self.abstract(superSpace(self.first[i])))
+            elif o == self.APPLICATION:
+                components.append(self.apply(superSpace(self.first[i]), superSpace(self.second[i])))
+            else: assert o != self.UNION
+
             return self.union(components)
         self.superCache[j] = superSpace(j)
         return self.superCache[j]
-            
+
     def loadEquivalences(self, g, spaces):
-        versionClasses = [None]*len(self.expressions)
+        versionClasses = [None]*len(self)
         def extract(j):
             if versionClasses[j] is not None:
                 return versionClasses[j]
-            
-            l = self.expressions[j]
-            if l.isAbstraction:
+
+            o = self.opcodes[j]
+            if o == self.ABSTRACTION:
                 ks = g.setOfClasses(g.abstractClass(b)
-                                    for b in extract(l.body))
-            elif l.isApplication:
-                fs = extract(l.f)
-                xs = extract(l.x)
+                                    for b in extract(self.first[j]))
+            elif o == self.APPLICATION:
+                fs = extract(self.first[j])
+                xs = extract(self.second[j])
                 ks = g.setOfClasses(g.applyClass(f,x)
                                     for x in xs for f in fs )
-            elif l.isUnion:
-                ks = g.setOfClasses(e for u in l for e in extract(u))
+            elif o == self.UNION:
+                ks = g.setOfClasses(e for u in self.members(j) for e in extract(u))
             else:
-                ks = g.setOfClasses({g.incorporate(l)})
+                ks = g.setOfClasses({g.incorporate(self.leaf(j))})
             versionClasses[j] = ks
             return ks
-            
+
 
         N = len(next(iter(spaces.values())))
         vertices = list(sorted(spaces.keys(), key=lambda v: self.size(v)))
@@ -658,11 +715,11 @@ class VersionTable():
                     else:
                         typedClassesOfVertex[v][e] = e
 
-    def bestInventions(self, versions, bs=25):
+    def bestInventions(self, versions, bs=25, CPUs=None):
         """versions: [[version index]]"""
         """bs: beam size"""
+        """CPUs: how many workers compute the beams (default: all of them)"""
         """returns: list of (indices to) candidates"""
-        import gc
         
         def nontrivial(proposal):
             primitives = 0
@@ -694,23 +751,118 @@ class VersionTable():
             # thus using a candidate with free variables is more expensive
             candidateCost = {k: len(set(next(self.extract(k)).freeVariables())) + 1
                              for k in candidates }
+            # Indices, and so the order of ties, depend on what else is in the
+            # table; ties are broken on the text of the candidate instead
+            candidateName = {k: str(next(self.extract(k))) for k in candidates }
+
+        flat = FlatVersionTable(self)
+        flat.loadInhabitants(self, candidateCost, candidateName)
+        with timing("beamed version spaces"):
+            beams = parallelMap(CPUs or numberOfCPUs(),
+                                lambda hs: flat.beamVersions(hs, bs),
+                                versions,
+                                chunksize=1)
+        flat = None
+
+        candidates = {d
+                      for _bs in beams
+                      for b in _bs
+                      for d in b['relativeCost'].keys() }
+        def score(candidate):
+            return sum(min(min(b['relativeCost'].get(candidate, b['defaultCost']),
+                               b['relativeFunctionCost'].get(candidate, b['defaultFunctionCost']))
+                           for b in _bs )
+                       for _bs in beams )
+        candidates = sorted(candidates, key=lambda k: (score(k), candidateName[k]))
+        return candidates
+
+    def rewriteWithInvention(self, i, js):
+        """Rewrites list of indices in beta long form using invention"""
+        return FlatVersionTable(self).rewriteWithInvention(i, js)
 
-        inhabitTable = self.inhabitantTable
-        functionTable = self.functionInhabitantTable
+    def addInventionToGrammar(self, candidate, g0, frontiers,
+                              pseudoCounts=1., emTolerance=None, rewrites=None):
+        programs = {e.program for f in frontiers for e in f }
+        return FlatVersionTable(self, programs).addInventionToGrammar(candidate, g0, frontiers,
+                                                                      pseudoCounts=pseudoCounts,
+                                                                      emTolerance=emTolerance,
+                                                                      rewrites=rewrites)
+
+
+
+def _sharedArray(typecode, values):
+    """values, in a flat array of shared memory that forked workers read without copying"""
+    from multiprocessing.sharedctypes import RawArray
+    if not isinstance(values, array) or values.typecode != typecode:
+        values = array(typecode, values)
+    a = RawArray(typecode, max(1, len(values)))
+    view = memoryview(a).cast('B').cast(typecode)[:len(values)]
+    view[:] = values
+    return view
+
+
+class FlatVersionTable(VersionColumns):
+    """A read-only copy of a VersionTable, with its columns in shared memory.
+    Workers forked by parallelMap only read integers out of these arrays,
+    where the dictionaries and caches of the VersionTable would be copied
+    into each worker as soon as their reference counts are touched."""
+
+    def __init__(self, table, programs=[]):
+        """programs: the programs whose super version spaces will be rewritten"""
+        self.opcodes = _sharedArray('b', table.opcodes)
+        self.first = _sharedArray('i', table.first)
+        self.second = _sharedArray('i', table.second)
+        self.elements = _sharedArray('i', table.elements)
+        # Primitives and inventions, which are few
+        self.leaves = list(table.leaves)
+
+        self.universe = table.universe
+        self.empty = table.empty
+        self.superSpaces = {p: table.superCache[table.incorporate(p)]
+                            for p in programs }
+        self.overlapTable = {}
 
+    def loadInhabitants(self, table, candidateCost, candidateName):
+        """Copies the minimal inhabitants of each version space that are
+        candidates, along with their costs, for beamVersions, which breaks
+        ties between costs on candidateName"""
+        self.candidateName = candidateName
+        n = len(table)
+        defaultCost, defaultFunctionCost = [POSITIVEINFINITY]*n, [POSITIVEINFINITY]*n
+        first, inhabitants, costs = [], [], []
+        for j in range(n):
+            first.append(len(inhabitants))
+            members = table.inhabitants[j]
+            if members is None: continue
+            defaultCost[j] = table.inhabitantCost[j]
+            if table.functionInhabitants[j] is not None:
+                defaultFunctionCost[j] = table.functionInhabitantCost[j]
+            for inhabitant in members:
+                if inhabitant in candidateCost:
+                    inhabitants.append(inhabitant)
+                    costs.append(candidateCost[inhabitant])
+        first.append(len(inhabitants))
+        self.defaultCost = _sharedArray('d', defaultCost)
+        self.defaultFunctionCost = _sharedArray('d', defaultFunctionCost)
+        self.inhabitantStart = _sharedArray('i', first)
+        self.inhabitants = _sharedArray('i', inhabitants)
+        self.inhabitantCosts = _sharedArray('d', costs)
+
+    def beamVersions(self, hs, bs):
+        """Beams of the candidate inventions that could be used to rewrite each of hs.
+        Needs loadInhabitants."""
+        flat = self
         class B():
+            __slots__ = ('relativeCost', 'relativeFunctionCost', 'defaultCost', 'defaultFunctionCost')
+
             def __init__(self, j):
-                cost, inhabitants = inhabitTable[j]
-                functionCost, functionInhabitants = functionTable[j]
-                self.relativeCost = {inhabitant: candidateCost[inhabitant]
-                                     for inhabitant in inhabitants
-                                     if inhabitant in candidates}
-                self.relativeFunctionCost = {inhabitant: candidateCost[inhabitant]
-                                             # INTENTIONALLY, do not use function inhabitants
-                                             for inhabitant in inhabitants
-                                             if inhabitant in candidates}
-                self.defaultCost = cost
-                self.defaultFunctionCost = functionCost
+                inhabitants = range(flat.inhabitantStart[j], flat.inhabitantStart[j + 1])
+                self.relativeCost = {flat.inhabitants[k]: flat.inhabitantCosts[k]
+                                     for k in inhabitants }
+                # INTENTIONALLY, do not use function inhabitants
+                self.relativeFunctionCost = dict(self.relativeCost)
+                self.defaultCost = flat.defaultCost[j]
+                self.defaultFunctionCost = flat.defaultFunctionCost[j]
 
             @property
             def domain(self):
@@ -721,10 +873,10 @@ class VersionTable():
             def restrict(self):
                 if len(self.relativeCost) > bs:
                     self.relativeCost = dict(sorted(self.relativeCost.items(),
-                                                    key=lambda rk: rk[1])[:bs])
+                                                    key=lambda rk: (rk[1], flat.candidateName[rk[0]]))[:bs])
                 if len(self.relativeFunctionCost) > bs:
                     self.relativeFunctionCost = dict(sorted(self.relativeFunctionCost.items(),
-                                                            key=lambda rk: rk[1])[:bs])
+                                                            key=lambda rk: (rk[1], flat.candidateName[rk[0]]))[:bs])
             def getCost(self, given):
                 return self.relativeCost.get(given, self.defaultCost)
             def getFunctionCost(self, given):
@@ -740,135 +892,112 @@ class VersionTable():
                 return {'relativeCost': self.relativeCost, 'defaultCost': self.defaultCost,
                         'relativeFunctionCost': self.relativeFunctionCost, 'defaultFunctionCost': self.defaultFunctionCost}
 
-        beamTable = [None]*len(self.expressions)
+        beamTable = {}
 
         def costs(j):
-            if beamTable[j] is not None:
+            if j in beamTable:
                 return beamTable[j]
 
             beamTable[j] = B(j)
-            
-            e = self.expressions[j]
-            if e.isIndex or e.isPrimitive or e.isInvented:
+
+            o = self.opcodes[j]
+            if o == self.INDEX or o == self.LEAF:
                 pass
-            elif e.isAbstraction:
-                b = costs(e.body)
+            elif o == self.ABSTRACTION:
+                b = costs(self.first[j])
                 for i,c in b.relativeCost.items():
                     beamTable[j].relax(i, c + epsilon)
-            elif e.isApplication:
-                f = costs(e.f)
-                x = costs(e.x)
+            elif o == self.APPLICATION:
+                f = costs(self.first[j])
+                x = costs(self.second[j])
                 for i in f.functionDomain | x.domain:
                     beamTable[j].relax(i, f.getFunctionCost(i) + x.getCost(i) + epsilon)
                     beamTable[j].relaxFunction(i, f.getFunctionCost(i) + x.getCost(i) + epsilon)
-            elif e.isUnion:
-                for z in e:
+            else:
+                for z in self.members(j):
                     cz = costs(z)
                     for i,c in cz.relativeCost.items(): beamTable[j].relax(i, c)
                     for i,c in cz.relativeFunctionCost.items(): beamTable[j].relaxFunction(i, c)
-            else: assert False
 
             beamTable[j].restrict()
             return beamTable[j]
 
-        with timing("beamed version spaces"):
-            beams = parallelMap(numberOfCPUs(),
-                                lambda hs: [ costs(h).unobject() for h in hs ],
-                                versions,
-                                memorySensitive=True,
-                                chunksize=1,
-                                maxtasksperchild=1)
-
-        # This can get pretty memory intensive - clean up the garbage
-        beamTable = None
-        gc.collect()
-        
-        candidates = {d
-                      for _bs in beams
-                      for b in _bs
-                      for d in b['relativeCost'].keys() }
-        def score(candidate):
-            return sum(min(min(b['relativeCost'].get(candidate, b['defaultCost']),
-                               b['relativeFunctionCost'].get(candidate, b['defaultFunctionCost']))
-                           for b in _bs )
-                       for _bs in beams )
-        candidates = sorted(candidates, key=score)
-        return candidates
+        return [ costs(h).unobject() for h in hs ]
 
     def rewriteWithInvention(self, i, js):
         """Rewrites list of indices in beta long form using invention"""
-        self.clearOverlapTable()
+        self.overlapTable = {}
         class RW():
-            """rewritten cost/expression either as a function or argument"""            
+            """rewritten cost/expression either as a function or argument"""
+            __slots__ = ('f', 'fc', 'a', 'ac')
+
             def __init__(self, f,fc,a,ac):
                 assert not (fc < ac)
                 self.f, self.fc, self.a, self.ac = f,fc,a,ac
-        
+
         _i = list(self.extract(i))
         assert len(_i) == 1
         _i = _i[0]
-        
+
         table = {}
         def rewrite(j):
             if j in table: return table[j]
-            e = self.expressions[j]
+            o = self.opcodes[j]
             if self.haveOverlap(i, j): r = RW(fc=1,ac=1,
                                               f=_i,a=_i)
-            elif e.isPrimitive or e.isInvented or e.isIndex:
+            elif o == self.INDEX or o == self.LEAF:
+                e = self.leaf(j)
                 r = RW(fc=1,ac=1,
                        f=e,a=e)
-            elif e.isApplication:
-                f = rewrite(e.f)
-                x = rewrite(e.x)
+            elif o == self.APPLICATION:
+                f = rewrite(self.first[j])
+                x = rewrite(self.second[j])
                 cost = f.fc + x.ac + epsilon
                 ep = Application(f.f, x.a) if cost < POSITIVEINFINITY else None
                 r = RW(fc=cost, ac=cost,
                        f=ep, a=ep)
-            elif e.isAbstraction:
-                b = rewrite(e.body)
+            elif o == self.ABSTRACTION:
+                b = rewrite(self.first[j])
                 cost = b.ac + epsilon
                 ep = Abstraction(b.a) if cost < POSITIVEINFINITY else None
                 r = RW(f=None, fc=POSITIVEINFINITY,
                        a=ep, ac=cost)
-            elif e.isUnion:
-                children = [rewrite(z) for z in e ]
+            else:
+                # the order of the members depends on the history of the
+                # table, so ties are broken on the text of the rewrite
+                children = [rewrite(z) for z in self.members(j) ]
                 f,fc = min(( (child.f, child.fc) for child in children ),
-                           key=cindex(1))
+                           key=lambda ec: (ec[1], str(ec[0])))
                 a,ac = min(( (child.a, child.ac) for child in children ),
-                           key=cindex(1))
+                           key=lambda ec: (ec[1], str(ec[0])))
                 r = RW(f=f,fc=fc,
                        a=a,ac=ac)
-            else: assert False
             table[j] = r
             return r
         js = [ rewrite(j).a for j in js ]
-        self.clearOverlapTable()
+        self.overlapTable = {}
         return js
-        
+
     def addInventionToGrammar(self, candidate, g0, frontiers,
-                              pseudoCounts=1.):
+                              pseudoCounts=1., emTolerance=None, rewrites=None):
+        """rewrites: {program: rewriteWithInvention of it}, which is only
+        calculated for the programs that are missing from it, and then added"""
         candidateSource = next(self.extract(candidate))
         v = RewriteWithInventionVisitor(candidateSource)
         invention = v.invention
 
-        rewriteMapping = list({e.program
-                               for f in frontiers
-                               for e in f })
-        spaces = [self.superCache[self.incorporate(program)]
-                  for program in rewriteMapping ]
-        rewriteMapping = dict(zip(rewriteMapping,
-                                  self.rewriteWithInvention(candidate, spaces)))
+        if rewrites is None: rewrites = {}
+        missing = list({e.program
+                        for f in frontiers
+                        for e in f
+                        if e.program not in rewrites })
+        spaces = [self.superSpaces[program]
+                  for program in missing ]
+        rewrites.update(zip(missing,
+                            self.rewriteWithInvention(candidate, spaces)))
 
         def tryRewrite(program, request=None):
-            rw = v.execute(rewriteMapping[program], request=request)
-            # print(f"Rewriting {program} ({rewriteMapping[program]}) : rw={rw}")
-            # print("slow-motion:")
-            # try:
-            #     i = rewriteMapping[program].visit(v)
-            #     print(f"\ti={i}")
-            #     l = EtaLongVisitor().execute(i)
-            #     print(f"\tl={l}")
-            # except Exception as e: print(e)
+            rw = v.execute(rewrites[program], request=request)
             return rw or program
 
         frontiers = [Frontier([FrontierEntry(program=tryRewrite(e.program, request=f.task.request),
@@ -877,13 +1006,9 @@ class VersionTable():
                                        for e in f ],
                               f.task)
                      for f in frontiers ]
-        # print(invention)
-        # for f in frontiers: print(f.entries[0].program)
-        # print()
-        # print()
         g = Grammar.uniform([invention] + g0.primitives, continuationType=g0.continuationType).\
             insideOutside(frontiers,
-                          pseudoCounts=pseudoCounts)
+                          pseudoCounts=pseudoCounts, tolerance=emTolerance)
         frontiers = [g.rescoreFrontier(f) for f in frontiers]
         return g, frontiers
 
@@ -950,6 +1075,67 @@ class RewriteWithInventionVisitor():
 
 
 
+class CompressionStore(object):
+    """What induceGrammar_Beta keeps from one call to the next, so that
+    compressing after each iteration only has to work on the programs that
+    are new: a version table holding the super version space of every
+    program compressed so far, and how each candidate invention rewrote
+    each program. Neither depends on the grammar or on the frontiers, only on
+    the programs and the arity, so both stay valid across iterations. The
+    table starts over once it has more than maximumSize version spaces, and
+    only the rewrites of the maximumCandidates most recent candidates are
+    kept. Stores pickle, which is how they get to pypy and back.
+
+    That round trip happens every iteration and the parent holds the store
+    for the whole run, so maximumSize is what bounds both: a version space
+    costs about 200 bytes in memory and 70 bytes pickled, so the default of
+    200000 is around 40MB held and 14MB shipped each way. Starting over only
+    costs rebuilding the version spaces of the programs compressed next."""
+
+    def __init__(self, maximumSize=200000, maximumCandidates=1000):
+        self.maximumSize = maximumSize
+        self.maximumCandidates = maximumCandidates
+        self.arity = None
+        self.table = None
+        # candidate invention -> {program: rewriteWithInvention of it}
+        self.rewrites = OrderedDict()
+
+    def update(self, other):
+        """Takes over the contents of other, a copy of this store that was changed elsewhere"""
+        self.__dict__.update(other.__dict__)
+
+    def versionTable(self, arity):
+        if self.arity != arity:
+            self.arity = arity
+            self.table = None
+            self.rewrites = OrderedDict()
+        if self.table is None or len(self.table) > self.maximumSize:
+            if self.table is not None:
+                eprint("Version table has %d version spaces; starting a new one"%len(self.table))
+            self.table = VersionTable(typed=False, identity=False)
+        return self.table
+
+    def rewritesOf(self, candidate):
+        """{program: how candidate, a Program, rewrote it}"""
+        rewrites = self.rewrites.get(candidate)
+        if rewrites is None: return {}
+        self.rewrites.move_to_end(candidate)
+        return rewrites
+
+    def addRewrites(self, candidate, rewrites):
+        self.rewrites.setdefault(candidate, {}).update(rewrites)
+        self.rewrites.move_to_end(candidate)
+        while len(self.rewrites) > self.maximumCandidates:
+            self.rewrites.popitem(last=False)
+
+    def forgetRewrites(self, programs):
+        """Drops the rewrites of everything except programs"""
+        programs = set(programs)
+        for rewrites in self.rewrites.values():
+            for p in [p for p in rewrites if p not in programs]:
+                del rewrites[p]
+
+
 def induceGrammar_Beta(g0, frontiers, _=None,
                        pseudoCounts=1.,
                        a=3,
@@ -957,8 +1143,12 @@ def induceGrammar_Beta(g0, frontiers, _=None,
                        topK=2,
                        topI=50,
                        structurePenalty=1.,
-                       CPUs=1):
-    """grammar induction using only version spaces"""
+                       emTolerance=None,
+                       CPUs=1,
+                       store=None):
+    """grammar induction using only version spaces.
+    emTolerance: if given, production weights are fit by EM until they move by less than it
+    store: a CompressionStore to reuse version spaces and rewrites from earlier calls, and to keep them in"""
     from dreamcoder.fragmentUtilities import primitiveSize
     import gc
     
@@ -967,14 +1157,13 @@ def induceGrammar_Beta(g0, frontiers, _=None,
     eprint("Inducing a grammar from", len(frontiers), "frontiers")
 
     arity = a
+    if store is None: store = CompressionStore()
+    store.forgetRewrites(e.program for f in frontiers for e in f)
 
     def restrictFrontiers():
-        return parallelMap(1,#CPUs,
+        return parallelMap(CPUs,
                            lambda f: g0.rescoreFrontier(f).topK(topK),
-                           frontiers,
-                           memorySensitive=True,
-                           chunksize=1,
-                           maxtasksperchild=1)
+                           frontiers)
     restrictedFrontiers = restrictFrontiers()
     
     def objective(g, fs):
@@ -983,16 +1172,23 @@ def induceGrammar_Beta(g0, frontiers, _=None,
         return ll - sp - aic*len(g.productions)
             
     v = None
+    # what the workers that score candidates see of v
+    flat = None
     def scoreCandidate(candidate, currentFrontiers, currentGrammar):
+        """Returns the score, and the rewrites that were not in the store"""
+        known = store.rewritesOf(next(flat.extract(candidate)))
+        rewrites = dict(known)
         try:
-            newGrammar, newFrontiers = v.addInventionToGrammar(candidate, currentGrammar, currentFrontiers,
-                                                               pseudoCounts=pseudoCounts)
+            newGrammar, newFrontiers = flat.addInventionToGrammar(candidate, currentGrammar, currentFrontiers,
+                                                               pseudoCounts=pseudoCounts,
+                                                               emTolerance=emTolerance,
+                                                               rewrites=rewrites)
         except InferenceFailure:
             # And this can occur if the candidate is not well typed:
             # it is expected that this can occur;
             # in practice, it is more efficient to filter out the ill typed terms,
             # then it is to construct the version spaces so that they only contain well typed terms.
-            return NEGATIVEINFINITY
+            return NEGATIVEINFINITY, {p: r for p,r in rewrites.items() if p not in known}
             
         o = objective(newGrammar, newFrontiers)
 
@@ -1004,39 +1200,39 @@ def induceGrammar_Beta(g0, frontiers, _=None,
         #     for e in f:
         #         eprint(e.program)
         
-        return o
+        return o, {p: r for p,r in rewrites.items() if p not in known}
         
     with timing("Estimated initial grammar production probabilities"):
-        g0 = g0.insideOutside(restrictedFrontiers, pseudoCounts)
+        g0 = g0.insideOutside(restrictedFrontiers, pseudoCounts, tolerance=emTolerance)
     oldScore = objective(g0, restrictedFrontiers)
     eprint("Starting grammar induction score",oldScore)
     
     while True:
-        v = VersionTable(typed=False, identity=False)
+        # Version spaces, and their inversions and inhabitants, that are
+        # already in the table from earlier are reused
+        v = store.versionTable(arity)
+        before = len(v)
         with timing("constructed %d-step version spaces"%arity):
             versions = [[v.superVersionSpace(v.incorporate(e.program), arity) for e in f]
                         for f in restrictedFrontiers ]
-            eprint("Enumerated %d distinct version spaces"%len(v.expressions))
+            eprint("Enumerated %d distinct version spaces (%d new)"%(len(v), len(v) - before))
         
         # Bigger beam because I feel like it
-        candidates = v.bestInventions(versions, bs=3*topI)[:topI]
+        candidates = v.bestInventions(versions, bs=3*topI, CPUs=CPUs)[:topI]
         eprint("Only considering the top %d candidates"%len(candidates))
-
-        # Clean caches that are no longer needed
-        v.recursiveTable = [None]*len(v)
-        v.inhabitantTable = [None]*len(v)
-        v.functionInhabitantTable = [None]*len(v)
-        v.substitutionTable = {}
         gc.collect()
         
+        flat = FlatVersionTable(v, {e.program for f in restrictedFrontiers for e in f })
         with timing("scored the candidate inventions"):
             scoredCandidates = parallelMap(CPUs,
                                            lambda candidate: \
                                            (candidate, scoreCandidate(candidate, restrictedFrontiers, g0)),
                                             candidates,
-                                           memorySensitive=True,
-                                           chunksize=1,
-                                           maxtasksperchild=1)
+                                           chunksize=1)
+        for candidate, (_, rewrites) in scoredCandidates:
+            store.addRewrites(next(flat.extract(candidate)), rewrites)
+        scoredCandidates = [(candidate, score) for candidate, (score, _) in scoredCandidates]
+        flat = None
         if len(scoredCandidates) > 0:
             bestNew, bestScore = max(scoredCandidates, key=lambda sc: sc[1])
         if len(scoredCandidates) == 0 or bestScore < oldScore:
@@ -1059,8 +1255,13 @@ def induceGrammar_Beta(g0, frontiers, _=None,
             for f in frontiers:
                 for e in f:
                     v.superVersionSpace(v.incorporate(e.program), arity)
+        candidateSource = next(v.extract(bestNew))
+        rewrites = dict(store.rewritesOf(candidateSource))
         newGrammar, newFrontiers = v.addInventionToGrammar(bestNew, g0, frontiers,
-                                                           pseudoCounts=pseudoCounts)
+                                                           pseudoCounts=pseudoCounts,
+                                                           emTolerance=emTolerance,
+                                                           rewrites=rewrites)
+        store.addRewrites(candidateSource, rewrites)
         eprint("Improved score to", bestScore, "(dS =", bestScore-oldScore, ") w/ invention",newGrammar.primitives[0],":",newGrammar.primitives[0].infer())
         oldScore = bestScore
 
@@ -1068,15 +1269,18 @@ def induceGrammar_Beta(g0, frontiers, _=None,
             eprint(f.summarizeFull())
 
         g0, frontiers = newGrammar, newFrontiers
+        v = None
+        store.forgetRewrites(e.program for f in frontiers for e in f)
+        gc.collect()
         restrictedFrontiers = restrictFrontiers()
 
 
-        
-        
-        
-        
-            
-            
+def induceGrammarWithStore(g0, frontiers, store, **keywords):
+    """induceGrammar_Beta, also returning the store, for when it runs in another process"""
+    g, frontiers = induceGrammar_Beta(g0, frontiers, store=store, **keywords)
+    return g, frontiers, store
+
+
 def testTyping(p):
     v = VersionTable()
     j = v.incorporate(p)
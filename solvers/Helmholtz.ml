@@ -18,7 +18,14 @@ open Yojson.Basic
 
 let run_job channel =
   let open Yojson.Basic.Util in
-  let j = Yojson.Basic.from_channel channel in
+  let j =
+    if Msgpack.requested () then
+      begin match Msgpack.read_frame channel with
+        | Some(j) -> j
+        | None -> raise (Msgpack.Malformed "no message on stdin")
+      end
+    else Yojson.Basic.from_channel channel
+  in
   let request = j |> member "request" |> deserialize_type in
   let timeout = j |> member "timeout" |> to_number in
   let evaluationTimeout =
@@ -69,5 +76,11 @@ let output_job ?maxExamples:(maxExamples=50000) result =
   in 
   message
 
+(* --capabilities lists the protocol features of this build, as json *)
 let _ = 
-  run_job Pervasives.stdin |> remove_bad_dreams |> output_job |> to_channel Pervasives.stdout
+  if Array.exists Sys.argv ~f:(fun a -> a = "--capabilities") then
+    `List([`String("msgpack")]) |> to_string |> print_endline
+  else
+  let response = run_job Pervasives.stdin |> remove_bad_dreams |> output_job in
+  if Msgpack.requested () then Msgpack.write_frame Pervasives.stdout response
+  else to_channel Pervasives.stdout response
@@ -0,0 +1,133 @@
+open Core
+
+(* A small MessagePack codec for the values Yojson.Basic can represent, so
+   that the binaries can accept the same messages in binary form. Messages
+   are framed: a 4-byte big-endian payload length followed by the payload. *)
+
+exception Malformed of string
+
+let decode (s : string) : Yojson.Basic.json =
+  let position = ref 0 in
+  let byte () =
+    if !position >= String.length s then raise (Malformed "truncated message");
+    let b = Char.to_int s.[!position] in
+    incr position; b
+  in
+  let unsigned n =
+    let v = ref 0 in
+    for _ = 1 to n do v := (!v lsl 8) lor byte () done;
+    !v
+  in
+  let signed n =
+    let v = unsigned n in
+    if n < 8 && v >= 1 lsl (8*n - 1) then v - (1 lsl (8*n)) else v
+  in
+  let bits64 () =
+    let v = ref Caml.Int64.zero in
+    for _ = 1 to 8 do
+      v := Caml.Int64.logor (Caml.Int64.shift_left !v 8) (Caml.Int64.of_int (byte ()))
+    done;
+    !v
+  in
+  let bytes n =
+    if !position + n > String.length s then raise (Malformed "truncated message");
+    let b = String.sub s ~pos:!position ~len:n in
+    position := !position + n; b
+  in
+  (* elements have to be read front to back, so no List.init here.
+     Outside of the recursive definitions, so that it stays polymorphic *)
+  let many n f =
+    let rec loop i accumulator =
+      if i = 0 then List.rev accumulator else loop (i - 1) (f () :: accumulator)
+    in loop n []
+  in
+  let rec value () : Yojson.Basic.json =
+    let tag = byte () in
+    if tag <= 0x7f then `Int(tag) else
+    if tag >= 0xe0 then `Int(tag - 0x100) else
+    if tag land 0xf0 = 0x80 then map (tag land 0x0f) else
+    if tag land 0xf0 = 0x90 then array (tag land 0x0f) else
+    if tag land 0xe0 = 0xa0 then `String(bytes (tag land 0x1f)) else
+      match tag with
+      | 0xc0 -> `Null
+      | 0xc2 -> `Bool(false)
+      | 0xc3 -> `Bool(true)
+      | 0xc4 | 0xd9 -> `String(bytes (unsigned 1))
+      | 0xc5 | 0xda -> `String(bytes (unsigned 2))
+      | 0xc6 | 0xdb -> `String(bytes (unsigned 4))
+      | 0xca -> `Float(Caml.Int32.float_of_bits (Caml.Int32.of_int (unsigned 4)))
+      | 0xcb -> `Float(Caml.Int64.float_of_bits (bits64 ()))
+      | 0xcc -> `Int(unsigned 1)
+      | 0xcd -> `Int(unsigned 2)
+      | 0xce -> `Int(unsigned 4)
+      | 0xcf -> `Int(unsigned 8)
+      | 0xd0 -> `Int(signed 1)
+      | 0xd1 -> `Int(signed 2)
+      | 0xd2 -> `Int(signed 4)
+      | 0xd3 -> `Int(signed 8)
+      | 0xdc -> array (unsigned 2)
+      | 0xdd -> array (unsigned 4)
+      | 0xde -> map (unsigned 2)
+      | 0xdf -> map (unsigned 4)
+      | _ -> raise (Malformed (Printf.sprintf "unsupported msgpack tag 0x%x" tag))
+  and array n = `List(many n value)
+  and map n =
+    `Assoc(many n (fun () ->
+        match value () with
+        | `String(k) -> let v = value () in (k, v)
+        | _ -> raise (Malformed "map keys must be strings")))
+  in
+  value ()
+
+let encode (j : Yojson.Basic.json) : string =
+  let b = Buffer.create 4096 in
+  let add_byte x = Buffer.add_char b (Char.of_int_exn (x land 0xff)) in
+  let add_bytes n v = for i = n - 1 downto 0 do add_byte (v asr (8*i)) done in
+  let header small tag32 n =
+    if n < 16 then add_byte (small lor n) else (add_byte tag32; add_bytes 4 n)
+  in
+  let rec value (j : Yojson.Basic.json) =
+    match j with
+    | `Null -> add_byte 0xc0
+    | `Bool(false) -> add_byte 0xc2
+    | `Bool(true) -> add_byte 0xc3
+    | `Int(i) when i >= 0 && i < 0x80 -> add_byte i
+    | `Int(i) when i < 0 && i >= -32 -> add_byte i
+    | `Int(i) -> add_byte 0xd3; add_bytes 8 i
+    | `Float(f) ->
+      let bits = Caml.Int64.bits_of_float f in
+      add_byte 0xcb;
+      for i = 7 downto 0 do
+        add_byte (Caml.Int64.to_int (Caml.Int64.shift_right_logical bits (8*i)))
+      done
+    | `String(s) ->
+      let n = String.length s in
+      if n < 32 then add_byte (0xa0 lor n) else (add_byte 0xdb; add_bytes 4 n);
+      Buffer.add_string b s
+    | `List(l) ->
+      header 0x90 0xdd (List.length l);
+      List.iter l ~f:value
+    | `Assoc(l) ->
+      header 0x80 0xdf (List.length l);
+      List.iter l ~f:(fun (k,v) -> value (`String(k)); value v)
+  in
+  value j;
+  Buffer.contents b
+
+let read_frame channel : Yojson.Basic.json option =
+  match Caml.really_input_string channel 4 with
+  | exception End_of_file -> None
+  | header ->
+    let n = String.fold header ~init:0 ~f:(fun n c -> (n lsl 8) lor Char.to_int c) in
+    Some(Caml.really_input_string channel n |> decode)
+
+let write_frame channel (j : Yojson.Basic.json) =
+  let payload = encode j in
+  let n = String.length payload in
+  Out_channel.output_string channel
+    (String.init 4 ~f:(fun i -> Char.of_int_exn ((n lsr (8*(3 - i))) land 0xff)));
+  Out_channel.output_string channel payload;
+  Out_channel.flush channel
+
+(* Binaries speak msgpack frames instead of json when invoked with --msgpack *)
+let requested () = Array.exists Sys.argv ~f:(fun a -> a = "--msgpack")
@@ -16,9 +16,8 @@ open Grammar
 open Task
 open FastType
 
-let load_problems channel =
+let problems_of_json j =
   let open Yojson.Basic.Util in
-  let j = Yojson.Basic.from_channel channel in
   let g = j |> member "DSL" in
   let g =
     try deserialize_grammar g |> make_dummy_contextual
@@ -111,7 +110,10 @@ let load_problems channel =
     with _ -> 1.
   in
 
-  let timeout = j |> member "timeout" |> to_number in
+  let timeout =
+    try j |> member "timeout" |> to_number
+    with _ -> 0.
+  in
   let nc =
     try
       j |> member "nc" |> to_int 
@@ -122,22 +124,128 @@ let load_problems channel =
    maxParameters,
    nc,timeout,verbose)
 
-let export_frontiers number_enumerated tf solutions : string =
-  let open Yojson.Basic.Util in
+let load_problems channel =
+  (if Msgpack.requested () then
+     begin match Msgpack.read_frame channel with
+       | Some(j) -> j
+       | None -> raise (Msgpack.Malformed "no message on stdin")
+     end
+   else Yojson.Basic.from_channel channel) |> problems_of_json
+
+let frontiers_to_json number_enumerated tf solutions : Yojson.Basic.json =
+  `Assoc(("number_enumerated",`Int(number_enumerated)) ::
+         List.map2_exn tf solutions ~f:(fun (t,_) ss ->
+      (t.name, `List(ss |> List.map ~f:(fun s ->
+           `Assoc([("program", `String(s.hit_program));
+                   ("time", `Float(s.hit_time));
+                   ("logLikelihood", `Float(s.hit_likelihood));
+                   ("logPrior", `Float(s.hit_prior))]))))))
+
+(* With --stream, every hit that makes it into a frontier is sent on its own
+   as soon as it is found (with nc > 1, as soon as the budget window it was
+   found in is over), as {task, program, time, logLikelihood, logPrior},
+   ahead of the frontiers; the frontiers are then sent as a single line. *)
+let streaming () = Array.exists Sys.argv ~f:(fun a -> a = "--stream")
+
+let hit_reporter send =
+  if streaming () then
+    (fun (t : task) (h : hit_result) ->
+       `Assoc([("task", `String(t.name));
+               ("program", `String(h.hit_program));
+               ("time", `Float(h.hit_time));
+               ("logLikelihood", `Float(h.hit_likelihood));
+               ("logPrior", `Float(h.hit_prior))]) |> send)
+  else (fun _ _ -> ())
+
+let export_frontiers ?pretty:(pretty=true) number_enumerated tf solutions : string =
   let open Yojson.Basic in
-  let serialization : Yojson.Basic.json =
-    `Assoc(("number_enumerated",`Int(number_enumerated)) ::
-           List.map2_exn tf solutions ~f:(fun (t,_) ss ->
-        (t.name, `List(ss |> List.map ~f:(fun s ->
-             `Assoc([("program", `String(s.hit_program));
-                     ("time", `Float(s.hit_time));
-                     ("logLikelihood", `Float(s.hit_likelihood));
-                     ("logPrior", `Float(s.hit_prior))]))))))
-  in pretty_to_string serialization
+  let serialization = frontiers_to_json number_enumerated tf solutions in
+  if pretty then pretty_to_string serialization else to_string serialization
 ;;
 
+let make_backend g unrolled tf mfp nc =
+  match unrolled with
+  | None ->
+    let traditional_backend lowerBound upperBound ~final =
+      enumerate_programs ~final g (List.hd_exn tf |> fst).task_type lowerBound upperBound ~maxFreeParameters:mfp ~nc
+    in traditional_backend
+  | Some(unrolled) ->
+    let new_backend lower_bound upper_bound ~final continuation =
+      (* bounded_recursive_enumeration *) (* bottom_up_enumeration *)
+      dynamic_programming_enumeration
+        ~factor:2
+        ~lower_bound ~upper_bound g.variable_context (List.hd_exn tf |> fst).task_type (* unrolled *)
+        (fun p l -> continuation p l);
+      [final()]
+    in new_backend
+
+(* Persistent mode: the first line on stdin is the whole problem (DSL and
+   tasks, as in the one-shot protocol). Every later line is a budget slice
+   {lowerBound, upperBound, budgetIncrement, timeout, nc, tasks: {name: maximumFrontier}}
+   and gets exactly one line of frontiers back. The grammar and the tasks
+   stay resident between slices. With --msgpack, lines are replaced by
+   length-prefixed msgpack frames. With --stream, hits come ahead of the
+   line of frontiers. *)
+let serve_problems () =
+  let open Yojson.Basic.Util in
+  let receive, send =
+    if Msgpack.requested () then
+      ((fun () -> Msgpack.read_frame Pervasives.stdin),
+       (fun j -> Msgpack.write_frame Pervasives.stdout j))
+    else
+      ((fun () -> In_channel.input_line Pervasives.stdin |> Option.map ~f:Yojson.Basic.from_string),
+       (fun j -> Yojson.Basic.to_string j |> print_endline; flush_everything()))
+  in
+  match receive () with
+  | None -> ()
+  | Some(first) ->
+    let (tf,g,unrolled,
+         _,_,defaultIncrement,
+         mfp,
+         defaultCPUs,_,verbose) =
+      first |> problems_of_json in
+    let rec loop () =
+      match receive () with
+      | None -> ()
+      | Some(j) ->
+        let lowerBound = j |> member "lowerBound" |> to_number in
+        let upperBound = j |> member "upperBound" |> to_number in
+        let budgetIncrement =
+          try j |> member "budgetIncrement" |> to_number
+          with _ -> defaultIncrement
+        in
+        let timeout = j |> member "timeout" |> to_number in
+        let nc =
+          try j |> member "nc" |> to_int
+          with _ -> defaultCPUs
+        in
+        let active = j |> member "tasks" |> to_assoc in
+        let tf = tf |> List.filter_map ~f:(fun (t,_) ->
+            match List.Assoc.find ~equal:(=) active t.name with
+            | Some(k) -> Some((t, to_int k))
+            | None -> None) in
+        let solutions, number_enumerated =
+          if List.is_empty tf then ([], 0) else
+            enumerate_for_tasks (make_backend g unrolled tf mfp nc)
+              ~report:(hit_reporter send)
+              ~lowerBound:lowerBound ~upperBound:upperBound ~budgetIncrement:budgetIncrement
+              ~verbose:verbose ~timeout:timeout tf ~nc
+        in
+        frontiers_to_json number_enumerated tf solutions |> send;
+        loop ()
+    in loop ()
+;;
+
+
+(* --capabilities lists the protocol features of this build, as json, so
+   that the python side can fall back to one-shot json with older binaries *)
+let capabilities = ["server"; "msgpack"; "stream"]
 
 let _ =
+  if Array.exists Sys.argv ~f:(fun a -> a = "--capabilities") then
+    `List(capabilities |> List.map ~f:(fun c -> `String(c))) |> Yojson.Basic.to_string |> print_endline
+  else
+  if Array.exists Sys.argv ~f:(fun a -> a = "--server") then serve_problems () else
 
   let (tf,g,unrolled,
        lowerBound,upperBound,budgetIncrement,
@@ -153,22 +261,7 @@ let _ =
   flush_everything();
   let _T,_ub = 5.,30. in
 
-  let backend=
-    match unrolled with
-    | None -> 
-      let traditional_backend lowerBound upperBound ~final =
-        enumerate_programs ~final g (List.hd_exn tf |> fst).task_type lowerBound upperBound ~maxFreeParameters:mfp ~nc
-      in traditional_backend
-    | Some(unrolled) -> 
-      let new_backend lower_bound upper_bound ~final continuation =
-        (* bounded_recursive_enumeration *) (* bottom_up_enumeration *)
-        dynamic_programming_enumeration
-        ~factor:2
-          ~lower_bound ~upper_bound g.variable_context (List.hd_exn tf |> fst).task_type (* unrolled *)
-          (fun p l -> continuation p l);
-        [final()]
-      in new_backend
-  in 
+  let backend = make_backend g unrolled tf mfp nc in
   
   (* let progress_without_evaluation = *)
   (* enumerate_for_tasks traditional_backend ~lowerBound:0. ~upperBound:_ub ~budgetIncrement:budgetIncrement *)
@@ -205,11 +298,19 @@ let _ =
   (*     ((Float.of_int fast_enumerated) /. _T); *)
   (*   Printf.eprintf "Evaluations per second: %f\n" evaluations_per_second); *)
 
+  let send j =
+    if Msgpack.requested () then Msgpack.write_frame Pervasives.stdout j
+    else (Yojson.Basic.to_string j |> print_endline; flush_everything())
+  in
   let solutions, number_enumerated =
-    enumerate_for_tasks backend ~lowerBound:lowerBound ~upperBound:upperBound ~budgetIncrement:budgetIncrement
+    enumerate_for_tasks backend ~report:(hit_reporter send)
+    ~lowerBound:lowerBound ~upperBound:upperBound ~budgetIncrement:budgetIncrement
     ~verbose:verbose ~timeout:timeout tf ~nc
   in
-  export_frontiers number_enumerated tf solutions |> print_string ;;
+  if Msgpack.requested () || streaming () then
+    frontiers_to_json number_enumerated tf solutions |> send
+  else
+    export_frontiers number_enumerated tf solutions |> print_string ;;
 
 (* let tune_differentiation () = *)
 (*   let (tf,g, *)
@@ -299,6 +299,9 @@ type hit_result = {hit_program: string;
                    hit_time: float;}
 
 let enumerate_for_tasks enumeration_backend ?verbose:(verbose = true)
+    (* Called with each hit that makes it into a frontier, as soon as it is found,
+       or with nc > 1 once the budget window it was found in has been merged *)
+    ?report:(report = fun _ _ -> ())
     ?budgetIncrement:(budgetIncrement = 1.)
     ?lowerBound:(lowerBound = 0.)
     ?upperBound:(upperBound = 99.)
@@ -334,6 +337,9 @@ let enumerate_for_tasks enumeration_backend ?verbose:(verbose = true)
 
   let total_number_of_enumerated_programs = ref 0 in
 
+  (* forked workers must not report: they would all be writing to stdout at once *)
+  let parent = Unix.getpid () in
+
   while not (enumeration_timed_out()) &&
           List.exists (range nt) ~f:(fun j -> Heap.length hits.(j) < maximumFrontier.(j))
        && !lower_bound +. budgetIncrement <= upperBound
@@ -365,22 +371,29 @@ let enumerate_for_tasks enumeration_backend ?verbose:(verbose = true)
                  if is_valid logLikelihood then begin
                    let dt = Time.abs_diff startTime (Time.now ())
                             |> Time.Span.to_sec in
-                   Heap.add hits.(j)
-                     {hit_program = string_of_program p;
-                      hit_prior = logPrior;
-                      hit_likelihood = logLikelihood;
-                      hit_time = dt;} ;
+                   let hit = {hit_program = string_of_program p;
+                              hit_prior = logPrior;
+                              hit_likelihood = logLikelihood;
+                              hit_time = dt;} in
+                   let kept = Heap.length hits.(j) < maximumFrontier.(j) ||
+                              (match Heap.top hits.(j) with
+                               | Some(worst) ->
+                                 hit.hit_likelihood+.hit.hit_prior > worst.hit_likelihood+.worst.hit_prior
+                               | None -> false) in
+                   Heap.add hits.(j) hit;
                    while Heap.length hits.(j) > maximumFrontier.(j) do
                      Heap.remove_top hits.(j)
                    done;
+                   if kept && Unix.getpid () = parent then report tasks.(j) hit;
                    if verbose then
                      Printf.eprintf
                        "\t(ocaml) HIT %s w/ %s\n" (tasks.(j).name) (string_of_program p)
                  end)) |> List.concat
       in
 
-      if nc > 1 then
+      if nc > 1 then begin
         (* merge the results from each of the parallel processes *)
+        let merged = Array.init nt ~f:(fun _ -> []) in
         final_results |> List.iter ~f:(fun (array_of_heaps, number_enumerated_here) ->
             total_number_of_enumerated_programs := !total_number_of_enumerated_programs +
                                                    number_enumerated_here;
@@ -390,9 +403,14 @@ let enumerate_for_tasks enumeration_backend ?verbose:(verbose = true)
                 List.iter new_heap ~f:(fun element ->
                     if not (Heap.mem old_heap ~equal:(=) element) then
                       (Heap.add old_heap element;
+                       merged.(j) <- element :: merged.(j);
                        if Heap.length old_heap > maximumFrontier.(j)
-                       then Heap.remove_top old_heap))))
-      ;
+                       then Heap.remove_top old_heap))));
+        (* report what the workers found, if it survived the merge *)
+        range nt |> List.iter ~f:(fun j ->
+            List.rev merged.(j) |> List.iter ~f:(fun element ->
+                if Heap.mem hits.(j) ~equal:(=) element then report tasks.(j) element))
+      end;
       
       lower_bound := budgetIncrement+. (!lower_bound);
 
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import unittest
+
+from dreamcoder.checkpoint import CheckpointDirectory, isCheckpointDirectory, loadECResult
+from dreamcoder.dreamcoder import ECResult
+from dreamcoder.frontier import Frontier
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint
+
+
+class TestCheckpointDirectory(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "run.checkpoint")
+        self.tasks = [Task("t%d" % n, arrow(tint, tint), [((n,), n)]) for n in range(3)]
+        self.result = ECResult(parameters={"iterations": 2}, grammars=["g0"],
+                               allFrontiers={t: Frontier([], task=t) for t in self.tasks})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_exports_only_what_changed(self):
+        checkpoints = CheckpointDirectory(self.path)
+        checkpoints.export(self.result, 1)
+        self.result.grammars.append("g1")
+        self.result.learningCurve.append(1)
+        self.result.allFrontiers[self.tasks[0]] = Frontier([], task=self.tasks[0])
+        self.result.recognitionTaskMetrics[self.tasks[1]] = {"frontier": self.result.allFrontiers[self.tasks[1]]}
+        entry = checkpoints.export(self.result, 2)
+        self.assertEqual(set(entry["segments"]),
+                         {"grammars", "learningCurve", "allFrontiers", "recognitionTaskMetrics"})
+        self.assertEqual(checkpoints.read(entry["segments"]["grammars"]), ("extend", ["g1"]))
+
+        loaded = loadECResult(self.path)
+        self.assertEqual(loaded.grammars, ["g0", "g1"])
+        self.assertEqual(loaded.learningCurve, [1])
+        self.assertEqual(set(loaded.allFrontiers), set(self.tasks))
+        # tasks are stored once and shared by everything that refers to them
+        task, = loaded.recognitionTaskMetrics
+        self.assertIs(loaded.recognitionTaskMetrics[task]["frontier"].task, task)
+        self.assertEqual(task.examples, [((1,), 1)])
+
+    def test_loads_earlier_iterations_and_single_attributes(self):
+        checkpoints = CheckpointDirectory(self.path)
+        checkpoints.export(self.result, 1)
+        self.result.grammars.append("g1")
+        checkpoints.export(self.result, 2)
+        self.assertTrue(isCheckpointDirectory(self.path))
+        self.assertEqual(checkpoints.iterations(), [1, 2])
+        loaded = loadECResult(self.path, attributes={"grammars"}, iteration=1)
+        self.assertEqual(loaded.grammars, ["g0"])
+        self.assertEqual(loaded.allFrontiers, {})
+
+    def test_resuming_from_an_earlier_iteration_branches(self):
+        checkpoints = CheckpointDirectory(self.path)
+        checkpoints.export(self.result, 1)
+        self.result.grammars.append("g1")
+        checkpoints.export(self.result, 2)
+
+        resumed = CheckpointDirectory(self.path)
+        result = resumed.load(iteration=1)
+        result.grammars.append("g1'")
+        entry = resumed.export(result, 2)
+        self.assertEqual(list(entry["segments"]), ["grammars"])
+        self.assertEqual(loadECResult(self.path).grammars, ["g0", "g1'"])
+
+
+if __name__ == '__main__':
+    unittest.main()
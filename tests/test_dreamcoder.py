@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 
 
 class TestEcModule(unittest.TestCase):
@@ -16,6 +17,25 @@ class TestEcModule(unittest.TestCase):
         except Exception:
             self.fail('Unable to import ec module')
 
+    def test_solver_flags_make_solver_options(self):
+        from dreamcoder.dreamcoder import commandlineArguments
+        with mock.patch('sys.argv', ['ec', '--streamHits', '--evaluationCache']):
+            arguments = commandlineArguments(enumerationTimeout=1, iterations=1)
+        options = arguments["solverOptions"]
+        self.assertTrue(options.streamHits)
+        self.assertFalse(options.persistentSolvers)
+        self.assertNotIn("streamHits", arguments)
+        # process-wide settings stay ecIterator arguments
+        self.assertEqual(arguments["evaluationCache"], "")
+
+    def test_solver_options_are_copied_before_changing(self):
+        from dreamcoder.enumeration import SolverOptions
+        options = SolverOptions(binaryProtocol=True, streamHits=True)
+        changed = options.replace(binaryProtocol=False)
+        self.assertTrue(options.binaryProtocol)
+        self.assertFalse(changed.binaryProtocol)
+        self.assertTrue(changed.streamHits)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,12 @@
+import os
 import unittest
 
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import k0, k1, addition, subtraction, multiplication
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.type import arrow, tint
+from dreamcoder.utilities import binaryProtocolAvailable, binaryCapabilities, get_root_dir
+
 
 class TestDreaming(unittest.TestCase):
 
@@ -11,5 +18,26 @@ class TestDreaming(unittest.TestCase):
             self.fail('Unable to import from dreaming module')
 
 
+@unittest.skipUnless("msgpack" in binaryCapabilities(os.path.join(get_root_dir(), 'helmholtz')) and \
+                     binaryProtocolAvailable(),
+                     "needs an up to date helmholtz binary (make) and the msgpack package")
+class TestHelmholtzBinary(unittest.TestCase):
+
+    def test_msgpack_round_trip(self):
+        from dreamcoder.dreaming import helmholtzEnumeration, decodeHelmholtzResponse
+        g = Grammar.uniform([k0, k1, addition, subtraction, multiplication])
+        request = arrow(tint, tint)
+        inputs = [(x,) for x in range(5)]
+        for binaryProtocol in [False, True]:
+            response = decodeHelmholtzResponse(helmholtzEnumeration(g, request, inputs, 1.,
+                                                                    binaryProtocol=binaryProtocol),
+                                               binaryProtocol=binaryProtocol)
+            self.assertGreater(len(response), 0)
+            for entry in response:
+                self.assertIsInstance(entry["ll"], float)
+                for p in entry["programs"]:
+                    self.assertEqual(Program.parse(p).infer(), request)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,24 @@
+import itertools
+import json
+import multiprocessing
+import os
 import random
+import shutil
+import tempfile
+import threading
 import unittest
 from unittest import mock
 
-from dreamcoder.enumeration import multicoreEnumeration
-from dreamcoder.frontier import Frontier
-from dreamcoder.grammar import Grammar
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import k0, k1, addition, subtraction, multiplication
+from dreamcoder.enumeration import multicoreEnumeration, IncrementalEnumerator, bottom_up_parallel_worker, \
+    solveForTask_ocaml, SolverWorker, SolverOptions
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar, ContextualGrammar, Context, PCFG
+from dreamcoder.program import NamedHole, Program
 from dreamcoder.task import Task
-from dreamcoder.type import arrow, tint
+from dreamcoder.type import arrow, tint, tlist
+from dreamcoder.utilities import frameMessage, unframeMessage, binaryProtocolAvailable, binaryCapabilities, \
+    get_root_dir
 
 
 def add1():
@@ -48,6 +60,10 @@ def get_add2_task():
     return task
 
 
+# what an up to date solver binary reports for --capabilities
+CAPABILITIES = frozenset({"server", "msgpack", "stream"})
+
+
 class TestEnumerationMain(unittest.TestCase):
 
     def test_multicore_enumeration_no_tasks(self):
@@ -115,6 +131,290 @@ class TestEnumerationMain(unittest.TestCase):
             multicoreEnumeration(
                 grammar, tasks, maximumFrontier=1, enumerationTimeout=1)
 
+    @mock.patch('dreamcoder.enumeration.binaryCapabilities', return_value=CAPABILITIES)
+    @mock.patch('dreamcoder.enumeration.subprocess')
+    def test_multicore_enumeration_persistent_solvers(self, mock_subprocess, _):
+        mock_process = mock.MagicMock()
+        response = '{"add1": []}\n'.encode('utf-8')
+        mock_process.stdout.readline.return_value = response
+        mock_subprocess.Popen.return_value = mock_process
+        grammar = Grammar.uniform([])
+        task = get_add1_task()
+        tasks = [task]
+        frontiers, best_search_time = multicoreEnumeration(
+            grammar, tasks, maximumFrontier=1, enumerationTimeout=1,
+            solverOptions=SolverOptions(persistentSolvers=True))
+        self.assertEqual(len(frontiers), 1)
+        self.assertEqual(frontiers[0].entries, [])
+        self.assertEqual([t.name for t in best_search_time.keys()], ['add1'])
+        # One solver process serves every budget slice of the job
+        self.assertEqual(mock_subprocess.Popen.call_count, 1)
+        self.assertGreater(mock_process.stdout.readline.call_count, 1)
+        mock_process.communicate.assert_not_called()
+
+    @mock.patch('dreamcoder.enumeration.binaryCapabilities', return_value=CAPABILITIES)
+    @mock.patch('dreamcoder.enumeration.subprocess')
+    def test_multicore_enumeration_binary_protocol(self, mock_subprocess, _):
+        mock_process = mock.MagicMock()
+        response = frameMessage({"add1": [], "number_enumerated": 3})
+        mock_process.communicate.return_value = (response, None)
+        mock_subprocess.Popen.return_value = mock_process
+        grammar = Grammar.uniform([])
+        task = get_add1_task()
+        tasks = [task]
+        frontiers, best_search_time = multicoreEnumeration(
+            grammar, tasks, maximumFrontier=1, enumerationTimeout=1,
+            solverOptions=SolverOptions(binaryProtocol=True))
+        self.assertEqual(len(frontiers), 1)
+        self.assertEqual(frontiers[0].entries, [])
+        arguments = mock_subprocess.Popen.call_args[0][0]
+        self.assertEqual(arguments[1:], ["--msgpack"])
+        message = unframeMessage(mock_process.communicate.call_args[0][0])
+        self.assertEqual(message["tasks"][0]["name"], "add1")
+        self.assertEqual(message["tasks"][0]["examples"],
+                         [{"inputs": list(xs), "output": y} for xs, y in task.examples])
+
+    @mock.patch('dreamcoder.enumeration.binaryCapabilities', return_value=frozenset())
+    @mock.patch('dreamcoder.enumeration.subprocess')
+    def test_older_solver_binary_gets_one_shot_json(self, mock_subprocess, _):
+        mock_process = mock.MagicMock()
+        response = '{"add1": [], "number_enumerated": 3}'.encode('utf-8')
+        mock_process.communicate.return_value = (response, None)
+        mock_subprocess.Popen.return_value = mock_process
+        grammar = Grammar.uniform([])
+        frontiers, _ = multicoreEnumeration(
+            grammar, [get_add1_task()], maximumFrontier=1, enumerationTimeout=1,
+            solverOptions=SolverOptions(persistentSolvers=True, binaryProtocol=True, streamHits=True))
+        self.assertEqual(len(frontiers), 1)
+        self.assertTrue(all(c[0][0].endswith('solver') for c in mock_subprocess.Popen.call_args_list))
+        json.loads(mock_process.communicate.call_args[0][0].decode("utf-8"))
+
+
+class TestBinaryCapabilities(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.binary = os.path.join(self.directory, 'solver')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, script):
+        with open(self.binary, 'w') as handle:
+            handle.write("#!/bin/sh\n" + script)
+        os.chmod(self.binary, 0o755)
+
+    def test_binary_lists_its_capabilities(self):
+        self.build('echo \'["server", "msgpack", "stream"]\'\n')
+        self.assertEqual(binaryCapabilities(self.binary), CAPABILITIES)
+
+    def test_older_binary_has_none(self):
+        # reads a job from stdin, which is empty, and fails to parse it
+        self.build('cat > /dev/null; echo "Fatal error: exception Yojson.Json_error" >&2; exit 2\n')
+        self.assertEqual(binaryCapabilities(self.binary), frozenset())
+        self.assertEqual(binaryCapabilities(os.path.join(self.directory, 'missing')), frozenset())
+
+    def test_rebuilt_binary_is_asked_again(self):
+        self.build('echo \'["msgpack"]\'\n')
+        self.assertEqual(binaryCapabilities(self.binary), {"msgpack"})
+        with mock.patch('dreamcoder.utilities.subprocess.run') as run:
+            self.assertEqual(binaryCapabilities(self.binary), {"msgpack"})
+            run.assert_not_called()
+        self.build('echo \'["server", "msgpack", "stream"]\'\n')
+        os.utime(self.binary, (0, os.path.getmtime(self.binary) + 1))
+        self.assertEqual(binaryCapabilities(self.binary), CAPABILITIES)
+
+
+# Set by solveThenHang if it was not cancelled. Workers are forked, so it has to be a multiprocessing.Event
+UNCANCELLED = multiprocessing.Event()
+
+def solveThenHang(g=None, tasks=None, reportHit=None, **keywords):
+    for t in tasks:
+        reportHit(t, FrontierEntry(Program.parse("(lambda $0)"), logPrior=-1., logLikelihood=0.), 0.1)
+    # nothing ever sets this: the wait only ends with the timeout
+    threading.Event().wait(60)
+    UNCANCELLED.set()
+
+
+class TestStreamingHits(unittest.TestCase):
+
+    def setUp(self):
+        UNCANCELLED.clear()
+
+    def assertCancelled(self, tasks, CPUs):
+        grammar = Grammar.uniform([k0, k1, addition])
+        with mock.patch('dreamcoder.enumeration.solveForTask_python', solveThenHang):
+            frontiers, times = multicoreEnumeration(grammar, tasks, solver="python", CPUs=CPUs,
+                                                    maximumFrontier=1, enumerationTimeout=30,
+                                                    solverOptions=SolverOptions(streamHits=True))
+        self.assertFalse(UNCANCELLED.is_set())
+        self.assertEqual([str(f.bestPosterior.program) for f in frontiers], ["(lambda $0)"]*len(tasks))
+        self.assertEqual(list(times.values()), [0.1]*len(tasks))
+
+    def test_solved_jobs_are_cancelled(self):
+        self.assertCancelled([get_add1_task(), Task("identity", arrow(tlist(tint), tlist(tint)), [])],
+                             CPUs=2)
+
+    def test_solved_job_is_cancelled_without_parallelism(self):
+        # a single job runs in this process, rather than in a worker
+        self.assertCancelled([get_add1_task(), get_add2_task()], CPUs=1)
+
+    def test_python_solver_streams_hits(self):
+        grammar = Grammar.uniform([k0, k1, addition])
+        frontiers, _ = multicoreEnumeration(grammar, [get_add1_task(), get_add2_task()],
+                                            solver="python", maximumFrontier=1,
+                                            enumerationTimeout=10,
+                                            solverOptions=SolverOptions(streamHits=True))
+        self.assertTrue(all(not f.empty for f in frontiers))
+
+    @mock.patch('dreamcoder.enumeration.binaryCapabilities', return_value=CAPABILITIES)
+    @mock.patch('dreamcoder.enumeration.subprocess')
+    def test_ocaml_hits_come_before_the_response(self, mock_subprocess, _):
+        mock_process = mock.MagicMock()
+        hit = {"task": "add1", "program": "(lambda (+ 1 $0))", "time": 0.5,
+               "logLikelihood": 0., "logPrior": -3.}
+        response = {"add1": [{k: hit[k] for k in ["program", "time", "logLikelihood", "logPrior"]}],
+                    "number_enumerated": 7}
+        # every budget slice finds the same hit
+        mock_process.stdout.readline.side_effect = itertools.cycle([
+            (json.dumps(hit) + "\n").encode("utf-8"),
+            (json.dumps(response) + "\n").encode("utf-8")])
+        mock_subprocess.Popen.return_value = mock_process
+        grammar = Grammar.uniform([k0, k1, addition])
+        with mock.patch.object(grammar, "logLikelihoods", wraps=grammar.logLikelihoods) as batch:
+            # with one hit out of two, the job is not cancelled before its response
+            frontiers, times = multicoreEnumeration(grammar, [get_add1_task()],
+                                                    maximumFrontier=2, enumerationTimeout=1,
+                                                    solverOptions=SolverOptions(streamHits=True))
+        # the hit was scored when it was streamed, and not again with the response
+        self.assertTrue(batch.called)
+        self.assertTrue(all(c[0][0] == [] for c in batch.call_args_list))
+        self.assertEqual(mock_subprocess.Popen.call_args[0][0][1:], ["--stream"])
+        self.assertEqual(str(frontiers[0].bestPosterior.program), "(lambda (+ 1 $0))")
+        self.assertAlmostEqual(times[frontiers[0].task], 0.5, places=2)
+
+
+@unittest.skipUnless({"server", "msgpack", "stream"} <= binaryCapabilities(os.path.join(get_root_dir(), 'solver')) and \
+                     binaryProtocolAvailable(),
+                     "needs an up to date solver binary (make) and the msgpack package")
+class TestSolverBinary(unittest.TestCase):
+    """Talks to the real solver, rather than a mock"""
+
+    def setUp(self):
+        self.g = Grammar.uniform([k0, k1, addition, subtraction, multiplication])
+        self.tasks = [get_add1_task(), Task("double", arrow(tint, tint), [((x,), 2*x) for x in range(5)])]
+        self.maximumFrontiers = {t: 10 for t in self.tasks}
+
+    def solve(self, **keywords):
+        frontiers, _, _ = solveForTask_ocaml(g=self.g, tasks=self.tasks,
+                                             lowerBound=0., upperBound=9., budgetIncrement=1.5,
+                                             timeout=30, evaluationTimeout=0.1,
+                                             maximumFrontiers=self.maximumFrontiers, **keywords)
+        return {t.name: sorted((str(e.program), e.logLikelihood) for e in frontiers[t])
+                for t in self.tasks}
+
+    def test_msgpack_matches_json(self):
+        expected = self.solve()
+        self.assertTrue(all(expected.values()))
+        self.assertEqual(self.solve(binaryProtocol=True), expected)
+
+    def test_streamed_hits_match_the_response(self):
+        hits = []
+        frontiers = self.solve(binaryProtocol=True,
+                               reportHit=lambda t, e, dt: hits.append((t.name, str(e.program))))
+        # a hit can later be pushed out of its frontier by better ones
+        self.assertLessEqual({(n, p) for n, f in frontiers.items() for p, _ in f}, set(hits))
+
+    def test_server_slices_match_one_shot(self):
+        # large enough that nothing gets pushed out of a frontier
+        self.maximumFrontiers = {t: 1000 for t in self.tasks}
+        for binaryProtocol in [False, True]:
+            worker = SolverWorker(self.g, self.tasks, self.maximumFrontiers, evaluationTimeout=0.1,
+                                  binaryProtocol=binaryProtocol)
+            found = {t.name: [] for t in self.tasks}
+            try:
+                for lowerBound, upperBound in [(0., 6.), (6., 9.)]:
+                    frontiers, _, _ = worker.extend(tasks=self.tasks,
+                                                    lowerBound=lowerBound, upperBound=upperBound,
+                                                    budgetIncrement=1.5, timeout=30,
+                                                    maximumFrontiers=self.maximumFrontiers)
+                    for t in self.tasks:
+                        found[t.name] += [(str(e.program), e.logLikelihood) for e in frontiers[t]]
+            finally:
+                worker.close()
+            self.assertEqual({n: sorted(f) for n, f in found.items()}, self.solve())
+
+    def test_multicore_enumeration_with_persistent_solvers(self):
+        for binaryProtocol in [False, True]:
+            frontiers, times = multicoreEnumeration(self.g, self.tasks, maximumFrontier=1,
+                                                    enumerationTimeout=10, evaluationTimeout=0.1,
+                                                    solverOptions=SolverOptions(persistentSolvers=True,
+                                                                                binaryProtocol=binaryProtocol))
+            self.assertTrue(all(not f.empty for f in frontiers))
+            self.assertTrue(all(times[t] is not None for t in self.tasks))
+
+
+class TestIncrementalEnumerator(unittest.TestCase):
+
+    def assertSameWindows(self, g, request, upperBound, increment=1.5):
+        enumerator = IncrementalEnumerator(g, request, maximumDepth=99)
+        lowerBound, budget = 0., increment
+        while budget <= upperBound:
+            incremental = sorted((str(p), round(l, 6))
+                                 for l, _, p in enumerator.enumerate(budget))
+            restarted = sorted((str(p), round(l, 6))
+                               for l, _, p in g.enumeration(Context.EMPTY, [], request,
+                                                            upperBound=budget,
+                                                            lowerBound=lowerBound,
+                                                            maximumDepth=99))
+            self.assertEqual(incremental, restarted)
+            lowerBound, budget = budget, budget + increment
+
+    def test_same_programs_in_each_window(self):
+        g = Grammar.uniform([k0, k1, addition, subtraction, multiplication])
+        self.assertSameWindows(g, arrow(tint, tint), 10.5)
+
+    def test_same_programs_in_each_window_contextual(self):
+        g = ContextualGrammar.fromGrammar(
+            Grammar.uniform([k0, k1, addition, subtraction, multiplication]))
+        self.assertSameWindows(g, arrow(tint, tint, tint), 9.)
+
+    def test_exhausted(self):
+        g = Grammar.uniform([k0, k1])
+        enumerator = IncrementalEnumerator(g, tint, maximumDepth=99)
+        programs = [str(p) for _, _, p in enumerator.enumerate(10.)]
+        self.assertEqual(sorted(programs), ["0", "1"])
+        self.assertTrue(enumerator.exhausted)
+
+
+class TestObservationalEquivalence(unittest.TestCase):
+
+    def setUp(self):
+        self.g = Grammar.uniform([k0, k1, addition, subtraction, multiplication])
+        self.pcfg = PCFG.from_grammar(self.g, arrow(tint, tint)).number_rules()
+        self.skeleton = NamedHole(self.pcfg.start_symbol).wrap_in_abstractions(1)
+        self.inputs = [(x,) for x in range(-3, 4)]
+
+    def behaviors(self, inputs, n=300):
+        programs = itertools.islice(self.pcfg.quantized_enumeration(skeletons=[self.skeleton],
+                                                                    inputs=inputs), n)
+        return [tuple(p.evaluate([])(x) for x, in self.inputs) for p in programs]
+
+    def test_programs_behave_differently(self):
+        plain = self.behaviors(None)
+        pruned = self.behaviors(self.inputs)
+        self.assertGreater(len(plain), len(set(plain)))
+        self.assertEqual(len(pruned), len(set(pruned)))
+        self.assertGreater(len(set(pruned)), len(set(plain)))
+
+    def test_worker_solves_task(self):
+        task = Task("square plus one", arrow(tint, tint),
+                    [((x,), x*x + 1) for x in range(-3, 4)])
+        frontiers, _ = bottom_up_parallel_worker(self.g, self.pcfg, [self.skeleton], [task], 2.,
+                                                 {task: 1}, evaluationTimeout=0.1,
+                                                 observationalEquivalence=True)
+        self.assertFalse(frontiers[task].empty)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,190 @@
+import math
+import pickle
+import random
+import unittest
+from unittest import mock
+
+from dreamcoder.domains.list.listPrimitives import McCarthyPrimitives
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar, Context, LikelihoodBatch, LikelihoodSummaryStore, Uses, \
+    configureLikelihoodSummaryStore
+from dreamcoder.task import Task
+from dreamcoder.program import Program
+from dreamcoder.type import arrow, tbool, tint, tlist
+
+
+def enumerate_programs(g, request, upperBound):
+    return sorted((str(p), round(l, 6))
+                  for l, _, p in g.enumeration(Context.EMPTY, [], request,
+                                               upperBound=upperBound,
+                                               maximumDepth=99))
+
+
+class TestCandidateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.request = arrow(tlist(tint), tint)
+        self.g = Grammar.uniform(McCarthyPrimitives())
+
+    def test_cache_does_not_change_enumeration(self):
+        cached = enumerate_programs(self.g, self.request, 9.)
+        self.assertGreater(len(self.g._candidateCache), 0)
+        with mock.patch.object(Grammar, '_candidateCacheEntry', return_value=None):
+            uncached = enumerate_programs(Grammar.uniform(McCarthyPrimitives()),
+                                          self.request, 9.)
+        self.assertEqual(cached, uncached)
+
+    def test_cache_does_not_change_likelihoods(self):
+        for l, _, p in self.g.enumeration(Context.EMPTY, [], self.request,
+                                          upperBound=8., maximumDepth=99):
+            self.assertAlmostEqual(self.g.logLikelihood(self.request, p), l)
+
+    def test_polymorphic_requests_are_not_cached(self):
+        self.g.buildCandidates(self.request.arguments[1], Context.EMPTY, [])
+        self.assertEqual(len(self.g._candidateCache), 1)
+        context, t = Context.EMPTY.makeVariable()
+        self.g.buildCandidates(t, context, [])
+        self.assertEqual(len(self.g._candidateCache), 1)
+
+    def test_cache_is_shared_across_next_variables(self):
+        request = tlist(tint)
+        for n in [0, 5, 2]:
+            context = Context(n, [])
+            cached = self.g.buildCandidates(request, context, [])
+            with mock.patch.object(Grammar, '_candidateCacheEntry', return_value=None):
+                uncached = self.g.buildCandidates(request, context, [])
+            self.assertEqual([(l, t, p, k.nextVariable, k.substitution) for l, t, p, k in cached],
+                             [(l, t, p, k.nextVariable, k.substitution) for l, t, p, k in uncached])
+        self.assertEqual(len(self.g._candidateCache), 1)
+
+    def test_cache_is_bounded(self):
+        with mock.patch.object(Grammar, 'CANDIDATECACHESIZE', 2):
+            for request in [tint, tbool, tlist(tint), tlist(tbool)]:
+                self.g.buildCandidates(request, Context.EMPTY, [])
+            self.assertEqual(len(self.g._candidateCache), 2)
+
+    def test_new_productions_clear_the_cache(self):
+        self.g.buildCandidates(tint, Context.EMPTY, [])
+        version = self.g.productionsVersion
+        self.g.productions = [(l, t, p) for l, t, p in self.g.productions
+                              if str(p) != "0"]
+        self.assertNotEqual(self.g.productionsVersion, version)
+        candidates = self.g.buildCandidates(tint, Context.EMPTY, [])
+        self.assertNotIn("0", [str(p) for _, _, p, _ in candidates])
+        self.assertEqual(len(self.g._candidateCache), 1)
+
+    def test_cache_is_not_pickled(self):
+        self.g.buildCandidates(tint, Context.EMPTY, [])
+        g = pickle.loads(pickle.dumps(self.g))
+        self.assertEqual(len(g._candidateCache), 0)
+        self.assertEqual(g, self.g)
+
+
+class TestLikelihoodBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.request = arrow(tlist(tint), tint)
+        self.g = Grammar.uniform(McCarthyPrimitives())
+        self.programs = [(self.request, p)
+                         for _, _, p in self.g.enumeration(Context.EMPTY, [], self.request,
+                                                           upperBound=9., maximumDepth=99)]
+
+    def assertScores(self, batch, g):
+        for (request, p), l in zip(self.programs, batch.logLikelihoods(g)):
+            self.assertAlmostEqual(g.logLikelihood(request, p), l)
+
+    def test_batch_matches_logLikelihood(self):
+        self.assertScores(LikelihoodBatch(self.g, self.programs), self.g)
+
+    def test_batch_rescores_under_new_weights(self):
+        batch = LikelihoodBatch(self.g, self.programs)
+        r = random.Random(0)
+        for _ in range(3):
+            self.assertScores(batch, self.g.randomWeights(lambda _: r.uniform(-3., 0.)))
+
+    def test_empty_batch(self):
+        self.assertEqual(len(self.g.logLikelihoods([])), 0)
+
+
+class TestLikelihoodSummaryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = configureLikelihoodSummaryStore()
+        self.request = arrow(tlist(tint), tint)
+        self.g = Grammar.uniform(McCarthyPrimitives())
+        self.p = Program.parse("(lambda (+ (car $0) 1))")
+
+    def tearDown(self):
+        configureLikelihoodSummaryStore()
+
+    def test_reweighted_grammars_share_summaries(self):
+        summary = self.g.closedLikelihoodSummary(self.request, self.p)
+        r = random.Random(0)
+        reweighted = self.g.randomWeights(lambda _: r.uniform(-3., 0.))
+        with mock.patch.object(Grammar, 'likelihoodSummary') as likelihoodSummary:
+            self.assertIs(reweighted.closedLikelihoodSummary(self.request, self.p), summary)
+            self.assertEqual(likelihoodSummary.call_count, 0)
+        cached = reweighted.logLikelihood(self.request, self.p)
+        configureLikelihoodSummaryStore()
+        self.assertAlmostEqual(reweighted.logLikelihood(self.request, self.p), cached)
+
+    def test_new_productions_invalidate_summaries(self):
+        summary = self.g.closedLikelihoodSummary(self.request, self.p)
+        invented = Program.parse("#(lambda (+ $0 1))")
+        bigger = Grammar.uniform(McCarthyPrimitives() + [invented])
+        self.assertIsNot(bigger.closedLikelihoodSummary(self.request, self.p), summary)
+        self.assertEqual(len(self.store.tables), 2)
+
+    def test_evicted_tables_are_not_used(self):
+        self.g.closedLikelihoodSummary(self.request, self.p)
+        for body in ["(+ $0 1)", "(+ $0 $0)"]:
+            invented = Program.parse("#(lambda %s)" % body)
+            Grammar.uniform(McCarthyPrimitives() + [invented]).closedLikelihoodSummary(self.request, self.p)
+        self.assertEqual(len(self.store.tables), 2)
+        self.g.closedLikelihoodSummary(self.request, self.p)
+        self.assertIn((self.request, self.p), self.store.table(self.g))
+
+
+class TestInsideOutside(unittest.TestCase):
+
+    def setUp(self):
+        self.request = arrow(tlist(tint), tint)
+        self.g = Grammar.uniform(McCarthyPrimitives())
+        programs = [p for _, _, p in self.g.enumeration(Context.EMPTY, [], self.request,
+                                                        upperBound=9., maximumDepth=99)]
+        r = random.Random(0)
+        self.frontiers = [Frontier([FrontierEntry(p, logPrior=0., logLikelihood=r.uniform(-2., 0.))
+                                    for p in r.sample(programs, 3)],
+                                   task=Task(str(n), self.request, []))
+                          for n in range(20)] + [Frontier([], task=Task("empty", self.request, []))]
+
+    def step(self, g, pseudoCounts):
+        """One round of EM, summing Uses like insideOutside used to"""
+        u = Uses()
+        for f in self.frontiers[:-1]:
+            for e in g.rescoreFrontier(f).normalize():
+                u += math.exp(e.logPosterior) * g.closedLikelihoodSummary(self.request, e.program).toUses()
+        return Grammar(math.log(u.actualVariables + pseudoCounts) - math.log(u.possibleVariables + pseudoCounts),
+                       [(math.log(u.actualUses.get(p, 0.) + pseudoCounts) -
+                         math.log(u.possibleUses.get(p, 0.) + pseudoCounts), t, p)
+                        for _, t, p in g.productions])
+
+    def assertSameWeights(self, g1, g2, places=7):
+        self.assertAlmostEqual(g1.logVariable, g2.logVariable, places=places)
+        for (l1, _, p1), (l2, _, p2) in zip(g1.productions, g2.productions):
+            self.assertEqual(p1, p2)
+            self.assertAlmostEqual(l1, l2, places=places)
+
+    def test_matches_summing_uses(self):
+        expected = self.g
+        for iterations in range(1, 4):
+            expected = self.step(expected, 1.)
+            self.assertSameWeights(self.g.insideOutside(self.frontiers, 1., iterations=iterations), expected)
+
+    def test_runs_to_convergence(self):
+        g = self.g.insideOutside(self.frontiers, 0.1, tolerance=1e-6)
+        self.assertSameWeights(self.step(g, 0.1), g, places=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
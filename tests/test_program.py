@@ -0,0 +1,170 @@
+import gc
+import pickle
+import threading
+import unittest
+
+from dreamcoder.domains.list.listPrimitives import McCarthyPrimitives, bootstrapTarget_extra
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import EtaLongVisitor, HashConsing, Program
+from dreamcoder.task import Task
+from dreamcoder.type import Context, MutableContext, PersistentContext, PersistentMutableContext, \
+    arrow, emptyContext, tint, tlist
+
+
+class TestHashConsing(unittest.TestCase):
+
+    def setUp(self):
+        McCarthyPrimitives()
+        HashConsing.enable()
+
+    def tearDown(self):
+        HashConsing.disable()
+
+    def test_equal_programs_share_nodes(self):
+        a = Program.parse("(lambda (+ $0 (car (cdr $0))))")
+        b = Program.parse("(lambda (+ $0 (car (cdr $0))))")
+        c = Program.parse("(lambda (+ $0 (car $0)))")
+        self.assertIs(a, b)
+        self.assertNotEqual(a, c)
+        self.assertIs(a.body.f, c.body.f)
+        self.assertIs(Program.parse("#(lambda (car $0))"),
+                      Program.parse("#(lambda (car $0))"))
+
+    def test_interned_and_ordinary_programs_compare_structurally(self):
+        a = Program.parse("(lambda (+ $0 (car (cdr $0))))")
+        HashConsing.disable()
+        b = Program.parse("(lambda (+ $0 (car (cdr $0))))")
+        self.assertIsNot(a, b)
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertIs(b.intern(), a)
+
+    def test_unpickled_programs_are_not_interned(self):
+        a = Program.parse("(lambda (cons (+ (car $0) 0) $0))")
+        b = pickle.loads(pickle.dumps(a))
+        self.assertFalse(b.interned)
+        self.assertEqual(a, b)
+        self.assertIs(b.intern(), a)
+
+    def test_dead_programs_leave_the_table(self):
+        gc.collect()
+        size = HashConsing.size()
+        a = Program.parse("(lambda (cons (car $0) (cdr (cdr $0))))")
+        self.assertGreater(HashConsing.size(), size)
+        del a
+        gc.collect()
+        self.assertEqual(HashConsing.size(), size)
+
+    def test_version_table(self):
+        # Union takes canBeEmpty as a keyword, which construct has to let through
+        from dreamcoder.vs import VersionTable
+        v = VersionTable(typed=False, identity=False)
+        p = Program.parse("(lambda (+ $0 (car (cdr $0))))")
+        j = v.superVersionSpace(v.incorporate(p), 1)
+        self.assertIn(p, set(v.extract(j)))
+        self.assertTrue(any(e.isUnion for e in v.walk(j)))
+
+    def test_frontier_combine(self):
+        task = Task("t", arrow(tlist(tint), tint), [])
+        programs = ["(lambda (car $0))", "(lambda (+ (car $0) 0))"]
+        frontiers = [Frontier([FrontierEntry(Program.parse(p), logPrior=-1., logLikelihood=0.)
+                               for p in programs[:n]], task=task)
+                     for n in [1, 2]]
+        self.assertEqual(sorted(str(e.program) for e in frontiers[0].combine(frontiers[1])),
+                         sorted(programs))
+
+
+def run(f, x):
+    try:
+        return f(x)
+    except Exception as e:
+        return type(e)
+
+
+class TestCompile(unittest.TestCase):
+
+    def setUp(self):
+        self.inputs = [[], [0], [3, 1, 2], [5, 5, 0, 1, 4, 2]]
+
+    def assertCompiles(self, p):
+        f = p.evaluate([])
+        g = p.compile()(())
+        self.assertEqual([run(f, x) for x in self.inputs],
+                         [run(g, x) for x in self.inputs], str(p))
+
+    def test_enumerated_programs(self):
+        for primitives, request in [(McCarthyPrimitives(), arrow(tlist(tint), tint)),
+                                    (bootstrapTarget_extra(), arrow(tlist(tint), tlist(tint)))]:
+            g = Grammar.uniform(primitives)
+            for _, _, p in g.enumeration(Context.EMPTY, [], request,
+                                         upperBound=9., maximumDepth=99):
+                self.assertCompiles(p)
+
+    def test_recursive_programs(self):
+        McCarthyPrimitives()
+        bootstrapTarget_extra()
+        for p in ["(lambda (fix1 $0 (lambda (lambda (if (empty? $0) 0 (+ (car $0) ($1 (cdr $0))))))))",
+                  "(lambda (fix1 $0 (lambda (lambda (if (empty? $0) empty (cons (+ 1 (car $0)) ($1 (cdr $0))))))))",
+                  "(lambda (#(lambda (lambda (cons $0 $1))) $0 (car $0)))"]:
+            self.assertCompiles(Program.parse(p))
+
+    def test_free_variables_fail_like_evaluate(self):
+        with self.assertRaises(IndexError):
+            Program.parse("(car $0)").compile()(())
+
+
+class TestPersistentContext(unittest.TestCase):
+
+    def setUp(self):
+        self.g = Grammar.uniform(bootstrapTarget_extra())
+        self.request = arrow(tlist(tint), tlist(tint))
+
+    def tearDown(self):
+        PersistentContext.disable()
+
+    def enumerate(self):
+        return [(l, p) for l, _, p in self.g.enumeration(emptyContext(), [], self.request,
+                                                         upperBound=8., maximumDepth=99)]
+
+    def infer(self, programs):
+        return [str(p.infer()) for p in programs]
+
+    def test_switch_changes_the_entry_points(self):
+        self.assertIs(emptyContext(), Context.EMPTY)
+        self.assertIs(type(MutableContext()), MutableContext)
+        PersistentContext.enable()
+        self.assertIs(emptyContext(), PersistentContext.EMPTY)
+        self.assertIs(type(MutableContext()), PersistentMutableContext)
+        PersistentContext.disable()
+        self.assertIs(emptyContext(), Context.EMPTY)
+        self.assertIs(type(MutableContext()), MutableContext)
+
+    def test_same_results_as_substitution_list(self):
+        expected = self.enumerate()
+        programs = [p for _, p in expected]
+        types = self.infer(programs)
+        likelihoods = [self.g.logLikelihood(self.request, p) for p in programs]
+        etaLong = [str(EtaLongVisitor(self.request).execute(p)) for p in programs]
+        PersistentContext.enable()
+        self.g.clearCandidateCache()
+        self.assertEqual(self.enumerate(), expected)
+        self.assertEqual(self.infer(programs), types)
+        self.assertEqual([self.g.logLikelihood(self.request, p) for p in programs], likelihoods)
+        self.assertEqual([str(EtaLongVisitor(self.request).execute(p)) for p in programs], etaLong)
+
+    def test_threads_share_the_empty_context(self):
+        programs = [p for _, p in self.enumerate()]
+        expected = self.infer(programs)
+        PersistentContext.enable()
+        results = [None]*6
+        def worker(j):
+            results[j] = self.infer(programs)
+        threads = [threading.Thread(target=worker, args=(j,)) for j in range(len(results))]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(results, [expected]*len(results))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,20 @@
+import os
+import pickle
+import random
+import signal
 import unittest
+from unittest import mock
+
+import torch
+
+from dreamcoder.domains.list.listPrimitives import McCarthyPrimitives
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.recognition import DummyFeatureExtractor, HelmholtzDreamer, RandomFeatureExtractor, \
+    RecognitionModel, SummaryRows, TaskCache, enumerateEnsemble, trainEnsemble
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint, tlist
 
 
 class TestRecognition(unittest.TestCase):
@@ -10,5 +26,214 @@ class TestRecognition(unittest.TestCase):
             self.fail('Unable to import from recognition module')
 
 
+class TestMinibatchTraining(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        torch.manual_seed(0)
+        self.grammar = Grammar.uniform(McCarthyPrimitives())
+        request = arrow(tlist(tint), tint)
+        programs = ["(lambda (car $0))", "(lambda (+ (car $0) 1))",
+                    "(lambda (car (cdr $0)))", "(lambda (if (empty? $0) 0 (car $0)))"]
+        self.frontiers = [Frontier([FrontierEntry(Program.parse(p), logPrior=-3., logLikelihood=0.)
+                                    for p in programs[n:n + 2]],
+                                   task=Task("t%d" % n, request, []))
+                          for n in range(3)]
+        self.model = RecognitionModel(DummyFeatureExtractor([]), self.grammar)
+
+    def test_minibatch_matches_per_frontier_losses(self):
+        frontiers = [self.model.replaceProgramsWithLikelihoodSummaries(f).normalize()
+                     for f in self.frontiers]
+        rows = SummaryRows(self.grammar)
+        batched, _, kept = self.model.minibatchLoss(frontiers, True, rows=rows)
+        self.assertEqual(kept, frontiers)
+        for frontier, loss in zip(frontiers, batched.tolist()):
+            expected, _ = self.model.frontierBiasOptimal(frontier)
+            self.assertAlmostEqual(loss, expected.item(), places=4)
+
+    def test_summary_rows_match_grammars(self):
+        for contextual, mask in [(False, False), (True, False), (True, True)]:
+            model = RecognitionModel(DummyFeatureExtractor([]), self.grammar,
+                                     contextual=contextual, mask=mask)
+            summaries = [e.program for f in self.frontiers
+                         for e in model.replaceProgramsWithLikelihoodSummaries(f)]
+            xs = torch.randn(len(summaries), model.outputDimensionality)
+            batched = model.grammarBuilder.batchedLogLikelihoods(xs, summaries).tolist()
+            for x, summary, ll in zip(xs, summaries, batched):
+                self.assertAlmostEqual(ll, summary.logLikelihood(model.grammarBuilder(x)).item(), places=4)
+
+    def test_shared_rows_give_the_same_likelihoods(self):
+        summaries = [e.program for f in self.frontiers
+                     for e in self.model.replaceProgramsWithLikelihoodSummaries(f)]
+        rows = self.model.grammarBuilder.summaryRows()
+        xs = torch.randn(len(summaries), self.model.outputDimensionality)
+        before = self.model.grammarBuilder.batchedLogLikelihoods(xs, summaries, rows=rows)
+        rows.share()
+        self.assertEqual(len(rows.shared), 3)
+        self.assertTrue(all(t.is_shared() for t in rows.shared))
+        after = self.model.grammarBuilder.batchedLogLikelihoods(xs, summaries, rows=rows)
+        self.assertTrue(torch.equal(before, after))
+
+    def test_train_with_minibatches(self):
+        self.model.train(self.frontiers, steps=20, batchSize=2, biasOptimal=False)
+        self.assertTrue(self.model.trained)
+        contextual = RecognitionModel(DummyFeatureExtractor([]), self.grammar, contextual=True)
+        contextual.train(self.frontiers, steps=20, batchSize=2, biasOptimal=True)
+        self.assertTrue(contextual.trained)
+
+
+class TestEnsemble(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = Grammar.uniform(McCarthyPrimitives())
+        request = arrow(tlist(tint), tint)
+        self.tasks = [Task("first", request, [(([n, 2],), n) for n in range(3)]),
+                      Task("second", request, [(([1, n],), n) for n in range(3)])]
+        self.frontiers = [Frontier([FrontierEntry(Program.parse("(lambda (car $0))"),
+                                                  logPrior=-3., logLikelihood=0.)],
+                                   task=self.tasks[0])]
+        self.recognizers = [RecognitionModel(DummyFeatureExtractor([]), self.grammar, id=k)
+                            for k in range(2)]
+
+    def test_workers_send_back_trained_weights(self):
+        before = [r.grammarBuilder.logProductions.weight.clone() for r in self.recognizers]
+        trained = trainEnsemble(self.recognizers, self.frontiers, CPUs=2, steps=20)
+        self.assertEqual(trained, self.recognizers)
+        for r, weight in zip(trained, before):
+            self.assertTrue(r.trained)
+            self.assertFalse(torch.equal(r.grammarBuilder.logProductions.weight, weight))
+
+    def test_members_enumerate_at_the_same_time(self):
+        results = enumerateEnsemble(self.recognizers, self.tasks, CPUs=2, solver="python",
+                                    enumerationTimeout=1, maximumFrontier=1, evaluationTimeout=0.1)
+        self.assertEqual(len(results), 2)
+        for frontiers, times in results:
+            self.assertTrue(all(f.task is t for f, t in zip(frontiers, self.tasks)))
+            self.assertEqual(set(times), set(self.tasks))
+
+    def test_killed_members_are_noticed(self):
+        def die(*_, **__): os.kill(os.getpid(), signal.SIGKILL)
+        with mock.patch.object(self.recognizers[1], "enumerateFrontiers", die):
+            with self.assertRaisesRegex(AssertionError, "recognizer 1 died"):
+                enumerateEnsemble(self.recognizers, self.tasks, CPUs=2, solver="python",
+                                  enumerationTimeout=1, maximumFrontier=1, evaluationTimeout=0.1)
+
+    def test_members_on_the_gpu_enumerate_in_turn(self):
+        for r in self.recognizers: r.use_cuda = True
+        with mock.patch.object(RecognitionModel, "enumerateFrontiers", autospec=True,
+                               return_value=([], {})) as enumerateFrontiers:
+            results = enumerateEnsemble(self.recognizers, self.tasks, CPUs=2)
+        self.assertEqual(results, [([], {})]*2)
+        self.assertEqual([c[0][0] for c in enumerateFrontiers.call_args_list], self.recognizers)
+
+
+class TestTaskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tasks = [Task("t%d" % n, arrow(tint, tint), []) for n in range(3)]
+
+    def test_least_recently_used_tasks_are_evicted(self):
+        cache = TaskCache(maximumSize=2)
+        calls = []
+        def compute(t):
+            calls.append(t.name)
+            return t.name
+        for t in self.tasks[:2] + self.tasks[:1] + self.tasks[2:] + self.tasks[:2]:
+            cache.get(t, compute)
+        self.assertEqual(calls, ["t0", "t1", "t2", "t1"])
+
+    def test_caches_pickle_empty(self):
+        cache = TaskCache(maximumSize=2)
+        cache.get(self.tasks[0], lambda t: 1)
+        cache = pickle.loads(pickle.dumps(cache))
+        self.assertEqual((len(cache), cache.maximumSize), (0, 2))
+
+    def test_frozen_features_last_until_training(self):
+        model = RecognitionModel(RandomFeatureExtractor([]), Grammar.uniform(McCarthyPrimitives()))
+        features = model.frozenFeaturesOfTask(self.tasks[0])
+        self.assertIs(model.frozenFeaturesOfTask(self.tasks[0]), features)
+        model.train([], steps=0, helmholtzRatio=1., defaultRequest=arrow(tlist(tint), tint))
+        self.assertIsNot(model.frozenFeaturesOfTask(self.tasks[0]), features)
+
+
+class TestBatchedInference(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = Grammar.uniform(McCarthyPrimitives())
+        self.tasks = [Task("t%d" % n, arrow(tlist(tint), tint), []) for n in range(4)]
+
+    def logProductions(self, g):
+        if hasattr(g, 'noParent'):
+            return self.logProductions(g.noParent) + self.logProductions(g.variableParent) + \
+                [l for prim in sorted(g.library, key=str) for h in g.library[prim]
+                 for l in self.logProductions(h)]
+        return [g.logVariable] + [l for l, _, _ in g.productions]
+
+    def test_batched_grammars_match_grammar_of_task(self):
+        for contextual, mask in [(False, False), (True, False), (True, True)]:
+            model = RecognitionModel(RandomFeatureExtractor([]), self.grammar, hidden=[8],
+                                     contextual=contextual, mask=mask)
+            grammars = model.grammarsOfTasks(self.tasks)
+            self.assertEqual(set(grammars), set(self.tasks))
+            for t in self.tasks:
+                expected = self.logProductions(model.grammarOfTask(t).untorch())
+                for a, b in zip(self.logProductions(grammars[t]), expected):
+                    self.assertAlmostEqual(a, b, places=5)
+
+    def test_identical_grammars_are_shared(self):
+        model = RecognitionModel(DummyFeatureExtractor([]), self.grammar)
+        self.assertEqual(len(set(map(id, model.grammarsOfTasks(self.tasks).values()))), 1)
+        model = RecognitionModel(RandomFeatureExtractor([]), self.grammar)
+        self.assertEqual(len(set(map(id, model.grammarsOfTasks(self.tasks).values()))), 4)
+        self.assertEqual(len(set(map(id, model.grammarsOfTasks(self.tasks, quantum=100.).values()))), 1)
+
+
+class TestHelmholtzDreamer(unittest.TestCase):
+
+    def test_workers_stream_until_finished(self):
+        dreamer = HelmholtzDreamer(lambda k, workers: iter(range(k, 10, workers)), 2, maximumSize=3)
+        self.assertEqual(sorted(self.receiveAll(dreamer)), list(range(10)))
+
+    def receiveAll(self, dreamer):
+        received = []
+        while True:
+            x = dreamer.get()
+            if x is None: break
+            received.append(x)
+        dreamer.close()
+        return received
+
+    def test_killed_workers_count_as_finished(self):
+        def produce(k, workers):
+            if k == 1: os.kill(os.getpid(), signal.SIGKILL)
+            return iter(range(5))
+        self.assertEqual(sorted(self.receiveAll(HelmholtzDreamer(produce, 2))), list(range(5)))
+
+    def test_workers_have_their_own_numpy_seeds(self):
+        import numpy as np
+        # once numpy has been seeded, forked workers all start from the same state
+        np.random.seed(0)
+        dreams = self.receiveAll(HelmholtzDreamer(lambda k, workers: iter([np.random.randint(2**30)]), 2))
+        self.assertEqual(len(set(dreams)), 2)
+
+    def train(self, cores):
+        McCarthyPrimitives()
+        request = arrow(tlist(tint), tint)
+        frontiers = [Frontier([FrontierEntry(Program.parse("(lambda (car $0))"), logPrior=-3., logLikelihood=0.)],
+                              task=Task("t", request, []))]
+        model = RecognitionModel(DummyFeatureExtractor([]), Grammar.uniform(McCarthyPrimitives()))
+        with mock.patch("dreamcoder.recognition.numberOfCPUs", return_value=cores), \
+             mock.patch("dreamcoder.recognition.HelmholtzDreamer", wraps=HelmholtzDreamer) as dreamer:
+            model.train([], steps=10, CPUs=2, helmholtzRatio=1., helmholtzFrontiers=frontiers)
+        self.assertTrue(model.trained)
+        return dreamer
+
+    def test_training_on_background_dreams(self):
+        self.assertEqual(self.train(2).call_args[0][1], 1)
+
+    def test_training_on_one_core_dreams_in_process(self):
+        self.assertFalse(self.train(1).called)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import dill
+import numpy as np
+
+from dreamcoder.checkpoint import CheckpointDirectory
+from dreamcoder.dreamcoder import ECResult
+from dreamcoder.frontier import Frontier
+from dreamcoder.resultView import ECResultView, indexCacheDirectory
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint
+
+
+class TestECResultView(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = tempfile.TemporaryDirectory()
+        environment = mock.patch.dict(os.environ, {"XDG_CACHE_HOME": self.cache.name})
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.tasks = [Task("t%d" % n, arrow(tint, tint), [((n,), n)]) for n in range(4)]
+        metrics = {t: {"expectedProductionUses": np.full(3, float(n)),
+                       "heldoutTestingTimes": None if n % 2 else 1.5,
+                       "frontier": Frontier([], task=t)}
+                   for n, t in enumerate(self.tasks)}
+        self.result = ECResult(parameters={"iterations": 2}, learningCurve=[1, 3], hitsAtEachWake=[1, 3],
+                               searchTimes=[[0.5], [0.25, 1.]], testingSearchTime=[[], [2.]],
+                               numTestingTasks=2, recognitionTaskMetrics=metrics,
+                               taskSolutions={t: Frontier([], task=t) for t in self.tasks[:2]})
+
+    def tearDown(self):
+        self.directory.cleanup()
+        self.cache.cleanup()
+
+    def files(self, path):
+        return sorted(os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs)
+
+    def dump(self):
+        path = os.path.join(self.directory.name, "run.pickle")
+        with open(path, "wb") as handle: dill.dump(self.result, handle)
+        return path
+
+    def test_numbers_are_memory_mapped_columns(self):
+        view = ECResultView(self.dump())
+        self.assertIsInstance(view.learningCurve, np.memmap)
+        self.assertEqual(list(view.hitsAtEachWake), [1, 3])
+        self.assertEqual(view.searchTimes[1], [0.25, 1.])
+        self.assertEqual(view.testingSearchTime[:], [[], [2.]])
+        self.assertEqual(view.numTestingTasks, 2)
+        self.assertEqual(view.length("taskSolutions"), 2)
+        self.assertNotIn("taskSolutions", view.__dict__)
+
+        metrics = view.recognitionTaskMetrics
+        self.assertEqual([t.name for t in metrics], ["t0", "t1", "t2", "t3"])
+        t1 = metrics[self.tasks[1]]
+        self.assertEqual(list(t1["expectedProductionUses"]), [1., 1., 1.])
+        self.assertIsNone(t1["heldoutTestingTimes"])
+        self.assertIs(t1["frontier"].task, [t for t in metrics if t.name == "t1"][0])
+        self.assertEqual(set(t1.keys()), {"expectedProductionUses", "heldoutTestingTimes", "frontier"})
+        self.assertEqual(view.getTestingTasks(), self.tasks[2:])
+
+    def test_pickles_are_indexed_again_when_they_change(self):
+        path = self.dump()
+        self.assertEqual(list(ECResultView(path).learningCurve), [1, 3])
+        self.result.learningCurve.append(4)
+        self.dump()
+        self.assertEqual(list(ECResultView(path).learningCurve), [1, 3, 4])
+
+    def test_pickles_are_indexed_into_the_cache(self):
+        path = self.dump()
+        self.assertEqual(list(ECResultView(path).learningCurve), [1, 3])
+        self.assertEqual(os.listdir(self.directory.name), ["run.pickle"])
+        self.assertEqual(len(os.listdir(indexCacheDirectory())), 1)
+
+    def test_checkpoint_directories_are_indexed_as_they_are_exported(self):
+        path = os.path.join(self.directory.name, "run.checkpoint")
+        checkpoints = CheckpointDirectory(path)
+        checkpoints.export(self.result, 1)
+        files = self.files(path)
+        self.assertIn(os.path.join(path, "index", "0", "index.json"), files)
+
+        view = ECResultView(path)
+        self.assertEqual(view._indexPath, os.path.join(path, "index", "0"))
+        self.assertEqual(list(view.learningCurve), [1, 3])
+        self.assertEqual(self.files(path), files)
+        self.assertFalse(os.path.exists(indexCacheDirectory()))
+
+        # exported before there were indices
+        shutil.rmtree(os.path.join(path, "index"))
+        files = self.files(path)
+        self.assertEqual(list(ECResultView(path).learningCurve), [1, 3])
+        self.assertEqual(self.files(path), files)
+
+    def test_checkpoint_directories_are_read_in_place(self):
+        path = os.path.join(self.directory.name, "run.checkpoint")
+        checkpoints = CheckpointDirectory(path)
+        checkpoints.export(self.result, 1)
+        self.result.learningCurve.append(4)
+        checkpoints.export(self.result, 2)
+
+        view = ECResultView(path, iteration=1)
+        self.assertEqual(list(view.learningCurve), [1, 3])
+        self.assertEqual(view.parameters, {"iterations": 2})
+        self.assertEqual(set(view.taskSolutions), set(self.tasks[:2]))
+        self.assertEqual(sorted(os.listdir(os.path.join(view._indexPath, "pickles"))),
+                         ["recognitionTaskMetrics", "tasks"])
+        self.assertEqual(list(ECResultView(path).learningCurve), [1, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing import Process
+from unittest import mock
+
+import dreamcoder.task
+from dreamcoder.domains.list.listPrimitives import McCarthyPrimitives, bootstrapTarget_extra
+from dreamcoder.program import EvaluationBudget, OutOfFuel, Primitive, Program
+from dreamcoder.task import EvaluationCache, Task, configureEvaluationCache
+from dreamcoder.type import arrow, tint, tlist
+from dreamcoder.utilities import Backstop
+
+
+class TestEvaluationCache(unittest.TestCase):
+
+    def setUp(self):
+        McCarthyPrimitives()
+        self.program = Program.parse("(lambda (car $0))")
+        self.examples = [(([n, 1, 2],), n) for n in range(5)]
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        configureEvaluationCache()
+        self.directory.cleanup()
+
+    def task(self, name, examples=None):
+        return Task(name, arrow(tlist(tint), tint), examples or self.examples, cache=True)
+
+    def test_tasks_with_the_same_inputs_share_entries(self):
+        cache = configureEvaluationCache()
+        self.assertTrue(self.task("first").check(self.program, 1.))
+        self.assertEqual(cache.statistics(), (0, 5))
+        self.assertTrue(self.task("second").check(self.program, 1.))
+        self.assertEqual(cache.statistics(), (5, 5))
+
+    def test_cached_outputs_are_checked_against_each_task(self):
+        configureEvaluationCache()
+        self.assertTrue(self.task("first").check(self.program, 1.))
+        wrong = [(x, y + 1) for x, y in self.examples]
+        self.assertFalse(self.task("second", wrong).check(self.program, 1.))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = EvaluationCache(maximumSize=2)
+        for k in [b"a", b"b", b"c"]: cache.record(k, k)
+        self.assertIs(cache.lookup(b"a"), EvaluationCache.MISSING)
+        self.assertEqual(cache.lookup(b"b"), b"b")
+        cache.record(b"d", b"d")
+        self.assertEqual(cache.lookup(b"b"), b"b")
+        self.assertIs(cache.lookup(b"c"), EvaluationCache.MISSING)
+
+    def test_evaluations_that_run_out_of_fuel_are_not_cached(self):
+        bootstrapTarget_extra()
+        p = Program.parse("(lambda (map (lambda (+ $0 1)) $0))")
+        xs = list(range(10**5))
+        task = Task("long increment", arrow(tlist(tint), tlist(tint)), [((xs,), [x + 1 for x in xs])],
+                    cache=True)
+        cache = configureEvaluationCache()
+        self.assertFalse(task.check(p, 0.001))
+        self.assertEqual(len(cache.table), 0)
+        self.assertTrue(task.check(p, 10.))
+        self.assertEqual(len(cache.table), 1)
+
+    def test_inputs_that_print_alike_have_different_digests(self):
+        import numpy as np
+        a = np.arange(2000)
+        b = a.copy()
+        b[1000] = -1
+        self.assertEqual(str((a,)), str((b,)))
+        self.assertNotEqual(EvaluationCache.digest((a,)), EvaluationCache.digest((b,)))
+
+    def test_forked_workers_share_the_database_and_report_their_counts(self):
+        import dill
+        from multiprocessing import Queue
+        from dreamcoder.enumeration import wrapInThread
+        cache = configureEvaluationCache(path=os.path.join(self.directory.name, "evaluations.db"))
+        q = Queue()
+        worker = Process(target=wrapInThread(lambda: self.task("first").check(self.program, 1.)),
+                         kwargs={"q": q, "ID": 0})
+        worker.start()
+        message = dill.loads(q.get())
+        worker.join()
+        self.assertEqual(len(cache.table), 0)
+        self.assertEqual(cache.statistics(), (0, 0))
+        pid, counts = message["evaluations"]
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(counts, [0, 5])
+        self.assertTrue(self.task("second").check(self.program, 1.))
+        self.assertEqual(cache.statistics(), (5, 0))
+        self.assertIs(dreamcoder.task.EVALUATIONTABLE, cache)
+
+
+def _spin(n):
+    while True: n += 1
+
+
+class TestEvaluationBudget(unittest.TestCase):
+
+    def setUp(self):
+        bootstrapTarget_extra()
+        self.task = Task("increment", arrow(tlist(tint), tlist(tint)),
+                         [(([n, 1, 2],), [n + 1, 2, 3]) for n in range(3)])
+
+    def test_programs_stop_when_out_of_fuel(self):
+        # one call to the program, three to the function, and three elements mapped over
+        f = Program.parse("(lambda (map (lambda (+ $0 1)) $0))").compile(EvaluationBudget(7))(())
+        self.assertEqual(f([1, 2, 3]), [2, 3, 4])
+        with self.assertRaises(OutOfFuel):
+            f([1, 2, 3])
+
+    def test_looping_primitives_spend_fuel(self):
+        # fold and range loop over + without calling anything the program built
+        f = Program.parse("(lambda (fold (range $0) 0 +))").compile(EvaluationBudget(10))(())
+        self.assertEqual(f(3), 3)
+        with self.assertRaises(OutOfFuel):
+            f(3)
+
+    def test_check_works_off_the_main_thread(self):
+        long = Task("long increment", self.task.request, [((list(range(10**6)),), list(range(1, 10**6 + 1)))])
+        p = Program.parse("(lambda (map (lambda (+ $0 1)) $0))")
+        results = []
+        def check():
+            results.append(self.task.check(p, 1.))
+            results.append(long.check(p, 0.01))
+        worker = threading.Thread(target=check)
+        worker.start()
+        worker.join()
+        self.assertEqual(results, [True, False])
+
+    def test_runaway_primitives_hit_the_backstop(self):
+        Primitive("spin", arrow(tint, tint), _spin)
+        starting = time.time()
+        self.assertFalse(self.task.check(Program.parse("(lambda (map (lambda (spin $0)) $0))"), 0.2))
+        self.assertLess(time.time() - starting, 2.)
+
+    def test_probabilistic_likelihood_model_runs_out_of_fuel(self):
+        from dreamcoder.likelihoodModel import ProbabilisticLikelihoodModel
+        # not a function, so it is run as it is compiled, with a budget of one call
+        p = Program.parse("(map (lambda (+ $0 1)) (range (+ 1 1)))")
+        self.assertEqual(ProbabilisticLikelihoodModel(1e-9).score(p, self.task), (False, float('-inf')))
+
+
+class Inner(Exception): pass
+class Outer(Exception): pass
+
+
+class TestBackstop(unittest.TestCase):
+
+    def tearDown(self):
+        self.assertEqual(Backstop.deadlines, [])
+
+    def test_timer_keeps_running(self):
+        Backstop.arm(10., Outer)
+        Backstop.disarm()
+        self.assertNotEqual(signal.getitimer(signal.ITIMER_PROF), (0., 0.))
+        bootstrapTarget_extra()
+        task = Task("increment", arrow(tlist(tint), tlist(tint)), [(([1, 2],), [2, 3])])
+        p = Program.parse("(lambda (map (lambda (+ $0 1)) $0))")
+        with mock.patch("signal.setitimer") as setitimer:
+            for _ in range(100): self.assertTrue(task.check(p, 0.01))
+        self.assertEqual(setitimer.call_count, 0)
+
+    def test_inner_deadline(self):
+        Backstop.arm(10., Outer)
+        try:
+            Backstop.arm(0.1, Inner)
+            try:
+                with self.assertRaises(Inner): _spin(0)
+            finally:
+                Backstop.disarm()
+            # the outer backstop is still armed
+            self.assertEqual(len(Backstop.deadlines), 1)
+        finally:
+            Backstop.disarm()
+
+    def test_outer_deadline(self):
+        Backstop.arm(0.1, Outer)
+        try:
+            Backstop.arm(None, Inner)
+            try:
+                with self.assertRaises(Outer): _spin(0)
+            finally:
+                Backstop.disarm()
+        finally:
+            Backstop.disarm()
+
+
+if __name__ == '__main__':
+    unittest.main()
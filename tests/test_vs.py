@@ -0,0 +1,126 @@
+import pickle
+import unittest
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget_extra
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.vs import CompressionStore, FlatVersionTable, VersionTable, induceGrammar_Beta
+
+
+class TestFlatVersionTable(unittest.TestCase):
+
+    def setUp(self):
+        bootstrapTarget_extra()
+        self.programs = [Program.parse(s) for s in
+                         ["(lambda (map (lambda (+ $0 1)) $0))",
+                          "(lambda (map (lambda (+ $0 $0)) (cdr $0)))",
+                          "(lambda (fold $0 0 (lambda (lambda (+ $0 $1)))))",
+                          "(lambda (fold (cdr $0) 1 (lambda (lambda (+ $0 $1)))))"]]
+
+    def test_table_stores_version_spaces_as_columns(self):
+        v = VersionTable(typed=False, identity=False)
+        heads = [v.incorporate(p) for p in self.programs]
+        self.assertEqual([next(v.extract(j)) for j in heads], self.programs)
+        self.assertEqual([v.incorporate(p) for p in self.programs], heads)
+        self.assertEqual(len(v.opcodes), len(v.first))
+        self.assertEqual(len(v.opcodes), len(v.second))
+
+        u = v.union(heads[:2])
+        self.assertEqual(v.opcodes[u], VersionTable.UNION)
+        self.assertEqual(v.union(list(reversed(heads[:2]))), u)
+        self.assertEqual(v.intersection(u, heads[0]), heads[0])
+        self.assertEqual(v.intersection(u, heads[2]), v.empty)
+
+        rewritten = v.superVersionSpace(heads[0], 1)
+        self.assertIn(self.programs[0], set(v.extract(rewritten)))
+        v.clearCaches()
+        self.assertIn(self.programs[1], set(v.extract(v.superVersionSpace(heads[1], 1))))
+
+    def test_flat_table_has_the_same_version_spaces(self):
+        v = VersionTable(typed=False, identity=False)
+        spaces = [v.superVersionSpace(v.incorporate(p), 1) for p in self.programs]
+        flat = FlatVersionTable(v, self.programs)
+        self.assertEqual(len(flat), len(v))
+        for j in range(len(v)):
+            self.assertEqual(set(flat.extract(j)), set(v.extract(j)))
+        for p, j in zip(self.programs, spaces):
+            self.assertEqual(flat.superSpaces[p], j)
+            for k in spaces:
+                self.assertEqual(flat.haveOverlap(j, k), v.haveOverlap(j, k))
+
+    def frontiers(self):
+        return [Frontier([FrontierEntry(p, logLikelihood=0., logPrior=0.)],
+                         task=Task(str(n), p.infer(), []))
+                for n, p in enumerate(self.programs)]
+
+    def test_scoring_in_parallel_finds_the_same_inventions(self):
+        g = Grammar.uniform(bootstrapTarget_extra())
+        frontiers = self.frontiers()
+        results = [induceGrammar_Beta(g, frontiers, a=2, topI=5, CPUs=CPUs)
+                   for CPUs in [1, 2]]
+        (g1, fs1), (g2, fs2) = results
+        self.assertEqual(str(g1), str(g2))
+        self.assertEqual([str(f.entries[0].program) for f in fs1],
+                         [str(f.entries[0].program) for f in fs2])
+        self.assertGreater(len(g1.productions), len(g.productions))
+
+    def test_store_keeps_version_spaces_between_calls(self):
+        g = Grammar.uniform(bootstrapTarget_extra())
+        store = CompressionStore()
+        g1, fs1 = induceGrammar_Beta(g, self.frontiers(), a=2, topI=5, store=store)
+        size = len(store.table)
+        self.assertGreater(len(store.rewrites), 0)
+
+        # the store crosses over to pypy and back as a pickle
+        store = pickle.loads(pickle.dumps(store))
+        g2, fs2 = induceGrammar_Beta(g1, fs1, a=2, topI=5, store=store)
+        self.assertEqual(len(store.table), size)
+        g3, fs3 = induceGrammar_Beta(g1, fs1, a=2, topI=5)
+        self.assertEqual(str(g2), str(g3))
+        self.assertEqual([str(f.entries[0].program) for f in fs2],
+                         [str(f.entries[0].program) for f in fs3])
+
+        store.versionTable(3)
+        self.assertEqual(len(store.rewrites), 0)
+
+    def test_store_history_does_not_change_compression(self):
+        def filledTable(table):
+            # another run has already filled the table, in a different order
+            for s in ["(lambda (map (lambda (+ $0 $0)) $0))",
+                      "(lambda (fold $0 1 (lambda (lambda (+ $1 $0)))))"]:
+                table.superVersionSpace(table.incorporate(Program.parse(s)), 2)
+            for p in reversed(self.programs):
+                table.superVersionSpace(table.incorporate(p), 2)
+            return table
+
+        def ranking(table):
+            versions = [[table.superVersionSpace(table.incorporate(p), 2)] for p in self.programs]
+            return [str(next(table.extract(k)))
+                    for k in table.bestInventions(versions, bs=15, CPUs=1)]
+
+        self.assertEqual(ranking(filledTable(VersionTable(typed=False, identity=False))),
+                         ranking(VersionTable(typed=False, identity=False)))
+
+        g = Grammar.uniform(bootstrapTarget_extra())
+        store = CompressionStore()
+        filledTable(store.versionTable(2))
+        g1, fs1 = induceGrammar_Beta(g, self.frontiers(), a=2, topI=5, store=store)
+        g2, fs2 = induceGrammar_Beta(g, self.frontiers(), a=2, topI=5)
+        self.assertEqual(str(g1), str(g2))
+        self.assertEqual([str(f.entries[0].program) for f in fs1],
+                         [str(f.entries[0].program) for f in fs2])
+
+    def test_store_starts_over_past_its_bound(self):
+        store = CompressionStore(maximumSize=10)
+        table = store.versionTable(1)
+        self.assertIs(store.versionTable(1), table)
+        for p in self.programs: table.incorporate(p)
+        self.assertGreater(len(table), 10)
+        self.assertIsNot(store.versionTable(1), table)
+        self.assertEqual(store.arity, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()